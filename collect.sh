@@ -1,9 +1,9 @@
 #!/bin/bash
 
 if [ $# -eq 0 ]; then
-    echo "collect.sh EXCHANGE SYMBOLS OUTPUT_PATH"
+    echo "collect.sh EXCHANGE SYMBOLS OUTPUT_PATH [CAPTURE_PROFILE]"
     echo "example: collect.sh binancefutures btcusdt,ethusdt /mnt/data"
     exit 1
 fi
 
-python3 collect/main.py $1 $2 $3
\ No newline at end of file
+python3 collect/main.py $1 $2 $3 $4
\ No newline at end of file
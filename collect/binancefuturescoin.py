@@ -1,6 +1,8 @@
 import asyncio
 import json
 import logging
+import re
+import sys
 import time
 import urllib.parse
 
@@ -8,9 +10,18 @@ import aiohttp
 from aiohttp import ClientSession, WSMsgType
 from yarl import URL
 
+from book import SHM_PREFIX, SharedBook
+from clock import now
+from exchangeinfo import ExchangeInfo, check_symbols
+from profiles import DEPTH, FUTURES_DEFAULT, RAW, TRADE, CaptureProfile
+from streams import stream_name
+
+# 快照响应以 lastUpdateId 开头, 只需要匹配开头的一小段
+LAST_UPDATE_ID = re.compile(rb'"lastUpdateId":\s*(\d+)')
+
 
 class BinanceFuturesCoin:
-    def __init__(self, queue, symbols, timeout=7):
+    def __init__(self, queue, symbols, timeout=7, book_depth=0, book_prefix=SHM_PREFIX, profile=None):
         self.symbols = symbols
         self.client = aiohttp.ClientSession(headers={ 'Content-Type': 'application/json' })
         self.closed = False
@@ -19,41 +30,112 @@ class BinanceFuturesCoin:
         self.timeout = timeout
         self.keep_alive = None
         self.queue = queue
+        self.ws = None
+        self.request_id = 0
+        # stream 名称 -> 最后一条消息的本地时间, 由 watchdog.py 检查
+        self.last_seen = {}
+        # 每个交易对重新同步订单簿时加 1, 用于丢弃进行中的快照任务
+        self.resync = {}
+        self._exchange_info = None
+        self.symbols_checked = False
+        self.books = None
+        if book_depth > 0:
+            self.books = {symbol: SharedBook(symbol, book_depth, book_prefix) for symbol in symbols}
+        self.profile = CaptureProfile(profile, FUTURES_DEFAULT)
+        # 收到的消息数, 由 profiling.GcMonitor 统计每条消息的分配
+        self.messages = 0
+        # stream 名称 -> (处理函数, symbol, stream), symbol 和 stream 在订阅时驻留, 消息路径上不再创建
+        self.dispatch = self.__dispatch_table()
+
+    @property
+    def exchange_info(self):
+        if self._exchange_info is None:
+            self._exchange_info = ExchangeInfo('dapi')
+        return self._exchange_info
 
     async def __on_message(self, raw_message):
-        timestamp = time.time()
+        timestamp = now()
+        self.messages += 1
+        # 只有需要内容的处理函数才解析 JSON
+        stream = stream_name(raw_message)
+        if stream is None:
+            message = json.loads(raw_message)
+            stream = message.get('stream')
+            if stream is None:
+                # SUBSCRIBE/UNSUBSCRIBE 的响应
+                if message.get('error') is not None:
+                    logging.error('Subscription request failed. %s' % raw_message)
+                return
+        handler = self.dispatch.get(stream)
+        if handler is not None:
+            handler[0](handler[1], handler[2], timestamp, raw_message)
+
+    def __dispatch_table(self):
+        handlers = {DEPTH: self.__on_depth, TRADE: self.__on_trade, RAW: self.__on_raw}
+        return {stream: (handlers[kind], sys.intern(symbol), sys.intern(stream))
+                for symbol in self.symbols for stream, kind in self.profile.streams(symbol)}
+
+    def __on_depth(self, symbol, stream, timestamp, raw_message):
         message = json.loads(raw_message)
-        # logging.debug(message)
-        stream = message['stream']
-        tokens = stream.split('@')
-        if tokens[1] == 'depth':
-            symbol = tokens[0]
-            data = message['data']
-            u = data['u']
-            pu = data['pu']
-            prev_u = self.prev_u.get(symbol)
-            if prev_u is None or pu != prev_u:
-                pending_messages = self.pending_messages.get(symbol)
-                if pending_messages is None:
-                    logging.warning('Mismatch on the book. prev_update_id=%s, pu=%s' % (prev_u, pu))
-                    asyncio.create_task(self.__get_marketdepth_snapshot(symbol))
-                    self.pending_messages[symbol] = pending_messages = []
-                pending_messages.append((message, raw_message))
-            else:
-                self.queue.put((symbol, timestamp, raw_message))
-                self.prev_u[symbol] = u
-        elif tokens[1] == 'aggTrade':
-            symbol = tokens[0]
-            self.queue.put((symbol, timestamp, raw_message))
-        elif tokens[1] == 'trade':
-            symbol = tokens[0]
-            self.queue.put((symbol, timestamp, raw_message))
-        elif tokens[1] == 'bookTicker':
-            symbol = tokens[0]
-            self.queue.put((symbol, timestamp, raw_message))
-        elif tokens[1] == 'markPrice':
-            symbol = tokens[0]
+        data = message['data']
+        u = data['u']
+        pu = data['pu']
+        prev_u = self.prev_u.get(symbol)
+        if prev_u is None or pu != prev_u:
+            pending_messages = self.pending_messages.get(symbol)
+            if pending_messages is None:
+                logging.warning('Mismatch on the book. prev_update_id=%s, pu=%s' % (prev_u, pu))
+                asyncio.create_task(self.__get_marketdepth_snapshot(symbol))
+                self.pending_messages[symbol] = pending_messages = []
+            pending_messages.append((message, raw_message))
+        else:
             self.queue.put((symbol, timestamp, raw_message))
+            self.prev_u[symbol] = u
+            # 只记录已经同步的深度消息, 快照同步卡住时 watchdog 也能发现
+            self.last_seen[stream] = timestamp
+            if self.books is not None:
+                self.books[symbol].on_depth(data['b'], data['a'], data['E'], timestamp)
+
+    def __on_trade(self, symbol, stream, timestamp, raw_message):
+        self.queue.put((symbol, timestamp, raw_message))
+        if self.books is not None:
+            data = json.loads(raw_message)['data']
+            self.books[symbol].on_trade(data['p'], data['q'], -1 if data['m'] else 1, data['T'])
+
+    def __on_raw(self, symbol, stream, timestamp, raw_message):
+        self.queue.put((symbol, timestamp, raw_message))
+        self.last_seen[stream] = timestamp
+
+    def __reset_book(self, symbol):
+        self.resync[symbol] = self.resync.get(symbol, 0) + 1
+        self.prev_u.pop(symbol, None)
+        self.pending_messages.pop(symbol, None)
+
+    async def __send_streams(self, method, params):
+        self.request_id += 1
+        logging.info('%s %s' % (method, params))
+        await self.ws.send_str(json.dumps({'method': method, 'params': params, 'id': self.request_id}))
+
+    def resync_books(self):
+        """
+        重置所有交易对的订单簿同步状态, 下一条深度消息会重新获取快照。
+        writer 在磁盘压力为 CRITICAL 时丢弃了消息, 归档中的深度有缺口, 由 main.py 在压力解除后调用。
+        """
+        for symbol in list(self.symbols):
+            self.__reset_book(symbol)
+
+    async def resubscribe(self, symbol, streams):
+        """
+        在当前连接上重新订阅一个交易对的 streams (见 watchdog.py), 其他交易对不受影响。
+        包含深度时同时重置订单簿同步状态, 下一条深度消息会重新获取快照。
+        """
+        if self.ws is None or symbol not in self.symbols:
+            return False
+        if any(self.dispatch[stream][0] == self.__on_depth for stream in streams):
+            self.__reset_book(symbol)
+        await self.__send_streams('UNSUBSCRIBE', streams)
+        await self.__send_streams('SUBSCRIBE', streams)
+        return True
 
     async def __keep_alive(self):
         while not self.closed:
@@ -66,7 +148,7 @@ class BinanceFuturesCoin:
                 logging.exception('Failed to keep alive.')
                 return
 
-    async def __curl(self, path, query=None, timeout=None, verb=None, rethrow_errors=None, max_retries=None):
+    async def __curl(self, path, query=None, timeout=None, verb=None, rethrow_errors=None, max_retries=None, raw=False):
         if timeout is None:
             timeout = self.timeout
 
@@ -97,7 +179,7 @@ class BinanceFuturesCoin:
             self.retries += 1
             if self.retries > max_retries:
                 raise Exception("Max retries on %s (%s) hit, raising." % (path, json.dumps(query or '')))
-            return self.__curl(path, query, timeout, verb, rethrow_errors, max_retries)
+            return self.__curl(path, query, timeout, verb, rethrow_errors, max_retries, raw)
 
         # Make the request
         try:
@@ -152,17 +234,22 @@ class BinanceFuturesCoin:
         # Reset retry counter on success
         self.retries = 0
 
+        if raw:
+            return await response.read()
         return await response.json()
 
     async def connect(self):
+        if not self.symbols_checked:
+            self.symbols_checked = True
+            await asyncio.get_running_loop().run_in_executor(None, check_symbols, self.exchange_info, self.symbols)
         try:
-            stream = '/'.join(['%s@depth@0ms/%s@trade/%s@markPrice@1s/%s@bookTicker' % (symbol, symbol, symbol, symbol)
-                               for symbol in self.symbols])
+            stream = '/'.join([stream for symbol in self.symbols for stream, _ in self.profile.streams(symbol)])
             url = 'wss://dstream.binance.com/stream?streams=%s' % stream
             async with ClientSession() as session:
                 async with session.ws_connect(url) as ws:
                     logging.info('WS Connected.')
                     self.ws = ws
+                    self.last_seen = {}
                     self.keep_alive = asyncio.create_task(self.__keep_alive())
                     async for msg in ws:
                         if msg.type == WSMsgType.TEXT:
@@ -188,20 +275,41 @@ class BinanceFuturesCoin:
 
     async def close(self):
         self.closed = True
-        await self.ws.close()
+        if self.ws is not None:
+            await self.ws.close()
         await self.client.close()
+        if self.books is not None:
+            for book in self.books.values():
+                book.close()
         await asyncio.sleep(1)
 
+    async def __last_update_id(self, raw):
+        match = LAST_UPDATE_ID.search(raw, 0, 256)
+        if match is not None:
+            return int(match.group(1))
+        data = await asyncio.get_running_loop().run_in_executor(None, json.loads, raw)
+        return data['lastUpdateId']
+
     async def __get_marketdepth_snapshot(self, symbol):
-        data = await self.__curl(verb='GET', path='/v1/depth', query={'symbol': symbol, 'limit': 1000})
-        self.queue.put((symbol, time.time(), json.dumps(data)))
-        lastUpdateId = data['lastUpdateId']
+        resync = self.resync.get(symbol, 0)
+        raw = await self.__curl(verb='GET', path='/v1/depth', query={'symbol': symbol, 'limit': 1000}, raw=True)
+        lastUpdateId = await self.__last_update_id(raw)
+        if self.books is not None:
+            data = await asyncio.get_running_loop().run_in_executor(None, json.loads, raw)
+        if resync != self.resync.get(symbol, 0):
+            # 获取和解析快照期间已经重新订阅, 此时不能再修改任何状态
+            return
+        timestamp = now()
+        # 原样写入响应, 不做 json 解析和重新编码
+        self.queue.put((symbol, timestamp, raw.strip().decode()))
+        if self.books is not None:
+            self.books[symbol].on_snapshot(data['bids'], data['asks'], data['E'], timestamp)
         self.prev_u[symbol] = None
         # Process the pending messages.
         prev_u = None
         while prev_u is None:
             pending_messages = self.pending_messages.get(symbol)
-            timestamp = time.time()
+            timestamp = now()
             while pending_messages:
                 message, raw_message = pending_messages.pop(0)
                 data = message['data']
@@ -216,7 +324,12 @@ class BinanceFuturesCoin:
                     logging.warning('UpdateId does not match. symbol=%s, prev_update_id=%d, pu=%d' % (symbol, prev_u, pu))
                 self.queue.put((symbol, timestamp, raw_message))
                 self.prev_u[symbol] = prev_u = u
+                self.last_seen[message['stream']] = timestamp
+                if self.books is not None:
+                    self.books[symbol].on_depth(data['b'], data['a'], data['E'], timestamp)
             if prev_u is None:
                 await asyncio.sleep(0.5)
+                if resync != self.resync.get(symbol, 0):
+                    return
         self.pending_messages[symbol] = None
         logging.warning('The book is initialized. symbol=%s, prev_update_id=%d' % (symbol, prev_u))
@@ -1,6 +1,8 @@
 import asyncio
 import json
 import logging
+import re
+import sys
 import time
 import urllib.parse
 
@@ -8,12 +10,22 @@ import aiohttp
 from aiohttp import ClientSession, WSMsgType
 from yarl import URL
 
+from book import SHM_PREFIX, SharedBook
+from clock import now
+from dedupe import Deduplicator
+from exchangeinfo import ExchangeInfo, check_symbols
+from profiles import DEPTH, RAW, SPOT_DEFAULT, TRADE, CaptureProfile
+from streams import stream_name
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# 快照响应以 lastUpdateId 开头, 只需要匹配开头的一小段
+LAST_UPDATE_ID = re.compile(rb'"lastUpdateId":\s*(\d+)')
+
 
 class Binance:
-    def __init__(self, queue, symbols, timeout=7):
-        self.symbols = symbols
+    def __init__(self, queue, symbols, timeout=7, book_depth=0, book_prefix=SHM_PREFIX, profile=None, dedupe=False):
+        self.symbols = list(symbols)
         self.client = aiohttp.ClientSession(headers={ 'Content-Type': 'application/json' })
         self.closed = False
         self.pending_messages = {}
@@ -21,158 +33,213 @@ class Binance:
         self.timeout = timeout
         self.keep_alive = None
         self.queue = queue
+        self.ws = None
+        # 当前连接上已订阅的交易对
+        self.subscribed = set()
+        self.request_id = 0
+        # 每次建立连接加 1, 用于丢弃上一个连接遗留的快照任务
+        self.generation = 0
+        # 每个交易对重新同步订单簿时加 1, 用于丢弃进行中的快照任务
+        self.resync = {}
+        # stream 名称 -> 最后一条消息的本地时间, 由 watchdog.py 检查
+        self.last_seen = {}
+        self._exchange_info = None
+        self.symbols_checked = False
+        # book_depth > 0 时在进程内维护订单簿, 并把前 book_depth 档发布到共享内存
+        self.book_depth = book_depth
+        self.book_prefix = book_prefix
+        self.books = None
+        if book_depth > 0:
+            self.books = {symbol: SharedBook(symbol, book_depth, book_prefix) for symbol in self.symbols}
+        # 每个交易对订阅的 stream, 见 profiles.py
+        self.profile = CaptureProfile(profile, SPOT_DEFAULT)
+        # dedupe 为 True 时丢弃内容没有变化的 kline/ticker/有限档深度推送, 见 dedupe.py
+        self.dedupe = Deduplicator() if dedupe else None
+        # 收到的消息数, 由 profiling.GcMonitor 统计每条消息的分配
+        self.messages = 0
+        # stream 名称 -> (处理函数, symbol, stream), symbol 和 stream 在订阅时驻留, 消息路径上不再创建
+        self.dispatch = {}
+        for symbol in self.symbols:
+            self.dispatch.update(self.__dispatch_entries(symbol))
+
+    @property
+    def exchange_info(self):
+        '''
+        现货 exchangeInfo 的本地缓存, 首次访问时才创建。
+        '''
+        if self._exchange_info is None:
+            self._exchange_info = ExchangeInfo('spot')
+        return self._exchange_info
 
     async def __on_message(self, raw_message):
         '''
         异步处理 WebSocket 接收到的原始消息。
-        使用 @ 分隔符将 stream 拆分成 tokens，例如 btcusdt@depth 会被拆分成 ['btcusdt', 'depth']
-        根据消息类型和内容进行不同的处理。
-        对于深度消息，它会检查消息的连续性，如果不连续则获取快照并暂存消息，否则直接处理。
-        对于其他类型的消息，则直接将消息存入队列中。
+        按 stream 名称在预先生成的分发表中找到处理函数和交易对, 不在表中的 stream (如退订后仍在途的消息) 直接忽略。
+        stream 名称直接从消息开头读取, 只有需要内容的处理函数才解析 JSON。
+        '''
+        timestamp = now()
+        self.messages += 1
+        stream = stream_name(raw_message)
+        if stream is None:
+            message = json.loads(raw_message)
+            stream = message.get('stream')
+            if stream is None:
+                # SUBSCRIBE/UNSUBSCRIBE 的响应, 例如 {"result": null, "id": 1}
+                if message.get('error') is not None:
+                    logging.error('Subscription request failed. %s' % raw_message)
+                return
+        handler = self.dispatch.get(stream)
+        if handler is not None:
+            handler[0](handler[1], handler[2], timestamp, raw_message)
+
+    def __dispatch_entries(self, symbol):
+        handlers = {DEPTH: self.__on_depth, TRADE: self.__on_trade, RAW: self.__on_raw}
+        symbol = sys.intern(symbol)
+        return {stream: (handlers[kind], symbol, sys.intern(stream)) for stream, kind in self.profile.streams(symbol)}
+
+    def __on_depth(self, symbol, stream, timestamp, raw_message):
         '''
-        timestamp = time.time()
+        检查深度消息的连续性，如果不连续则获取快照并暂存消息，否则直接处理。
+        '''
+        if symbol not in self.subscribed:
+            # 退订后仍在途的消息
+            return
         message = json.loads(raw_message)
-        # logging.debug(message)
-        stream = message['stream']
-        tokens = stream.split('@')
-        if tokens[1] == 'depth':
-            # 如果消息类型是 depth，表示这是一个深度消息。
-            symbol = tokens[0]
-            data = message['data']
-            # 从数据中获取更新 ID u 和首个更新 ID U
-            u = data['u']
-            U = data['U']
-            # 检查 prev_u（前一个更新 ID），如果是第一次接收或者 U 不是紧接在 prev_u 之后
-            prev_u = self.prev_u.get(symbol)
-            if prev_u is None or U != prev_u + 1:
-                # 获取 pending_messages（待处理的消息队列），如果为空，记录警告日志并异步获取市场深度快照，初始化 pending_messages
-                pending_messages = self.pending_messages.get(symbol)
-                if pending_messages is None:
-                    logging.warning('Mismatch on the book. prev_update_id=%s, U=%s' % (prev_u, U))
-                    asyncio.create_task(self.__get_marketdepth_snapshot(symbol))
-                    self.pending_messages[symbol] = pending_messages = []
-                # 将当前消息添加到 pending_messages
-                pending_messages.append((message, raw_message))
-            else:
-                # 如果 U 是紧接在 prev_u 之后，将消息加入队列并更新 prev_u
-                self.queue.put((symbol, timestamp, raw_message))
-                self.prev_u[symbol] = u
-        # 对于 aggTrade（聚合交易）、trade（交易）、bookTicker（订单簿价格）、markPrice（标记价格）等其他消息类型，直接将消息加入队列 self.queue
-        elif tokens[1] == 'aggTrade':
-            # {
-            #   "e": "aggTrade",      // 事件类型
-            #   "E": 1672515782136,   // 事件时间
-            #   "s": "BNBBTC",        // 交易对
-            #   "a": 12345,           // 归集交易ID
-            #   "p": "0.001",         // 成交价格
-            #   "q": "100",           // 成交数量
-            #   "f": 100,             // 被归集的首个交易ID
-            #   "l": 105,             // 被归集的末次交易ID
-            #   "T": 1672515782136,   // 成交时间
-            #   "m": true,            // 买方是否是做市方。如true，则此次成交是一个主动卖出单，否则是一个主动买入单。
-            #   "M": true             // 请忽略该字段
-            # }
-            symbol = tokens[0]
-            self.queue.put((symbol, timestamp, raw_message))
-        elif tokens[1] == 'trade':
-            # {
-            #   "e": "trade",        // 事件类型
-            #   "E": 1672515782136,  // 事件时间
-            #   "s": "BNBBTC",       // 交易对
-            #   "t": 12345,          // 交易ID
-            #   "p": "0.001",        // 成交价格
-            #   "q": "100",          // 成交数量
-            #   "T": 1672515782136,  // 成交时间
-            #   "m": true,           // 买方是否是做市方。如true，则此次成交是一个主动卖出单，否则是一个主动买入单。
-            #   "M": true            // 请忽略该字段
-            # }
-            symbol = tokens[0]
-            self.queue.put((symbol, timestamp, raw_message))
-        elif tokens[1] == 'bookTicker':
-            # 最优挂单信息
-            # {
-            #   "u":400900217,     // order book updateId
-            #   "s":"BNBUSDT",     // 交易对
-            #   "b":"25.35190000", // 买单最优挂单价格
-            #   "B":"31.21000000", // 买单最优挂单数量
-            #   "a":"25.36520000", // 卖单最优挂单价格
-            #   "A":"40.66000000"  // 卖单最优挂单数量
-            # }
-            symbol = tokens[0]
-            self.queue.put((symbol, timestamp, raw_message))
-        elif tokens[1] == 'markPrice':
-            symbol = tokens[0]
-            self.queue.put((symbol, timestamp, raw_message))
-        elif tokens[1] == 'kline_1m':
-            # {
-            #   "e": "kline",          // 事件类型
-            #   "E": 1672515782136,    // 事件时间
-            #   "s": "BNBBTC",         // 交易对
-            #   "k": {
-            #     "t": 1672515780000,  // 这根K线的起始时间
-            #     "T": 1672515839999,  // 这根K线的结束时间
-            #     "s": "BNBBTC",       // 交易对
-            #     "i": "1m",           // K线间隔
-            #     "f": 100,            // 这根K线期间第一笔成交ID
-            #     "L": 200,            // 这根K线期间末一笔成交ID
-            #     "o": "0.0010",       // 这根K线期间第一笔成交价
-            #     "c": "0.0020",       // 这根K线期间末一笔成交价
-            #     "h": "0.0025",       // 这根K线期间最高成交价
-            #     "l": "0.0015",       // 这根K线期间最低成交价
-            #     "v": "1000",         // 这根K线期间成交量
-            #     "n": 100,            // 这根K线期间成交数量
-            #     "x": false,          // 这根K线是否完结（是否已经开始下一根K线）
-            #     "q": "1.0000",       // 这根K线期间成交额
-            #     "V": "500",          // 主动买入的成交量
-            #     "Q": "0.500",        // 主动买入的成交额
-            #     "B": "123456"        // 忽略此参数
-            #   }
-            # }
-            symbol = tokens[0]
-            self.queue.put((symbol, timestamp, raw_message))
-        elif tokens[1] == 'ticker_1h':
-            # 滚动窗口统计
-            # {
-            #   "e": "1hTicker",    // 事件类型
-            #   "E": 1672515782136, // 事件时间
-            #   "s": "BNBBTC",      // 交易对
-            #   "p": "0.0015",      // 价格变化
-            #   "P": "250.00",      // 价格变化百分比
-            #   "o": "0.0010",      // 开盘价
-            #   "h": "0.0025",      // 最高价
-            #   "l": "0.0010",      // 最低价
-            #   "c": "0.0025",      // 最后价格
-            #   "w": "0.0018",      // 加权平均价
-            #   "v": "10000",       // 基础资产总交易量
-            #   "q": "18",          // 报价资产总交易量
-            #   "O": 0,             // 统计开放时间
-            #   "C": 86400000,      // 统计关闭时间
-            #   "F": 0,             // 第一个交易ID
-            #   "L": 18150,         // 最后交易 ID
-            #   "n": 18151          // 交易总数
-            # }
-            symbol = tokens[0]
-            self.queue.put((symbol, timestamp, raw_message))
-        elif tokens[1] == 'depth20':
-            # {
-            #   "lastUpdateId": 160,  // 末次更新ID
-            #   "bids": [             // 买单
-            #     [
-            #       "0.0024",         // 价
-            #       "10",             // 量
-            #       []                // 忽略
-            #     ]
-            #   ],
-            #   "asks": [             // 卖单
-            #     [
-            #       "0.0026",         // 价
-            #       "100",            // 量
-            #       []                // 忽略
-            #     ]
-            #   ]
-            # }
-            symbol = tokens[0]
+        data = message['data']
+        # 从数据中获取更新 ID u 和首个更新 ID U
+        u = data['u']
+        U = data['U']
+        # 检查 prev_u（前一个更新 ID），如果是第一次接收或者 U 不是紧接在 prev_u 之后
+        prev_u = self.prev_u.get(symbol)
+        if prev_u is None or U != prev_u + 1:
+            # 获取 pending_messages（待处理的消息队列），如果为空，记录警告日志并异步获取市场深度快照，初始化 pending_messages
+            pending_messages = self.pending_messages.get(symbol)
+            if pending_messages is None:
+                logging.warning('Mismatch on the book. prev_update_id=%s, U=%s' % (prev_u, U))
+                asyncio.create_task(self.__get_marketdepth_snapshot(symbol))
+                self.pending_messages[symbol] = pending_messages = []
+            # 将当前消息添加到 pending_messages
+            pending_messages.append((message, raw_message))
+        else:
+            # 如果 U 是紧接在 prev_u 之后，将消息加入队列并更新 prev_u
             self.queue.put((symbol, timestamp, raw_message))
+            self.prev_u[symbol] = u
+            # 只记录已经同步的深度消息, 快照同步卡住时 watchdog 也能发现
+            self.last_seen[stream] = timestamp
+            if self.books is not None:
+                self.books[symbol].on_depth(data['b'], data['a'], data['E'], timestamp)
+
+    def __on_trade(self, symbol, stream, timestamp, raw_message):
+        # aggTrade（聚合交易）:
+        # {
+        #   "e": "aggTrade",      // 事件类型
+        #   "E": 1672515782136,   // 事件时间
+        #   "s": "BNBBTC",        // 交易对
+        #   "a": 12345,           // 归集交易ID
+        #   "p": "0.001",         // 成交价格
+        #   "q": "100",           // 成交数量
+        #   "f": 100,             // 被归集的首个交易ID
+        #   "l": 105,             // 被归集的末次交易ID
+        #   "T": 1672515782136,   // 成交时间
+        #   "m": true,            // 买方是否是做市方。如true，则此次成交是一个主动卖出单，否则是一个主动买入单。
+        #   "M": true             // 请忽略该字段
+        # }
+        # trade（交易）:
+        # {
+        #   "e": "trade",        // 事件类型
+        #   "E": 1672515782136,  // 事件时间
+        #   "s": "BNBBTC",       // 交易对
+        #   "t": 12345,          // 交易ID
+        #   "p": "0.001",        // 成交价格
+        #   "q": "100",          // 成交数量
+        #   "T": 1672515782136,  // 成交时间
+        #   "m": true,           // 买方是否是做市方。如true，则此次成交是一个主动卖出单，否则是一个主动买入单。
+        #   "M": true            // 请忽略该字段
+        # }
+        self.queue.put((symbol, timestamp, raw_message))
+        if self.books is not None:
+            data = json.loads(raw_message)['data']
+            self.books[symbol].on_trade(data['p'], data['q'], -1 if data['m'] else 1, data['T'])
+
+    def __on_raw(self, symbol, stream, timestamp, raw_message):
+        # bookTicker（最优挂单）, kline_1m（K线）, ticker_1h（滚动窗口统计）, depth20（有限档深度）等其他消息类型，
+        # 直接将消息加入队列 self.queue, 不解析 JSON, 开启 dedupe 时内容没有变化的推送不入队
+        # bookTicker（最优挂单信息）:
+        # {
+        #   "u":400900217,     // order book updateId
+        #   "s":"BNBUSDT",     // 交易对
+        #   "b":"25.35190000", // 买单最优挂单价格
+        #   "B":"31.21000000", // 买单最优挂单数量
+        #   "a":"25.36520000", // 卖单最优挂单价格
+        #   "A":"40.66000000"  // 卖单最优挂单数量
+        # }
+        # kline_1m（K线）:
+        # {
+        #   "e": "kline",          // 事件类型
+        #   "E": 1672515782136,    // 事件时间
+        #   "s": "BNBBTC",         // 交易对
+        #   "k": {
+        #     "t": 1672515780000,  // 这根K线的起始时间
+        #     "T": 1672515839999,  // 这根K线的结束时间
+        #     "s": "BNBBTC",       // 交易对
+        #     "i": "1m",           // K线间隔
+        #     "f": 100,            // 这根K线期间第一笔成交ID
+        #     "L": 200,            // 这根K线期间末一笔成交ID
+        #     "o": "0.0010",       // 这根K线期间第一笔成交价
+        #     "c": "0.0020",       // 这根K线期间末一笔成交价
+        #     "h": "0.0025",       // 这根K线期间最高成交价
+        #     "l": "0.0015",       // 这根K线期间最低成交价
+        #     "v": "1000",         // 这根K线期间成交量
+        #     "n": 100,            // 这根K线期间成交数量
+        #     "x": false,          // 这根K线是否完结（是否已经开始下一根K线）
+        #     "q": "1.0000",       // 这根K线期间成交额
+        #     "V": "500",          // 主动买入的成交量
+        #     "Q": "0.500",        // 主动买入的成交额
+        #     "B": "123456"        // 忽略此参数
+        #   }
+        # }
+        # ticker_1h（滚动窗口统计）:
+        # {
+        #   "e": "1hTicker",    // 事件类型
+        #   "E": 1672515782136, // 事件时间
+        #   "s": "BNBBTC",      // 交易对
+        #   "p": "0.0015",      // 价格变化
+        #   "P": "250.00",      // 价格变化百分比
+        #   "o": "0.0010",      // 开盘价
+        #   "h": "0.0025",      // 最高价
+        #   "l": "0.0010",      // 最低价
+        #   "c": "0.0025",      // 最后价格
+        #   "w": "0.0018",      // 加权平均价
+        #   "v": "10000",       // 基础资产总交易量
+        #   "q": "18",          // 报价资产总交易量
+        #   "O": 0,             // 统计开放时间
+        #   "C": 86400000,      // 统计关闭时间
+        #   "F": 0,             // 第一个交易ID
+        #   "L": 18150,         // 最后交易 ID
+        #   "n": 18151          // 交易总数
+        # }
+        # depth20（有限档深度）:
+        # {
+        #   "lastUpdateId": 160,  // 末次更新ID
+        #   "bids": [             // 买单
+        #     [
+        #       "0.0024",         // 价
+        #       "10",             // 量
+        #       []                // 忽略
+        #     ]
+        #   ],
+        #   "asks": [             // 卖单
+        #     [
+        #       "0.0026",         // 价
+        #       "100",            // 量
+        #       []                // 忽略
+        #     ]
+        #   ]
+        # }
+        self.last_seen[stream] = timestamp
+        if self.dedupe is not None and self.dedupe.duplicate(stream, timestamp, raw_message):
+            return
+        self.queue.put((symbol, timestamp, raw_message))
 
     async def __keep_alive(self):
         '''
@@ -189,7 +256,7 @@ class Binance:
                 logging.exception('Failed to keep alive.')
                 return
 
-    async def __curl(self, path, query=None, timeout=None, verb=None, rethrow_errors=None, max_retries=None):
+    async def __curl(self, path, query=None, timeout=None, verb=None, rethrow_errors=None, max_retries=None, raw=False):
         '''
         使用 aiohttp 完成 Binance API 调用请求
         调用请求时，如果返回状态码不是 200，则根据状态码进行不同的处理
@@ -227,7 +294,7 @@ class Binance:
             self.retries += 1
             if self.retries > max_retries:
                 raise Exception("Max retries on %s (%s) hit, raising." % (path, json.dumps(query or '')))
-            return self.__curl(path, query, timeout, verb, rethrow_errors, max_retries)
+            return self.__curl(path, query, timeout, verb, rethrow_errors, max_retries, raw)
 
         # Make the request
         try:
@@ -282,28 +349,139 @@ class Binance:
         # Reset retry counter on success
         self.retries = 0
 
+        if raw:
+            return await response.read()
         return await response.json()
 
+    def streams(self, symbol):
+        '''
+        返回一个交易对需要订阅的流（深度数据、交易数据和订单簿价格数据等），由 capture profile 决定。
+        '''
+        return [stream for stream, _ in self.profile.streams(symbol)]
+
+    async def __send_request(self, method, symbols):
+        '''
+        在当前连接上发送 SUBSCRIBE/UNSUBSCRIBE 请求。
+        '''
+        logging.info('%s %s' % (method, symbols))
+        await self.__send_streams(method, [stream for symbol in symbols for stream in self.streams(symbol)])
+
+    async def __send_streams(self, method, params):
+        self.request_id += 1
+        await self.ws.send_str(json.dumps({'method': method, 'params': params, 'id': self.request_id}))
+
+    def __reset_book(self, symbol):
+        '''
+        使进行中的快照任务失效, 下一条深度消息会重新获取快照。
+        '''
+        self.resync[symbol] = self.resync.get(symbol, 0) + 1
+        self.prev_u.pop(symbol, None)
+        self.pending_messages.pop(symbol, None)
+
+    def resync_books(self):
+        '''
+        重置所有交易对的订单簿同步状态, 下一条深度消息会重新获取快照。
+        writer 在磁盘压力为 CRITICAL 时丢弃了消息, 归档中的深度有缺口, 由 main.py 在压力解除后调用。
+        '''
+        for symbol in list(self.symbols):
+            self.__reset_book(symbol)
+
+    async def resubscribe(self, symbol, streams):
+        '''
+        在当前连接上重新订阅一个交易对的 streams (见 watchdog.py), 其他交易对不受影响。
+        包含深度时同时重置订单簿同步状态。
+        '''
+        if self.ws is None or symbol not in self.subscribed:
+            return False
+        if any(self.dispatch[stream][0] == self.__on_depth for stream in streams):
+            self.__reset_book(symbol)
+        logging.info('RESUBSCRIBE %s' % streams)
+        await self.__send_streams('UNSUBSCRIBE', streams)
+        await self.__send_streams('SUBSCRIBE', streams)
+        return True
+
+    async def subscribe(self, symbols):
+        '''
+        添加交易对。连接已建立时直接在该连接上订阅, 否则在下次连接时订阅。
+        已在采集的交易对保持不变, 订单簿和文件句柄不会重建。
+        与启动时相同, 先用 exchangeInfo 检查交易对, 不存在或不在交易状态的交易对不会订阅。返回实际添加的交易对。
+        '''
+        symbols = [symbol for symbol in symbols if symbol not in self.symbols]
+        if not symbols:
+            return []
+        symbols = await asyncio.get_running_loop().run_in_executor(None, check_symbols, self.exchange_info, symbols)
+        # 检查期间可能已经由其他调用添加
+        symbols = [symbol for symbol in symbols if symbol not in self.symbols]
+        if not symbols:
+            return []
+        self.symbols += symbols
+        for symbol in symbols:
+            self.dispatch.update(self.__dispatch_entries(symbol))
+        if self.books is not None:
+            for symbol in symbols:
+                self.books[symbol] = SharedBook(symbol, self.book_depth, self.book_prefix)
+        if self.ws is not None:
+            self.subscribed.update(symbols)
+            await self.__send_request('SUBSCRIBE', symbols)
+        return symbols
+
+    async def unsubscribe(self, symbols):
+        '''
+        移除交易对, 并清理其深度同步状态。
+        '''
+        symbols = [symbol for symbol in symbols if symbol in self.symbols]
+        if not symbols:
+            return
+        for symbol in symbols:
+            self.symbols.remove(symbol)
+            self.subscribed.discard(symbol)
+            self.prev_u.pop(symbol, None)
+            self.pending_messages.pop(symbol, None)
+            for stream in self.streams(symbol):
+                self.dispatch.pop(stream, None)
+                self.last_seen.pop(stream, None)
+                if self.dedupe is not None:
+                    self.dedupe.forget(stream)
+            if self.books is not None:
+                self.books.pop(symbol).close()
+        if self.ws is not None:
+            await self.__send_request('UNSUBSCRIBE', symbols)
+
     async def connect(self):
         '''
         异步建立与 Binance WebSocket 服务器的连接，订阅指定交易对的深度、交易和订单簿价格数据。
         在连接期间，方法处理接收到的各种类型的消息，并通过心跳信号保持连接活跃。
         包括异常处理和清理资源的机制，确保在发生错误或断开连接时能正确处理。
         '''
+        if not self.symbols_checked:
+            # 读取本地缓存, 缓存过期时才访问 REST, 放到线程池中避免阻塞事件循环
+            self.symbols_checked = True
+            await asyncio.get_running_loop().run_in_executor(None, check_symbols, self.exchange_info, self.symbols)
         try:
-            # 构建 stream 字符串，包含所有需要订阅的流（深度数据、交易数据和订单簿价格数据）。
-            stream = '/'.join(['%s@depth@1000ms/%s@aggTrade/%s@bookTicker/%s@kline_1m/%s@ticker_1h/%s@depth20@1000ms' % (symbol, symbol, symbol, symbol, symbol, symbol)
-                               for symbol in self.symbols])
+            symbols = list(self.symbols)
+            # 构建 stream 字符串，包含所有需要订阅的流。没有交易对时先建立空连接, 之后通过 SUBSCRIBE 订阅。
+            stream = '/'.join([stream for symbol in symbols for stream in self.streams(symbol)])
             # 构建 WebSocket URL url，格式为 wss://stream.binance.com:9443/stream?streams=%s。
-            url = 'wss://stream.binance.com:9443/stream?streams=%s' % stream
+            if stream:
+                url = 'wss://stream.binance.com:9443/stream?streams=%s' % stream
+            else:
+                url = 'wss://stream.binance.com:9443/stream'
             logging.info('Connecting to %s' % url)
             # 创建一个异步会话 session
             async with ClientSession() as session:
                 # 建立 WebSocket 连接，返回的 WebSocket 连接对象为 ws
                 async with session.ws_connect(url) as ws:
-                    logging.info('%s WS Connected.' % self.symbols)
+                    logging.info('%s WS Connected.' % symbols)
                     # 将 ws 赋值给实例变量 self.ws
                     self.ws = ws
+                    self.generation += 1
+                    self.subscribed = set(symbols)
+                    self.last_seen = {}
+                    # 连接期间新增的交易对
+                    missing = [symbol for symbol in self.symbols if symbol not in self.subscribed]
+                    if missing:
+                        self.subscribed.update(missing)
+                        await self.__send_request('SUBSCRIBE', missing)
                     # 创建一个异步任务 self.keep_alive 来保持连接的活跃，调用 self.__keep_alive() 方法。
                     self.keep_alive = asyncio.create_task(self.__keep_alive())
                     # 异步 for 循环 async for msg in ws 处理接收到的消息
@@ -332,6 +510,10 @@ class Binance:
                 await self.keep_alive
             self.ws = None
             self.keep_alive = None
+            self.subscribed = set()
+            # 重连后需要重新获取快照
+            self.prev_u = {}
+            self.pending_messages = {}
 
     async def close(self):
         '''
@@ -342,19 +524,45 @@ class Binance:
             await self.ws.close()
         if self.client:
             await self.client.close()
+        if self.books is not None:
+            for book in self.books.values():
+                book.close()
         await asyncio.sleep(1)
 
+    async def __last_update_id(self, raw):
+        '''
+        从快照响应中提取 lastUpdateId, 响应格式不符合预期时退回到在线程池中完整解析。
+        '''
+        match = LAST_UPDATE_ID.search(raw, 0, 256)
+        if match is not None:
+            return int(match.group(1))
+        data = await asyncio.get_running_loop().run_in_executor(None, json.loads, raw)
+        return data['lastUpdateId']
+
     async def __get_marketdepth_snapshot(self, symbol):
         '''
         异步获取市场深度的快照，并处理在此之前收到的未处理的深度更新消息。
         '''
+        generation = self.generation
+        resync = self.resync.get(symbol, 0)
         # 使用 /v3/depth 接口获取市场深度快照
-        data = await self.__curl(verb='GET', path='/v3/depth', query={'symbol': symbol.upper(), 'limit': 1000})
-        # 将获取到的市场深度数据放入队列 self.queue 中
-        logging.info('Get market depth snapshot. symbol=%s %s' % (symbol, json.dumps(data)))
-        self.queue.put((symbol, time.time(), json.dumps(data)))
+        raw = await self.__curl(verb='GET', path='/v3/depth', query={'symbol': symbol.upper(), 'limit': 1000}, raw=True)
         # 提取 lastUpdateId，这是市场深度数据的最新更新 ID
-        lastUpdateId = data['lastUpdateId']
+        lastUpdateId = await self.__last_update_id(raw)
+        if self.books is not None:
+            # 完整解析只在发布共享内存订单簿时需要, 放到线程池中执行
+            data = await asyncio.get_running_loop().run_in_executor(None, json.loads, raw)
+        # 所有 await 都在检查之前完成, 检查之后到修改状态之间不会切换到其他任务
+        if generation != self.generation or symbol not in self.subscribed or resync != self.resync.get(symbol, 0):
+            # 交易对已退订, 已重新订阅或连接已重建
+            return
+        logging.info('Get market depth snapshot. symbol=%s, last_update_id=%d, size=%d' % (symbol, lastUpdateId, len(raw)))
+        # 将响应原样放入队列 self.queue 中, 不做 json 解析和重新编码
+        timestamp = now()
+        self.queue.put((symbol, timestamp, raw.strip().decode()))
+        if self.books is not None:
+            # 现货快照不带事件时间
+            self.books[symbol].on_snapshot(data['bids'], data['asks'], 0, timestamp)
         # 初始化
         self.prev_u[symbol] = None
         # Process the pending messages.
@@ -363,7 +571,7 @@ class Binance:
         while prev_u is None:
             # 获取交易对的未处理消息 pending_messages。
             pending_messages = self.pending_messages.get(symbol)
-            timestamp = time.time()
+            timestamp = now()
             # 处理未处理的消息
             while pending_messages:
                 # 从 pending_messages 中弹出消息。
@@ -384,9 +592,15 @@ class Binance:
                 # 将消息放入队列 self.queue 中，并更新 self.prev_u[symbol] 和 prev_u。
                 self.queue.put((symbol, timestamp, raw_message))
                 self.prev_u[symbol] = prev_u = u
+                self.last_seen[message['stream']] = timestamp
+                if self.books is not None:
+                    self.books[symbol].on_depth(data['b'], data['a'], data['E'], timestamp)
             if prev_u is None:
                 # 如果在处理完 pending_messages 后 prev_u 仍为 None，等待 0.5 秒再重试。
                 await asyncio.sleep(0.5)
+                if generation != self.generation or symbol not in self.subscribed \
+                        or resync != self.resync.get(symbol, 0):
+                    return
         # 处理完所有未处理的消息后，将 self.pending_messages[symbol] 置为 None，表示该交易对的消息已经全部处理。
         self.pending_messages[symbol] = None
         logging.warning('The book is initialized. symbol=%s, prev_update_id=%d' % (symbol, prev_u))
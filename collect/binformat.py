@@ -0,0 +1,428 @@
+"""
+紧凑的二进制归档格式 (<symbol>_<date>.bin)。
+
+文件以 MAGIC 开头, 之后是一条条记录, 每条记录以 1 字节 tag 开头:
+    TAG_RESET   清空字典, 之后是绝对本地时间戳 (varint, 微秒)。writer 每次打开文件时写入一次。
+    TAG_DEF     字典项: varint 长度 + utf-8 字符串, 编号按出现顺序递增。stream 名称、字段名和短字符串都进入字典。
+    TAG_COMPACT 消息: zigzag varint 时间戳增量 + 值编码, 还原时使用 separators=(',', ':') (websocket 原始消息)
+    TAG_SPACED  同上, 还原时使用 json.dumps 默认分隔符 (REST 快照)
+    TAG_RAW     无法无损编码的消息: zigzag varint 时间戳增量 + varint 长度 + utf-8 原文
+
+十进制字符串 (价格/数量) 编码为 zigzag varint 整数 + 1 字节小数位数, 例如 "24670.90" -> (2467090, 2)。
+写入前会校验消息能否原样还原, 否则退回 TAG_RAW, 保证与原始 JSON 逐字节一致。
+追加写入已有的文件前, 先截掉末尾不完整的记录 (异常退出或磁盘写满时留下), 之后的记录才能正确解码。
+"""
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+
+MAGIC = b'BFR\x01'
+
+TAG_RESET = 0
+TAG_DEF = 1
+TAG_COMPACT = 2
+TAG_SPACED = 3
+TAG_RAW = 4
+
+T_NULL = 0
+T_FALSE = 1
+T_TRUE = 2
+T_INT = 3
+T_DECIMAL = 4
+T_SYMBOL = 5
+T_STR = 6
+T_LIST = 7
+T_DICT = 8
+T_FLOAT = 9
+T_LEVELS = 10
+
+MAX_SYMBOLS = 65536
+MAX_SYMBOL_LENGTH = 32
+
+DECIMAL = re.compile(r'-?(0|[1-9][0-9]*)(\.[0-9]+)?\Z')
+DOUBLE = struct.Struct('<d')
+
+
+def write_varint(buf, value):
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def zigzag(value):
+    return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+
+def unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def split_decimal(value):
+    """把十进制字符串拆成 (mantissa, scale), 不能无损还原时返回 None。"""
+    if len(value) > 40 or not DECIMAL.match(value):
+        return None
+    integer, _, fraction = value.partition('.')
+    mantissa = int(integer + fraction)
+    if mantissa == 0 and value[0] == '-':
+        return None
+    return mantissa, len(fraction)
+
+
+def format_decimal(mantissa, scale):
+    if scale == 0:
+        return str(mantissa)
+    digits = str(abs(mantissa)).rjust(scale + 1, '0')
+    return '%s%s.%s' % ('-' if mantissa < 0 else '', digits[:-scale], digits[-scale:])
+
+
+class Encoder:
+    """
+    把 (timestamp, message) 编码为二进制记录, 一个 Encoder 对应一个打开的文件。
+    """
+
+    def __init__(self):
+        self.symbols = {}
+        self.timestamp = 0
+
+    def reset(self, timestamp):
+        self.symbols = {}
+        self.timestamp = timestamp
+        buf = bytearray((TAG_RESET,))
+        write_varint(buf, timestamp)
+        return buf
+
+    def __symbol(self, value, out):
+        """返回字典编号, 新字符串的 TAG_DEF 记录写入 out。"""
+        symbol_id = self.symbols.get(value)
+        if symbol_id is None:
+            if len(self.symbols) >= MAX_SYMBOLS:
+                return None
+            symbol_id = self.symbols[value] = len(self.symbols)
+            data = value.encode()
+            out.append(TAG_DEF)
+            write_varint(out, len(data))
+            out += data
+        return symbol_id
+
+    def __value(self, value, buf, out):
+        if value is None:
+            buf.append(T_NULL)
+        elif value is True:
+            buf.append(T_TRUE)
+        elif value is False:
+            buf.append(T_FALSE)
+        elif isinstance(value, int):
+            buf.append(T_INT)
+            write_varint(buf, zigzag(value))
+        elif isinstance(value, float):
+            buf.append(T_FLOAT)
+            buf += DOUBLE.pack(value)
+        elif isinstance(value, str):
+            decimal = split_decimal(value)
+            if decimal is not None and decimal[1] < 256:
+                buf.append(T_DECIMAL)
+                write_varint(buf, zigzag(decimal[0]))
+                buf.append(decimal[1])
+                return
+            symbol_id = self.__symbol(value, out) if len(value) <= MAX_SYMBOL_LENGTH else None
+            if symbol_id is not None:
+                buf.append(T_SYMBOL)
+                write_varint(buf, symbol_id)
+            else:
+                data = value.encode()
+                buf.append(T_STR)
+                write_varint(buf, len(data))
+                buf += data
+        elif isinstance(value, list):
+            levels = self.__levels(value)
+            if levels is not None:
+                buf.append(T_LEVELS)
+                write_varint(buf, len(levels))
+                for price, price_scale, qty, qty_scale in levels:
+                    write_varint(buf, zigzag(price))
+                    buf.append(price_scale)
+                    write_varint(buf, zigzag(qty))
+                    buf.append(qty_scale)
+                return
+            buf.append(T_LIST)
+            write_varint(buf, len(value))
+            for item in value:
+                self.__value(item, buf, out)
+        elif isinstance(value, dict):
+            buf.append(T_DICT)
+            write_varint(buf, len(value))
+            for key, item in value.items():
+                symbol_id = self.__symbol(key, out)
+                if symbol_id is None:
+                    raise ValueError('too many symbols')
+                write_varint(buf, symbol_id)
+                self.__value(item, buf, out)
+        else:
+            raise ValueError('unsupported type %s' % type(value))
+
+    @staticmethod
+    def __levels(value):
+        """深度档位 [["price", "qty"], ...] 的快速路径。"""
+        if not value:
+            return None
+        levels = []
+        for level in value:
+            if type(level) is not list or len(level) != 2 or type(level[0]) is not str or type(level[1]) is not str:
+                return None
+            price = split_decimal(level[0])
+            qty = split_decimal(level[1])
+            if price is None or qty is None or price[1] > 255 or qty[1] > 255:
+                return None
+            levels.append((price[0], price[1], qty[0], qty[1]))
+        return levels
+
+    def encode(self, timestamp, message):
+        """
+        timestamp 为微秒整数, message 为原始 JSON 字符串, 返回要追加到文件的字节。
+        """
+        out = bytearray()
+        delta = zigzag(timestamp - self.timestamp)
+        self.timestamp = timestamp
+        try:
+            obj = json.loads(message)
+            if json.dumps(obj, separators=(',', ':'), ensure_ascii=False) == message:
+                tag = TAG_COMPACT
+            elif json.dumps(obj) == message:
+                tag = TAG_SPACED
+            else:
+                tag = None
+            if tag is not None:
+                buf = bytearray((tag,))
+                write_varint(buf, delta)
+                self.__value(obj, buf, out)
+                out += buf
+                return out
+        except ValueError:
+            pass
+        data = message.encode()
+        out.append(TAG_RAW)
+        write_varint(out, delta)
+        write_varint(out, len(data))
+        out += data
+        return out
+
+
+class Decoder:
+    """
+    逐条解码二进制记录, 不经过 JSON 解析。
+    decimals='str' 时十进制值还原为原始字符串, decimals='float' 时直接得到 float。
+    """
+
+    def __init__(self, data, decimals='str'):
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError('not a binary archive file.')
+        self.data = data
+        self.pos = len(MAGIC)
+        self.symbols = []
+        self.timestamp = 0
+        self.float_decimals = decimals == 'float'
+
+    def __varint(self):
+        data = self.data
+        pos = self.pos
+        b = data[pos]
+        pos += 1
+        value = b & 0x7f
+        shift = 7
+        while b & 0x80:
+            b = data[pos]
+            pos += 1
+            value |= (b & 0x7f) << shift
+            shift += 7
+        self.pos = pos
+        return value
+
+    def __decimal(self):
+        mantissa = unzigzag(self.__varint())
+        scale = self.data[self.pos]
+        self.pos += 1
+        if self.float_decimals:
+            return mantissa / 10 ** scale if scale else float(mantissa)
+        return format_decimal(mantissa, scale)
+
+    def __value(self):
+        t = self.data[self.pos]
+        self.pos += 1
+        if t == T_DECIMAL:
+            return self.__decimal()
+        elif t == T_SYMBOL:
+            return self.symbols[self.__varint()]
+        elif t == T_INT:
+            return unzigzag(self.__varint())
+        elif t == T_DICT:
+            n = self.__varint()
+            symbols = self.symbols
+            obj = {}
+            for _ in range(n):
+                key = symbols[self.__varint()]
+                obj[key] = self.__value()
+            return obj
+        elif t == T_LEVELS:
+            n = self.__varint()
+            decimal = self.__decimal
+            return [[decimal(), decimal()] for _ in range(n)]
+        elif t == T_LIST:
+            n = self.__varint()
+            return [self.__value() for _ in range(n)]
+        elif t == T_TRUE:
+            return True
+        elif t == T_FALSE:
+            return False
+        elif t == T_NULL:
+            return None
+        elif t == T_STR:
+            n = self.__varint()
+            if self.pos + n > len(self.data):
+                raise IndexError
+            value = self.data[self.pos:self.pos + n].decode()
+            self.pos += n
+            return value
+        elif t == T_FLOAT:
+            value = DOUBLE.unpack_from(self.data, self.pos)[0]
+            self.pos += 8
+            return value
+        raise ValueError('unknown value type %d at %d' % (t, self.pos - 1))
+
+    def __iter__(self):
+        """
+        产出 (local_timestamp, tag, value): tag 为 TAG_COMPACT/TAG_SPACED 时 value 是解码后的对象,
+        为 TAG_RAW 时 value 是原始 JSON 字符串。文件末尾不完整的记录会被忽略。
+        """
+        data = self.data
+        size = len(data)
+        while self.pos < size:
+            start = self.pos
+            try:
+                tag = data[self.pos]
+                self.pos += 1
+                if tag == TAG_DEF:
+                    n = self.__varint()
+                    if self.pos + n > size:
+                        raise IndexError
+                    self.symbols.append(data[self.pos:self.pos + n].decode())
+                    self.pos += n
+                elif tag == TAG_RESET:
+                    self.symbols = []
+                    self.timestamp = self.__varint()
+                elif tag == TAG_COMPACT or tag == TAG_SPACED:
+                    timestamp = self.timestamp + unzigzag(self.__varint())
+                    value = self.__value()
+                    self.timestamp = timestamp
+                    yield timestamp, tag, value
+                elif tag == TAG_RAW:
+                    timestamp = self.timestamp + unzigzag(self.__varint())
+                    n = self.__varint()
+                    if self.pos + n > size:
+                        raise IndexError
+                    value = data[self.pos:self.pos + n].decode()
+                    self.pos += n
+                    self.timestamp = timestamp
+                    yield timestamp, tag, value
+                else:
+                    raise ValueError('unknown record tag %d at %d' % (tag, start))
+            except IndexError:
+                # 写入中途的记录
+                self.pos = start
+                return
+
+
+def read_file(path, decimals='str'):
+    with open(path, 'rb') as f:
+        data = f.read()
+    return Decoder(data, decimals)
+
+
+def complete_length(path):
+    """文件中完整记录的总长度 (包括 MAGIC), 文件头不完整时为 0。"""
+    size = os.path.getsize(path)
+    if size < len(MAGIC):
+        with open(path, 'rb') as f:
+            if not MAGIC.startswith(f.read()):
+                raise ValueError('not a binary archive file: %s' % path)
+        return 0
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        decoder = Decoder(data)
+        end = decoder.pos
+        try:
+            for _ in decoder:
+                end = decoder.pos
+            # 末尾不完整的记录被忽略, pos 停在它的开头; 字典项和 TAG_RESET 不产出记录
+            end = decoder.pos
+        except (ValueError, UnicodeDecodeError) as e:
+            logging.error('Corrupted record in %s, truncating after the last complete record. %s' % (path, e))
+        return end
+
+
+def to_json(tag, value):
+    if tag == TAG_COMPACT:
+        return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+    elif tag == TAG_SPACED:
+        return json.dumps(value)
+    return value
+
+
+class BinaryFile:
+    """
+    以追加方式写入二进制归档文件, 接口与文本文件的写入保持一致。
+    """
+
+    def __init__(self, path, file=None):
+        """file 为以追加方式打开 path 得到的类文件对象 (如 diskio.AsyncFile), 默认直接打开 path。"""
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        if exists:
+            size = os.path.getsize(path)
+            length = complete_length(path)
+            if length < size:
+                logging.warning('Truncating an incomplete record at the end of %s. size=%d, length=%d'
+                                % (path, size, length))
+                os.truncate(path, length)
+                exists = length > 0
+        self.file = file if file is not None else open(path, 'ab')
+        if not exists:
+            self.file.write(MAGIC)
+        self.encoder = Encoder()
+        self.started = False
+
+    def write_record(self, timestamp, message):
+        self.write(int(timestamp * 1000000), message)
+
+    def write(self, timestamp, message):
+        """timestamp 为微秒整数。"""
+        if not self.started:
+            self.file.write(self.encoder.reset(timestamp))
+            self.started = True
+        self.file.write(self.encoder.encode(timestamp, message))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+if __name__ == '__main__':
+    # python3 collect/binformat.py encode src.dat dst.bin
+    # python3 collect/binformat.py decode src.bin dst.dat
+    command, src, dst = sys.argv[1:4]
+    if command == 'encode':
+        with open(src, 'r') as f_in:
+            out = BinaryFile(dst)
+            for line in f_in:
+                out.write(int(line[:16]), line[17:].rstrip('\n'))
+            out.close()
+    elif command == 'decode':
+        with open(dst, 'w') as f_out:
+            for timestamp, tag, value in read_file(src):
+                f_out.write('%d %s\n' % (timestamp, to_json(tag, value)))
+    else:
+        raise ValueError('unsupported command.')
@@ -0,0 +1,221 @@
+import struct
+import time
+from array import array
+from bisect import bisect_left
+from multiprocessing import resource_tracker, shared_memory
+
+SHM_PREFIX = 'book_'
+
+# seq, exch_timestamp, local_timestamp, bid_count, ask_count,
+# trade_price, trade_qty, trade_side, trade_timestamp
+HEADER = struct.Struct('<QqqIIddqq')
+# seq 之后的字段, 与档位一起在 seq 为奇数时写入
+FIELDS = struct.Struct('<qqIIddqq')
+SEQ = struct.Struct('<Q')
+
+
+class OrderBook:
+    """
+    基于 array 的紧凑订单簿, 价格升序存放, 最优买价在 bid 数组末尾, 最优卖价在 ask 数组开头。
+    """
+
+    __slots__ = ('bid_prices', 'bid_qtys', 'ask_prices', 'ask_qtys')
+
+    def __init__(self):
+        self.bid_prices = array('d')
+        self.bid_qtys = array('d')
+        self.ask_prices = array('d')
+        self.ask_qtys = array('d')
+
+    def clear(self):
+        del self.bid_prices[:]
+        del self.bid_qtys[:]
+        del self.ask_prices[:]
+        del self.ask_qtys[:]
+
+    def update(self, bids, asks):
+        set_level = self.__set
+        for level in bids:
+            set_level(self.bid_prices, self.bid_qtys, float(level[0]), float(level[1]))
+        for level in asks:
+            set_level(self.ask_prices, self.ask_qtys, float(level[0]), float(level[1]))
+
+    def snapshot(self, bids, asks):
+        self.clear()
+        # 快照中 bids 价格降序, asks 价格升序
+        for price, qty in reversed([(float(b[0]), float(b[1])) for b in bids]):
+            if qty != 0:
+                self.bid_prices.append(price)
+                self.bid_qtys.append(qty)
+        for price, qty in [(float(a[0]), float(a[1])) for a in asks]:
+            if qty != 0:
+                self.ask_prices.append(price)
+                self.ask_qtys.append(qty)
+
+    @staticmethod
+    def __set(prices, qtys, price, qty):
+        i = bisect_left(prices, price)
+        if i < len(prices) and prices[i] == price:
+            if qty == 0:
+                del prices[i]
+                del qtys[i]
+            else:
+                qtys[i] = qty
+        elif qty != 0:
+            prices.insert(i, price)
+            qtys.insert(i, qty)
+
+    def set_bid(self, price, qty):
+        self.__set(self.bid_prices, self.bid_qtys, price, qty)
+
+    def set_ask(self, price, qty):
+        self.__set(self.ask_prices, self.ask_qtys, price, qty)
+
+    def clear_bids_from(self, price):
+        """删除价格 >= price 的买单。"""
+        i = bisect_left(self.bid_prices, price)
+        del self.bid_prices[i:]
+        del self.bid_qtys[i:]
+
+    def clear_asks_upto(self, price):
+        """删除价格 <= price 的卖单。"""
+        i = bisect_left(self.ask_prices, price)
+        if i < len(self.ask_prices) and self.ask_prices[i] == price:
+            i += 1
+        del self.ask_prices[:i]
+        del self.ask_qtys[:i]
+
+    def top_bids(self, depth):
+        n = min(depth, len(self.bid_prices))
+        return [(self.bid_prices[-1 - i], self.bid_qtys[-1 - i]) for i in range(n)]
+
+    def top_asks(self, depth):
+        n = min(depth, len(self.ask_prices))
+        return [(self.ask_prices[i], self.ask_qtys[i]) for i in range(n)]
+
+
+def _shm_size(depth):
+    return HEADER.size + depth * 4 * 8
+
+
+class SharedBook:
+    """
+    维护一个交易对的订单簿, 并把前 N 档和最新成交发布到共享内存。
+    写入使用 seqlock: 写之前 seq 置为奇数, 写完置为偶数, 读者据此判断是否读到一致的数据。
+    """
+
+    def __init__(self, symbol, depth=20, prefix=SHM_PREFIX):
+        self.symbol = symbol
+        self.depth = depth
+        self.book = OrderBook()
+        self.seq = 0
+        self.exch_timestamp = 0
+        self.local_timestamp = 0
+        self.trade = (0.0, 0.0, 0, 0)
+        self.levels = struct.Struct('<%dd' % (depth * 2))
+        self.buffer = [0.0] * (depth * 2)
+        name = prefix + symbol
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=_shm_size(depth))
+        except FileExistsError:
+            # 上一次进程异常退出时遗留的共享内存
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=_shm_size(depth))
+        self.publish()
+
+    def on_snapshot(self, bids, asks, exch_timestamp, local_timestamp):
+        self.book.snapshot(bids, asks)
+        self.exch_timestamp = int(exch_timestamp)
+        self.local_timestamp = int(local_timestamp * 1000000)
+        self.publish()
+
+    def on_depth(self, bids, asks, exch_timestamp, local_timestamp):
+        self.book.update(bids, asks)
+        self.exch_timestamp = int(exch_timestamp)
+        self.local_timestamp = int(local_timestamp * 1000000)
+        self.publish()
+
+    def on_trade(self, price, qty, side, exch_timestamp):
+        self.trade = (float(price), float(qty), side, int(exch_timestamp))
+        self.publish()
+
+    def publish(self):
+        buf = self.shm.buf
+        book = self.book
+        depth = self.depth
+        levels = self.buffer
+        self.seq += 1
+        SEQ.pack_into(buf, 0, self.seq)
+
+        n_bid = min(depth, len(book.bid_prices))
+        n_ask = min(depth, len(book.ask_prices))
+        if n_bid:
+            levels[0:n_bid * 2:2] = book.bid_prices[:-n_bid - 1:-1]
+            levels[1:n_bid * 2:2] = book.bid_qtys[:-n_bid - 1:-1]
+        self.levels.pack_into(buf, HEADER.size, *levels)
+        if n_ask:
+            levels[0:n_ask * 2:2] = book.ask_prices[:n_ask]
+            levels[1:n_ask * 2:2] = book.ask_qtys[:n_ask]
+        self.levels.pack_into(buf, HEADER.size + self.levels.size, *levels)
+
+        price, qty, side, trade_timestamp = self.trade
+        FIELDS.pack_into(buf, SEQ.size, self.exch_timestamp, self.local_timestamp, n_bid, n_ask,
+                         price, qty, side, trade_timestamp)
+        # 偶数 seq 最后单独写入, 读者看到偶数 seq 时其余字段都已写完
+        self.seq += 1
+        SEQ.pack_into(buf, 0, self.seq)
+
+    def close(self):
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class BookReader:
+    """
+    从共享内存读取 SharedBook 发布的订单簿, 不做任何 JSON 解析。
+    """
+
+    def __init__(self, symbol, depth=20, prefix=SHM_PREFIX):
+        self.depth = depth
+        self.shm = shared_memory.SharedMemory(name=prefix + symbol)
+        # 读者不拥有这块共享内存, 避免进程退出时被 resource_tracker 删除
+        resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.levels = struct.Struct('<%dd' % (depth * 2))
+
+    def read(self, retries=1000):
+        """
+        返回 (exch_timestamp, local_timestamp, bids, asks, trade),
+        bids/asks 为 [(price, qty), ...], trade 为 (price, qty, side, exch_timestamp)。
+        """
+        buf = self.shm.buf
+        for _ in range(retries):
+            header = HEADER.unpack_from(buf, 0)
+            if header[0] & 1:
+                continue
+            bid_levels = self.levels.unpack_from(buf, HEADER.size)
+            ask_levels = self.levels.unpack_from(buf, HEADER.size + self.levels.size)
+            if SEQ.unpack_from(buf, 0)[0] != header[0]:
+                continue
+            _, exch_timestamp, local_timestamp, n_bid, n_ask, price, qty, side, trade_timestamp = header
+            bids = list(zip(bid_levels[0:n_bid * 2:2], bid_levels[1:n_bid * 2:2]))
+            asks = list(zip(ask_levels[0:n_ask * 2:2], ask_levels[1:n_ask * 2:2]))
+            return exch_timestamp, local_timestamp, bids, asks, (price, qty, side, trade_timestamp)
+        raise TimeoutError('book is being updated too frequently to get a consistent read.')
+
+    def wait(self, timeout=None, interval=0.0001):
+        """等待下一次更新后读取。"""
+        seq = SEQ.unpack_from(self.shm.buf, 0)[0]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while SEQ.unpack_from(self.shm.buf, 0)[0] == seq:
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            time.sleep(interval)
+        return self.read()
+
+    def close(self):
+        self.shm.close()
@@ -0,0 +1,23 @@
+"""
+采集器共用的本地时钟。
+以 time.monotonic() 为基准加上启动时相对 time.time() 的固定偏移, 系统时间被 NTP 跳变修改时本地时间戳仍然单调,
+同一台机器上的多个采集器 (包括子进程, 见 main.py) 使用同一个偏移, 不同交易所的记录可以直接按时间戳对齐。
+"""
+import time
+
+_offset = time.time() - time.monotonic()
+
+
+def now():
+    """当前本地时间 (秒, float), 与 time.time() 同一基准。"""
+    return time.monotonic() + _offset
+
+
+def offset():
+    return _offset
+
+
+def set_offset(value):
+    """子进程使用父进程的偏移, 保证所有进程的时间戳一致。"""
+    global _offset
+    _offset = value
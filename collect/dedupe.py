@@ -0,0 +1,61 @@
+"""
+丢弃与同一 stream 上一条内容相同的现货 kline/ticker/有限档深度消息, 减少队列, 磁盘和转换的开销。
+
+比较时去掉每次都会变化但不携带信息的字段, 剩余部分逐字节比较, 不做 JSON 解析:
+    kline_*     E (事件时间)
+    ticker*     E, O, C (事件时间和滚动窗口的起止时间, 由事件时间决定)
+    depth<N>*   lastUpdateId (更深的档位变化时也会变化)
+第一条消息和内容有变化的消息总会保留, 丢弃的只是重复的推送。内容不变时每 keyframe 秒也保留一条,
+这样每个日文件开头的 keyframe 秒内就有完整的状态, 两条记录的时间间隔也有上限。
+有限档深度也可以不订阅, 需要时从增量深度重建 (BOOK_DEPTH 或 converter.top_levels)。
+"""
+import logging
+import re
+
+REPORT_EVERY = 100000
+
+RULES = [
+    (re.compile(r'^kline_'), re.compile(r'"E":\d+')),
+    (re.compile(r'^ticker'), re.compile(r'"[EOC]":\d+')),
+    (re.compile(r'^depth\d+'), re.compile(r'"lastUpdateId":\d+')),
+]
+
+
+class Deduplicator:
+    def __init__(self, keyframe=60):
+        self.keyframe = keyframe
+        # stream 名称 -> 去掉可变字段的正则, None 表示不去重
+        self.patterns = {}
+        # stream 名称 -> (内容, 保留的时间)
+        self.last = {}
+        self.kept = 0
+        self.dropped = 0
+
+    def pattern(self, stream):
+        if stream not in self.patterns:
+            name = stream.split('@', 1)[1]
+            self.patterns[stream] = next((volatile for prefix, volatile in RULES if prefix.match(name)), None)
+        return self.patterns[stream]
+
+    def duplicate(self, stream, timestamp, raw_message):
+        volatile = self.pattern(stream)
+        if volatile is None:
+            return False
+        content = volatile.sub('', raw_message)
+        last = self.last.get(stream)
+        if last is not None and last[0] == content and timestamp - last[1] < self.keyframe:
+            self.dropped += 1
+            duplicate = True
+        else:
+            self.last[stream] = (content, timestamp)
+            self.kept += 1
+            duplicate = False
+        if (self.kept + self.dropped) % REPORT_EVERY == 0:
+            self.report()
+        return duplicate
+
+    def forget(self, stream):
+        self.last.pop(stream, None)
+
+    def report(self):
+        logging.info('Dedupe stats. kept=%d, dropped=%d' % (self.kept, self.dropped))
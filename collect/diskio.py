@@ -0,0 +1,191 @@
+"""
+writer 使用的非阻塞文件写入: 记录先追加到内存中的当前缓冲区, flush 时把整个缓冲区交给 I/O 线程池,
+由线程池用 os.writev 一次写入, writer 进程继续填充下一个缓冲区 (双缓冲)。
+同一个文件同时最多只有一个缓冲区在写入, 保证顺序; 写入跟不上时当前缓冲区继续累积,
+超过 max_buffer_size 才等待上一次写入完成 (反压)。
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+FSYNC_NONE = 'none'
+FSYNC_INTERVAL = 'interval'
+FSYNC_ROTATE = 'rotate'
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+
+
+class WriteStats:
+    """I/O 线程和 writer 共享的统计, 每次 report 后清零。"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buffered = 0
+        self.reset()
+
+    def reset(self):
+        self.writes = 0
+        self.bytes = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.fsyncs = 0
+        self.stalls = 0
+        self.max_buffered = self.buffered
+
+    def on_buffer(self, size):
+        with self.lock:
+            self.buffered += size
+            if self.buffered > self.max_buffered:
+                self.max_buffered = self.buffered
+
+    def on_write(self, size, latency):
+        with self.lock:
+            self.buffered -= size
+            self.writes += 1
+            self.bytes += size
+            self.latency += latency
+            if latency > self.max_latency:
+                self.max_latency = latency
+
+    def on_stall(self):
+        with self.lock:
+            self.stalls += 1
+
+    def on_fsync(self):
+        with self.lock:
+            self.fsyncs += 1
+
+    def on_discard(self, size):
+        with self.lock:
+            self.buffered -= size
+
+    def report(self):
+        with self.lock:
+            report = {
+                'writes': self.writes,
+                'bytes': self.bytes,
+                'avg_latency_ms': self.latency / self.writes * 1000 if self.writes else 0.0,
+                'max_latency_ms': self.max_latency * 1000,
+                'fsyncs': self.fsyncs,
+                'stalls': self.stalls,
+                'buffered': self.buffered,
+                'max_buffered': self.max_buffered,
+            }
+            self.reset()
+        return report
+
+
+class AsyncFile:
+    """
+    以追加方式打开的文件, 提供 write/flush/close, 实际写入在 I/O 线程池中进行。
+    线程中的写入错误 (如 ENOSPC) 在下一次 flush/close 时抛出。
+    """
+
+    def __init__(self, path, pool, stats, buffer_size=1 << 20, max_buffer_size=64 << 20, fsync=FSYNC_NONE,
+                 fsync_interval=1.0):
+        if fsync not in (FSYNC_NONE, FSYNC_INTERVAL, FSYNC_ROTATE):
+            raise ValueError('unsupported fsync policy: %s' % fsync)
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.pool = pool
+        self.stats = stats
+        self.buffer_size = buffer_size
+        self.max_buffer_size = max_buffer_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.last_fsync = time.monotonic()
+        self.buffer = []
+        self.size = 0
+        self.pending = None
+        self.closed = False
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        pending = self.pending
+        if pending is not None:
+            if not pending.done():
+                if self.size < self.max_buffer_size:
+                    return
+                self.stats.on_stall()
+            # 等待上一次写入完成, 并抛出其中的错误
+            self.pending = None
+            pending.result()
+        self.pending = self.pool.submit(self.__write, self.__swap())
+
+    def close(self):
+        """把剩余数据和关闭操作交给线程池, 不等待完成。"""
+        self.closed = True
+        self.pending = self.pool.submit(self.__close, self.__swap(), self.pending)
+
+    def done(self):
+        """已经关闭, 并且线程池中的写入和关闭都已完成。"""
+        return self.closed and self.pending.done()
+
+    def wait(self):
+        """等待已提交的写入 (和关闭) 完成, 之后才能重新打开同一个文件。"""
+        if self.pending is not None:
+            try:
+                self.pending.result()
+            except OSError:
+                # 错误已经由 flush/close 报告
+                pass
+
+    def __swap(self):
+        buffer = self.buffer
+        self.stats.on_buffer(self.size)
+        self.buffer = []
+        self.size = 0
+        return buffer
+
+    def __write(self, buffer):
+        size = sum(len(data) for data in buffer)
+        start = time.perf_counter()
+        try:
+            while buffer:
+                chunk = buffer[:IOV_MAX]
+                written = os.writev(self.fd, chunk)
+                # 处理部分写入
+                for i, data in enumerate(chunk):
+                    if written < len(data):
+                        buffer = [data[written:]] + buffer[i + 1:]
+                        break
+                    written -= len(data)
+                else:
+                    buffer = buffer[len(chunk):]
+            if self.fsync == FSYNC_INTERVAL and time.monotonic() - self.last_fsync >= self.fsync_interval:
+                os.fsync(self.fd)
+                self.last_fsync = time.monotonic()
+                self.stats.on_fsync()
+        except OSError:
+            self.stats.on_discard(size)
+            raise
+        self.stats.on_write(size, time.perf_counter() - start)
+
+    def __close(self, buffer, pending):
+        # 关闭时没有调用方可以接收错误, 只记录日志
+        try:
+            if pending is not None:
+                pending.result()
+        except OSError as e:
+            logging.error('Failed to write before closing. %s' % e)
+        try:
+            if buffer:
+                self.__write(buffer)
+            if self.fsync != FSYNC_NONE:
+                os.fsync(self.fd)
+                self.stats.on_fsync()
+        except OSError as e:
+            logging.error('Failed to write on close. %s' % e)
+        finally:
+            os.close(self.fd)
+
+
+def create_pool(threads=2):
+    return ThreadPoolExecutor(max_workers=threads, thread_name_prefix='writer-io')
@@ -0,0 +1,135 @@
+import json
+import logging
+import os
+import time
+import urllib.request
+
+ENDPOINTS = {
+    'spot': 'https://api.binance.com/api/v3/exchangeInfo',
+    'fapi': 'https://fapi.binance.com/fapi/v1/exchangeInfo',
+    'dapi': 'https://dapi.binance.com/dapi/v1/exchangeInfo',
+}
+DEFAULT_CACHE_DIR = os.getenv('EXCHANGE_INFO_CACHE_DIR',
+                              os.path.join(os.path.expanduser('~'), '.cache', 'collect-binancefutures'))
+DEFAULT_TTL = float(os.getenv('EXCHANGE_INFO_TTL', '86400'))
+
+
+def decimal_places(value):
+    """tickSize/stepSize (如 "0.10000000") 的有效小数位数。"""
+    fraction = value.partition('.')[2].rstrip('0')
+    return len(fraction)
+
+
+class ExchangeInfo:
+    """
+    本地缓存的 exchangeInfo (spot/fapi/dapi)。
+    首次访问时才读取缓存文件; 缓存超过 ttl 秒时从 REST 刷新, 刷新失败则继续使用旧的缓存 (离线可用)。
+    指定 path 且不指定 market 时只读取该文件, 不会访问网络。
+    """
+
+    def __init__(self, market=None, cache_dir=DEFAULT_CACHE_DIR, ttl=DEFAULT_TTL, path=None):
+        if market is None and path is None:
+            raise ValueError('either market or path is required.')
+        if market is not None and market not in ENDPOINTS:
+            raise ValueError('unsupported market: %s' % market)
+        self.market = market
+        self.ttl = ttl
+        self.path = path if path is not None else os.path.join(cache_dir, '%s_exchangeInfo.json' % market)
+        self.__data = None
+        self.__symbols = None
+        self.__loaded_at = 0
+
+    def __fetch(self):
+        with urllib.request.urlopen(ENDPOINTS[self.market], timeout=10) as response:
+            raw = response.read()
+        data = json.loads(raw)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(raw)
+        os.replace(self.path + '.tmp', self.path)
+        logging.info('exchangeInfo is refreshed. market=%s, path=%s' % (self.market, self.path))
+        return data
+
+    def __read(self):
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def load(self):
+        """返回 exchangeInfo 原始数据, 需要时刷新缓存。"""
+        if self.__data is not None and (self.market is None or time.time() - self.__loaded_at < self.ttl):
+            return self.__data
+        data = None
+        expired = True
+        if os.path.exists(self.path):
+            expired = self.market is not None and time.time() - os.path.getmtime(self.path) >= self.ttl
+            if not expired or self.__data is None:
+                data = self.__read()
+        if expired:
+            try:
+                data = self.__fetch()
+            except Exception as e:
+                if data is None and self.__data is None:
+                    raise
+                logging.warning('Failed to refresh exchangeInfo, using the cached one. market=%s, %s' % (self.market, e))
+                data = data or self.__data
+        self.__data = data
+        self.__symbols = None
+        self.__loaded_at = time.time()
+        return data
+
+    def symbols(self):
+        """返回 {SYMBOL: symbol 信息} 字典。"""
+        data = self.load()
+        if self.__symbols is None:
+            self.__symbols = {item['symbol'].upper(): item for item in data['symbols']}
+        return self.__symbols
+
+    def symbol(self, symbol):
+        """
+        返回交易对的元数据: tick_size, step_size, price_scale, qty_scale, status, contract_type, contract_size。
+        """
+        item = self.symbols().get(symbol.upper())
+        if item is None:
+            raise KeyError('%s is not found in the %s exchangeInfo.' % (symbol, self.market or self.path))
+        filters = {flt['filterType']: flt for flt in item['filters']}
+        tick_size = filters['PRICE_FILTER']['tickSize']
+        step_size = filters['LOT_SIZE']['stepSize']
+        return {
+            'symbol': item['symbol'],
+            'status': item.get('status', item.get('contractStatus')),
+            'tick_size': tick_size,
+            'step_size': step_size,
+            'price_scale': decimal_places(tick_size),
+            'qty_scale': decimal_places(step_size),
+            'contract_type': item.get('contractType'),
+            'contract_size': item.get('contractSize'),
+        }
+
+    def scales(self, symbol):
+        info = self.symbol(symbol)
+        return info['price_scale'], info['qty_scale']
+
+
+def check_symbols(exchange_info, symbols):
+    """
+    检查采集的交易对是否存在并处于交易状态, 记录警告, 返回通过检查的交易对。
+    exchangeInfo 不可用时无法检查, 返回全部交易对。
+    """
+    try:
+        known = exchange_info.symbols()
+    except Exception as e:
+        logging.warning('exchangeInfo is not available. %s' % e)
+        return list(symbols)
+    valid = []
+    for symbol in symbols:
+        item = known.get(symbol.upper())
+        if item is None:
+            logging.warning('Unknown symbol. symbol=%s' % symbol)
+        elif item.get('status', item.get('contractStatus')) != 'TRADING':
+            logging.warning('Symbol is not trading. symbol=%s, status=%s'
+                            % (symbol, item.get('status', item.get('contractStatus'))))
+        else:
+            valid.append(symbol)
+    return valid
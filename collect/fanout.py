@@ -0,0 +1,224 @@
+import asyncio
+import logging
+import os
+from collections import deque
+
+from streams import stream_name
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+DISCONNECT = 'disconnect'
+
+
+def parse_address(address):
+    """
+    解析 unix:/path/to/sock 或 tcp:host:port 形式的地址。
+    """
+    scheme, _, rest = address.partition(':')
+    if scheme == 'unix':
+        return 'unix', rest
+    elif scheme == 'tcp':
+        host, _, port = rest.rpartition(':')
+        return 'tcp', (host or '127.0.0.1', int(port))
+    raise ValueError('unsupported fanout address: %s' % address)
+
+
+def message_stream(symbol, message):
+    """
+    原始消息用于匹配订阅的 stream 名称, 深度快照没有 stream 字段, 记为 <symbol>@snapshot。
+    多交易所采集时 symbol 带交易所前缀 (如 binance/btcusdt, 见 main.py), stream 名称也带上相同的前缀。
+    """
+    venue, _, bare = symbol.rpartition('/')
+    stream = stream_name(message)
+    if stream is None:
+        stream = bare + '@snapshot'
+    return venue + '/' + stream if venue else stream
+
+
+class Subscriber:
+    def __init__(self, writer, patterns, buffer_size, policy):
+        self.writer = writer
+        self.patterns = patterns
+        self.policy = policy
+        self.buffer = deque(maxlen=buffer_size if policy == DROP_OLDEST else None)
+        self.buffer_size = buffer_size
+        self.ready = asyncio.Event()
+        self.matches = {}
+        self.dropped = 0
+        self.sent = 0
+        self.closed = False
+
+    def match(self, stream):
+        matched = self.matches.get(stream)
+        if matched is None:
+            key = stream
+            venue, _, stream = stream.lower().rpartition('/')
+            symbol, _, name = stream.partition('@')
+            matched = False
+            for pattern in self.patterns:
+                pattern_venue, _, pattern = pattern.rpartition('/')
+                if pattern_venue and pattern_venue != venue:
+                    # binance/btcusdt@depth 只匹配该交易所, 不带前缀的订阅匹配所有交易所
+                    continue
+                if pattern == '*' or pattern == stream or pattern == symbol:
+                    matched = True
+                elif pattern.startswith('*@') and name.startswith(pattern[2:]):
+                    matched = True
+                elif '@' in pattern and stream.startswith(pattern + '@'):
+                    # btcusdt@depth 匹配 btcusdt@depth@0ms
+                    matched = True
+                elif name == 'snapshot':
+                    # 深度快照发送给订阅该交易对增量深度 (btcusdt@depth, btcusdt@depth@0ms, *@depth) 的订阅者
+                    pattern_symbol, _, pattern_name = pattern.partition('@')
+                    matched = pattern_symbol in ('*', symbol) and (pattern_name == 'depth'
+                                                                   or pattern_name.startswith('depth@'))
+                if matched:
+                    break
+            self.matches[key] = matched
+        return matched
+
+    def push(self, frame):
+        if len(self.buffer) >= self.buffer_size:
+            if self.policy == DROP_NEWEST:
+                self.dropped += 1
+                return True
+            elif self.policy == DISCONNECT:
+                return False
+            # DROP_OLDEST: deque(maxlen) 自动丢弃最旧的一条
+            self.dropped += 1
+        self.buffer.append(frame)
+        self.ready.set()
+        return True
+
+
+class FanoutServer:
+    """
+    把采集到的原始消息 (已带本地时间戳) 转发给本机的多个订阅者。
+    订阅者连接后发送一行以逗号分隔的订阅, 例如 btcusdt@depth,ethusdt@trade, btcusdt, *@bookTicker 或 *,
+    订阅增量深度时同时收到该交易对的深度快照。多交易所采集时可以用 binance/btcusdt@depth 只订阅一个交易所。
+    之后服务端按 .dat 文件相同的格式 "<timestamp> <message>\\n" 推送数据。
+    每个订阅者有独立的有界缓冲区, 慢消费者按 policy 丢弃数据或断开, 不会阻塞写入。
+    """
+
+    def __init__(self, address, buffer_size=10000, policy=DROP_OLDEST):
+        if policy not in (DROP_OLDEST, DROP_NEWEST, DISCONNECT):
+            raise ValueError('unsupported slow consumer policy: %s' % policy)
+        self.address = address
+        self.buffer_size = buffer_size
+        self.policy = policy
+        self.subscribers = set()
+        self.server = None
+
+    async def start(self):
+        kind, address = parse_address(self.address)
+        if kind == 'unix':
+            if os.path.exists(address):
+                os.unlink(address)
+            self.server = await asyncio.start_unix_server(self.__on_connect, path=address)
+        else:
+            self.server = await asyncio.start_server(self.__on_connect, host=address[0], port=address[1])
+        logging.info('Fanout server is listening on %s' % self.address)
+
+    async def close(self):
+        for subscriber in list(self.subscribers):
+            self.__remove(subscriber)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        kind, address = parse_address(self.address)
+        if kind == 'unix' and os.path.exists(address):
+            os.unlink(address)
+
+    def publish(self, symbol, timestamp, message):
+        if not self.subscribers:
+            return
+        stream = message_stream(symbol, message)
+        frame = None
+        for subscriber in list(self.subscribers):
+            if not subscriber.match(stream):
+                continue
+            if frame is None:
+                frame = ('%d %s\n' % (int(timestamp * 1000000), message)).encode()
+            if not subscriber.push(frame):
+                logging.warning('Disconnecting slow fanout subscriber. patterns=%s' % subscriber.patterns)
+                self.__remove(subscriber)
+
+    def stats(self):
+        return [{'patterns': subscriber.patterns,
+                 'buffered': len(subscriber.buffer),
+                 'sent': subscriber.sent,
+                 'dropped': subscriber.dropped} for subscriber in self.subscribers]
+
+    def __remove(self, subscriber):
+        subscriber.closed = True
+        subscriber.ready.set()
+        self.subscribers.discard(subscriber)
+
+    async def __on_connect(self, reader, writer):
+        try:
+            line = await reader.readline()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+            return
+        patterns = [pattern.strip().lower() for pattern in line.decode().split(',') if pattern.strip()]
+        if not patterns:
+            writer.close()
+            return
+        subscriber = Subscriber(writer, patterns, self.buffer_size, self.policy)
+        self.subscribers.add(subscriber)
+        logging.info('Fanout subscriber connected. patterns=%s' % patterns)
+        try:
+            while not subscriber.closed:
+                await subscriber.ready.wait()
+                subscriber.ready.clear()
+                buffer = subscriber.buffer
+                while buffer:
+                    frames = list(buffer)
+                    buffer.clear()
+                    writer.writelines(frames)
+                    subscriber.sent += len(frames)
+                    await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.__remove(subscriber)
+            writer.close()
+            logging.info('Fanout subscriber disconnected. patterns=%s, sent=%d, dropped=%d'
+                         % (patterns, subscriber.sent, subscriber.dropped))
+
+
+class FanoutQueue:
+    """
+    包装写入队列, put 的同时把消息转发给 FanoutServer, 采集器无需修改。
+    """
+
+    def __init__(self, queue, server):
+        self.queue = queue
+        self.server = server
+
+    def put(self, item):
+        self.queue.put(item)
+        self.server.publish(*item)
+
+
+async def subscribe(address, patterns):
+    """
+    订阅端辅助函数, 逐条产出 (local_timestamp, raw_message)。
+    """
+    kind, address = parse_address(address)
+    if kind == 'unix':
+        reader, writer = await asyncio.open_unix_connection(address)
+    else:
+        reader, writer = await asyncio.open_connection(address[0], address[1])
+    try:
+        writer.write((','.join(patterns) + '\n').encode())
+        await writer.drain()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            timestamp, _, message = line.partition(b' ')
+            yield int(timestamp), message[:-1].decode()
+    finally:
+        writer.close()
@@ -0,0 +1,181 @@
+"""
+采集输出目录的生命周期管理, 在独立进程中定期执行:
+    1. 压缩已经结束的日文件 <symbol>_<date>.dat -> <symbol>_<date>.dat.gz
+    2. (可选) 压缩后调用 convert/convert.py 转换, 通过 <output>/snapshots 快照存储自动衔接前一天的订单簿
+    3. 按交易对的保留天数删除过期的原始归档 (.dat, .dat.gz, .bin)
+    4. 监控磁盘剩余空间, 通过共享的 pressure 通知 writer 丢弃低优先级 stream 或暂停写入
+"""
+import asyncio
+import datetime
+import gzip
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+from snapstore import DEFAULT_DIRECTORY, SnapshotStore
+
+NORMAL = 0
+# 丢弃低优先级 stream (bookTicker, markPrice)
+SHED = 1
+# 暂停写入, 丢弃所有消息
+CRITICAL = 2
+
+ARCHIVE_FILE = re.compile(r'^(.+)_(\d{8})\.(dat|dat\.gz|bin)$')
+CONVERTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'convert', 'convert.py')
+
+
+async def resync_after_critical(pressure, collectors, interval=1.0):
+    """
+    在采集进程的事件循环中运行。CRITICAL 时 writer 丢弃了所有消息, 归档中的深度有无法修复的缺口,
+    压力解除后让 collectors() 返回的采集器重新获取快照, 转换时订单簿从新的快照开始恢复完整。
+    """
+    critical = False
+    while True:
+        await asyncio.sleep(interval)
+        if pressure.value == CRITICAL:
+            critical = True
+        elif critical:
+            critical = False
+            logging.warning('Disk pressure is no longer critical, resyncing the books.')
+            for collector in collectors():
+                collector.resync_books()
+
+
+def parse_retention(value):
+    """
+    '7,btcusdt:30,ethusdt:0' -> (7, {'btcusdt': 30, 'ethusdt': 0}), 0 或未设置表示永久保留。
+    """
+    default = 0
+    per_symbol = {}
+    for item in filter(None, (item.strip() for item in (value or '').split(','))):
+        symbol, _, days = item.rpartition(':')
+        if symbol:
+            per_symbol[symbol.lower()] = int(days)
+        else:
+            default = int(days)
+    return default, per_symbol
+
+
+class LifecycleManager:
+    def __init__(self, output, pressure, retention=None, convert=False, shed_free=0.10, critical_free=0.03,
+                 interval=10, housekeeping_interval=600, grace=600):
+        self.output = output
+        self.pressure = pressure
+        self.default_retention, self.retention = parse_retention(retention)
+        self.convert = convert
+        self.shed_free = shed_free
+        self.critical_free = critical_free
+        self.interval = interval
+        self.housekeeping_interval = housekeeping_interval
+        # writer 可能因为迟到的数据重新打开前一天的文件, 最后修改超过 grace 秒才视为已结束
+        self.grace = grace
+        self.last_housekeeping = 0
+
+    def archives(self):
+        """产出 (path, symbol, date, ext), 包括多交易所采集时的 <output>/<exchange>/ 子目录。"""
+        for directory, _, filenames in os.walk(self.output):
+            for filename in sorted(filenames):
+                match = ARCHIVE_FILE.match(filename)
+                if match is not None:
+                    yield (os.path.join(directory, filename),) + match.groups()
+
+    def check_disk(self):
+        usage = shutil.disk_usage(self.output)
+        free = usage.free / usage.total
+        if free < self.critical_free:
+            level = CRITICAL
+        elif free < self.shed_free:
+            level = SHED
+        else:
+            level = NORMAL
+        if level != self.pressure.value:
+            logging.warning('Disk pressure level is changed. level=%d, free=%.2f%%, path=%s'
+                            % (level, free * 100, self.output))
+            self.pressure.value = level
+        return level
+
+    def compress(self, path):
+        dst = path + '.gz'
+        tmp = dst + '.tmp'
+        # 已经存在 .gz 时 (迟到的数据) 追加为新的 gzip member, gzip 读取时会按顺序拼接。
+        # 先在临时文件中拼接再整体替换, 中断时 .gz 和 .dat 都保持原样, 下次重新压缩不会重复数据
+        append = os.path.exists(dst)
+        if append:
+            shutil.copyfile(dst, tmp)
+        with open(path, 'rb') as src, gzip.open(tmp, 'ab' if append else 'wb') as f:
+            shutil.copyfileobj(src, f, 1024 * 1024)
+        os.replace(tmp, dst)
+        os.remove(path)
+        logging.info('Archive is compressed. path=%s' % dst)
+        return dst
+
+    def run_converter(self, path, symbol, date):
+        prev_date = (datetime.datetime.strptime(date, '%Y%m%d') - datetime.timedelta(days=1)).strftime('%Y%m%d')
+        directory = os.path.dirname(path)
+        store = os.path.join(self.output, DEFAULT_DIRECTORY)
+        args = [sys.executable, CONVERTER, '-i', path, '-o', directory, '--snapshot-store', store]
+        # 多交易所采集时子目录名为交易所名称
+        exchange = os.path.relpath(directory, self.output)
+        if exchange != '.':
+            args += ['--exchange', exchange]
+        else:
+            exchange = None
+        snapshot = os.path.join(directory, '%s_%s.snapshot.pkl' % (symbol, prev_date))
+        # 快照存储中还没有这个交易对时 (升级前转换的数据) 使用前一天的 .snapshot.pkl
+        if os.path.exists(snapshot) and not len(SnapshotStore(store).index(exchange, symbol)):
+            args += ['-s', snapshot]
+        # 转换占用大量 CPU, 降低优先级以免影响采集
+        result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                preexec_fn=lambda: os.nice(10))
+        if result.returncode != 0:
+            logging.error('Failed to convert. path=%s, %s' % (path, result.stdout.decode(errors='replace')[-1000:]))
+        else:
+            logging.info('Archive is converted. path=%s' % path)
+
+    def housekeeping(self):
+        today = datetime.datetime.now().strftime('%Y%m%d')
+        now = time.time()
+        for path, symbol, date, ext in list(self.archives()):
+            days = self.retention.get(symbol.lower(), self.default_retention)
+            if days > 0:
+                expires = (datetime.datetime.strptime(date, '%Y%m%d') + datetime.timedelta(days=days)).strftime('%Y%m%d')
+                if expires <= today:
+                    os.remove(path)
+                    logging.info('Archive is expired. path=%s, retention=%d' % (path, days))
+                    continue
+            if ext != 'dat' or date >= today or now - os.path.getmtime(path) < self.grace:
+                continue
+            path = self.compress(path)
+            if self.convert and not os.path.exists(os.path.join(os.path.dirname(path), '%s_%s.pkl' % (symbol, date))):
+                self.run_converter(path, symbol, date)
+
+    def run(self):
+        while True:
+            try:
+                self.check_disk()
+                if time.time() - self.last_housekeeping >= self.housekeeping_interval:
+                    self.last_housekeeping = time.time()
+                    self.housekeeping()
+            except Exception as e:
+                logging.error('Lifecycle error. %s' % e)
+            time.sleep(self.interval)
+
+
+def lifecycle_proc(output, pressure, **kwargs):
+    LifecycleManager(output, pressure, **kwargs).run()
+
+
+def from_env():
+    """根据环境变量生成 lifecycle_proc 的参数, LIFECYCLE 未开启时返回 None。"""
+    if os.getenv('LIFECYCLE', '0') in ('0', ''):
+        return None
+    return {
+        'retention': os.getenv('LIFECYCLE_RETENTION'),
+        'convert': os.getenv('LIFECYCLE_CONVERT', '0') not in ('0', ''),
+        'shed_free': float(os.getenv('DISK_SHED_FREE', '0.10')),
+        'critical_free': float(os.getenv('DISK_CRITICAL_FREE', '0.03')),
+    }
@@ -1,52 +1,217 @@
 import asyncio
-import datetime
 import logging
 import os
 import signal
 import sys
-from multiprocessing import Process, Queue
+from multiprocessing import Process, RawValue
 
+import clock
 from binancefutures import BinanceFutures
 from binancefuturescoin import BinanceFuturesCoin
 from binancespot import Binance
+from fanout import FanoutQueue, FanoutServer
+from lifecycle import NORMAL, from_env, lifecycle_proc, resync_after_critical
+from profiles import load_profile
+from profiling import GcMonitor, LoopLagMonitor, Profiler, install, tune_gc
+from snapstore import DEFAULT_DIRECTORY, SnapshotStore
+from spillqueue import SpillQueue, flush_segments
+from watchdog import Watchdog
+from writer import writer_options, writer_proc
 
-queue = Queue()
+EXCHANGES = {
+    'binancefutures': BinanceFutures,
+    'binance': Binance,
+    'binancefuturescoin': BinanceFuturesCoin,
+}
 
-if sys.argv[1] == 'binancefutures':
-    stream = BinanceFutures(queue, sys.argv[2].split(','))
-elif sys.argv[1] == 'binance':
-    stream = Binance(queue, sys.argv[2].split(','))
-elif sys.argv[1] == 'binancefuturescoin':
-    stream = BinanceFuturesCoin(queue, sys.argv[2].split(','))
-else:
-    raise ValueError('unsupported exchange.')
 
+def parse_venues(exchanges, symbols):
+    """
+    'binance+binancefutures' 'btcusdt,ethusdt' -> 两个交易所采集相同的交易对,
+    'binance+binancefutures' 'btcusdt+btcusdt,ethusdt' -> 按顺序分别指定交易对。
+    """
+    exchanges = exchanges.split('+')
+    symbol_lists = symbols.split('+')
+    if len(symbol_lists) == 1:
+        symbol_lists = symbol_lists * len(exchanges)
+    if len(symbol_lists) != len(exchanges):
+        raise ValueError('the number of symbol lists does not match the number of exchanges.')
+    for exchange in exchanges:
+        if exchange not in EXCHANGES:
+            raise ValueError('unsupported exchange.')
+    if len(set(exchanges)) != len(exchanges):
+        raise ValueError('duplicate exchange.')
+    return [(exchange, symbol_list.split(',')) for exchange, symbol_list in zip(exchanges, symbol_lists)]
 
-def writer_proc(queue, output):
-    while True:
-        data = queue.get()
-        if data is None:
-            break
-        symbol, timestamp, message = data
-        date = datetime.datetime.fromtimestamp(timestamp).strftime('%Y%m%d')
-        with open(os.path.join(output, '%s_%s.dat' % (symbol, date)), 'a') as f:
-            f.write(str(int(timestamp * 1000000)))
-            f.write(' ')
-            f.write(message)
-            f.write('\n')
+
+class VenueQueue:
+    """
+    同时采集多个交易所时, 在 symbol 前加上 <exchange>/, writer 把数据写入 <output>/<exchange>/<symbol>_<date>.dat。
+    """
+
+    def __init__(self, queue, venue):
+        self.queue = queue
+        self.prefix = venue + '/'
+
+    def put(self, item):
+        symbol, timestamp, message = item
+        self.queue.put((self.prefix + symbol, timestamp, message))
+
+
+def warm_start(collector, exchange):
+    """
+    用快照存储中最近的订单簿预先发布共享内存订单簿, 时间戳为快照的时间, 读者可以据此判断是否已经同步。
+    """
+    store = SnapshotStore(os.path.join(sys.argv[3], DEFAULT_DIRECTORY))
+    for symbol, book in collector.books.items():
+        snapshot = store.get(exchange, symbol)
+        if snapshot is not None:
+            bids, asks = snapshot.levels()
+            book.on_snapshot(bids, asks, snapshot.exch_timestamp // 1000, snapshot.local_timestamp / 1000000)
+            logging.info('The book is warm-started. symbol=%s, local_timestamp=%d' % (symbol, snapshot.local_timestamp))
+
+
+def create_collector(exchange, symbols, queue, multi_venue):
+    if multi_venue:
+        queue = VenueQueue(queue, exchange)
+    # 共享内存订单簿的名称为 <exchange>_<symbol>
+    kwargs = {}
+    if exchange == 'binance':
+        kwargs['dedupe'] = spot_dedupe
+    collector = EXCHANGES[exchange](queue, symbols, book_depth=book_depth, book_prefix='%s_' % exchange,
+                                    profile=profile, **kwargs)
+    if book_warm_start and collector.books is not None:
+        # 转换时保存的快照在多交易所采集时以子目录名 (交易所名称) 为键
+        warm_start(collector, exchange if multi_venue else None)
+    return collector
+
+
+async def keep_connected(collector, name):
+    watchdog = None
+    if watchdog_timeout > 0:
+        # 只重新订阅静默的交易对, 不断开连接
+        watchdog = asyncio.create_task(Watchdog(collector, name, min_timeout=watchdog_timeout).run())
+    while not collector.closed:
+        await collector.connect()
+        await asyncio.sleep(1)
+    if watchdog is not None:
+        watchdog.cancel()
+
+
+def venue_proc(exchange, symbols, queue, clock_offset, pressure):
+    """COLLECT_PROCESSES=1 时每个交易所在独立进程的事件循环中运行, 与主进程共用 writer 和时钟。"""
+    clock.set_offset(clock_offset)
+
+    async def run():
+        collector = create_collector(exchange, symbols, queue, True)
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(collector.close()))
+        loop.add_signal_handler(signal.SIGINT, lambda: asyncio.create_task(collector.close()))
+        install(Profiler('collect_%s' % exchange), loop)
+        lag_monitor = asyncio.create_task(LoopLagMonitor(exchange, threshold=lag_threshold).run())
+        gc_monitor = asyncio.create_task(GcMonitor(exchange, lambda: collector.messages).run())
+        resync = asyncio.create_task(resync_after_critical(pressure, lambda: [collector]))
+        spill_flush = asyncio.create_task(flush_segments(queue))
+        tune_gc(gc_threshold, gc_freeze)
+        await keep_connected(collector, exchange)
+        lag_monitor.cancel()
+        gc_monitor.cancel()
+        resync.cancel()
+        spill_flush.cancel()
+        # 交出本进程的溢出段
+        queue.flush()
+
+    asyncio.run(run())
+
+
+# 队列超过 QUEUE_HIGH_WATER 条 (0 表示不限制) 时溢出到 <output>/.spill, writer 追上后按顺序读回
+queue = SpillQueue(os.path.join(sys.argv[3], '.spill'), int(os.getenv('QUEUE_HIGH_WATER', '100000')))
+# FANOUT_ADDRESS 形如 unix:/tmp/collect.sock 或 tcp:127.0.0.1:9000, 设置后把收到的消息转发给本机订阅者
+fanout_address = os.getenv('FANOUT_ADDRESS')
+fanout = None
+stream_queue = queue
+if fanout_address:
+    fanout = FanoutServer(fanout_address,
+                          buffer_size=int(os.getenv('FANOUT_BUFFER_SIZE', '10000')),
+                          policy=os.getenv('FANOUT_POLICY', 'drop_oldest'))
+    stream_queue = FanoutQueue(queue, fanout)
+# BOOK_DEPTH > 0 时在共享内存中发布前 N 档订单簿, 名称为 <exchange>_<symbol>
+book_depth = int(os.getenv('BOOK_DEPTH', '0'))
+# BOOK_WARM_START=1 时在获取 REST 快照之前, 先发布 <output>/snapshots 中最近的订单簿
+book_warm_start = os.getenv('BOOK_WARM_START', '0') not in ('0', '')
+# 事件循环延迟超过 LOOP_LAG_THRESHOLD 秒时记录警告
+lag_threshold = float(os.getenv('LOOP_LAG_THRESHOLD', '0.1'))
+# WATCHDOG_TIMEOUT > 0 时检测静默的 stream (秒, 有推送周期的 stream 至少为周期的 10 倍), 见 watchdog.py
+watchdog_timeout = float(os.getenv('WATCHDOG_TIMEOUT', '0'))
+# GC_THRESHOLD=50000,20,20 时调整循环垃圾回收的阈值, GC_FREEZE=1 时在启动完成后冻结已有对象, 见 profiling.py
+gc_threshold = [int(value) for value in os.getenv('GC_THRESHOLD', '').split(',') if value]
+gc_freeze = os.getenv('GC_FREEZE', '0') not in ('0', '')
+# SPOT_DEDUPE=1 时现货采集器丢弃内容没有变化的 kline/ticker/有限档深度推送
+spot_dedupe = os.getenv('SPOT_DEDUPE', '0') not in ('0', '')
+# 可选的第 4 个参数为 capture profile (JSON/YAML), 按交易对选择订阅的 stream, 见 profiles.py
+profile = load_profile(sys.argv[4] if len(sys.argv) > 4 else None)
+
+# 第 1 个参数可以用 + 连接多个交易所, 所有交易所共用一个 writer 和同一个本地时钟 (见 clock.py)
+venues = parse_venues(sys.argv[1], sys.argv[2])
+multi_venue = len(venues) > 1
+# COLLECT_PROCESSES=1 时每个交易所使用独立的进程, 否则在同一个事件循环中运行
+use_processes = multi_venue and os.getenv('COLLECT_PROCESSES', '0') not in ('0', '')
+collectors = []
+venue_ps = []
 
 
 def shutdown():
-    asyncio.create_task(stream.close())
+    for collector in collectors:
+        asyncio.create_task(collector.close())
+    for venue_p in venue_ps:
+        venue_p.terminate()
 
 
 async def main():
     logging.basicConfig(level=logging.DEBUG)
-    writer_p = Process(target=writer_proc, args=(queue, sys.argv[3],))
+    # ARCHIVE_FORMAT=binary 时写入紧凑的二进制归档 (.bin)
+    # LIFECYCLE=1 时压缩/清理输出目录, 并在磁盘空间不足时让 writer 丢弃低优先级 stream
+    lifecycle = from_env()
+    pressure = RawValue('i', NORMAL)
+    writer_p = Process(target=writer_proc, args=(queue, sys.argv[3], os.getenv('ARCHIVE_FORMAT', 'text'), pressure),
+                       kwargs=writer_options())
     writer_p.start()
-    while not stream.closed:
-        await stream.connect()
-        await asyncio.sleep(1)
+    # SIGUSR1 切换主进程的 cProfile, 并转发给 writer 和各交易所进程
+    install(Profiler('collect'), asyncio.get_running_loop(),
+            lambda: [p.pid for p in [writer_p] + venue_ps if p.is_alive()])
+    lag_monitor = asyncio.create_task(LoopLagMonitor('collect', threshold=lag_threshold).run())
+    gc_monitor = asyncio.create_task(GcMonitor('collect', lambda: sum(c.messages for c in collectors)).run())
+    # 磁盘压力从 CRITICAL 恢复后重新获取快照, 修复 writer 丢弃消息造成的深度缺口
+    resync = asyncio.create_task(resync_after_critical(pressure, lambda: collectors))
+    # 采集器没有新消息时也定时交出溢出段
+    spill_flush = asyncio.create_task(flush_segments(queue))
+    if lifecycle is not None:
+        Process(target=lifecycle_proc, args=(sys.argv[3], pressure), kwargs=lifecycle, daemon=True).start()
+    if use_processes:
+        # FanoutServer 运行在主进程的事件循环中, 子进程无法使用
+        if fanout is not None:
+            logging.warning('Fanout is not supported with COLLECT_PROCESSES=1.')
+        for exchange, symbols in venues:
+            venue_p = Process(target=venue_proc, args=(exchange, symbols, queue, clock.offset(), pressure))
+            venue_p.start()
+            venue_ps.append(venue_p)
+        # shutdown 通过 terminate 通知子进程关闭, 这里只等待子进程退出
+        await asyncio.get_running_loop().run_in_executor(None, lambda: [venue_p.join() for venue_p in venue_ps])
+    else:
+        # aiohttp.ClientSession 需要在事件循环中创建
+        collectors.extend(create_collector(exchange, symbols, stream_queue, multi_venue)
+                          for exchange, symbols in venues)
+        if fanout is not None:
+            await fanout.start()
+        tune_gc(gc_threshold, gc_freeze)
+        await asyncio.gather(*[keep_connected(collector, exchange)
+                               for collector, (exchange, _) in zip(collectors, venues)])
+        if fanout is not None:
+            await fanout.close()
+    lag_monitor.cancel()
+    gc_monitor.cancel()
+    resync.cancel()
+    spill_flush.cancel()
     queue.put(None)
     writer_p.join()
 
@@ -0,0 +1,87 @@
+"""
+采集配置 (capture profile): 按交易对选择订阅的 stream。
+
+    {
+        "default": {"depth": "100ms", "trade": "aggTrade", "streams": ["bookTicker"]},
+        "symbols": {
+            "btcusdt": {"depth": "0ms", "trade": "trade", "streams": ["bookTicker", "markPrice@1s"]},
+            "ethusdt": {"depth": null}
+        }
+    }
+
+depth 为增量深度的推送间隔 (null 表示不订阅深度, 也不会获取快照), trade 为 "trade" 或 "aggTrade" (null 表示不订阅),
+streams 为其他原样写入的 stream (不含交易对前缀)。交易对配置覆盖 default, 未指定的项使用交易所的默认配置。
+文件为 JSON, 安装 pyyaml 后也可以使用 .yaml/.yml。
+"""
+import json
+import re
+
+DEPTH = 0
+TRADE = 1
+RAW = 2
+
+FUTURES_DEFAULT = {'depth': '0ms', 'trade': 'trade', 'streams': ['markPrice@1s', 'bookTicker']}
+SPOT_DEFAULT = {'depth': '1000ms', 'trade': 'aggTrade', 'streams': ['bookTicker', 'kline_1m', 'ticker_1h',
+                                                                    'depth20@1000ms']}
+
+DEPTH_SPEED = re.compile(r'^\d+ms$')
+KEYS = ('depth', 'trade', 'streams')
+
+
+def load_profile(path):
+    """读取配置文件, path 为 None 时返回 None (使用交易所的默认配置)。"""
+    if path is None:
+        return None
+    with open(path, 'r') as f:
+        if path.endswith(('.yaml', '.yml')):
+            # 可选依赖, 只有 YAML 配置需要
+            import yaml
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def _validate(settings, where):
+    for key in settings:
+        if key not in KEYS:
+            raise ValueError('unknown key in the capture profile: %s (%s)' % (key, where))
+    depth = settings.get('depth')
+    if depth is not None and not DEPTH_SPEED.match(depth):
+        raise ValueError('invalid depth speed: %s (%s)' % (depth, where))
+    trade = settings.get('trade')
+    if trade not in (None, 'trade', 'aggTrade'):
+        raise ValueError('trade must be trade or aggTrade: %s (%s)' % (trade, where))
+    for stream in settings.get('streams', []):
+        if '@' in stream and stream.split('@')[0] in ('depth', 'trade', 'aggTrade'):
+            raise ValueError('use depth/trade instead of streams for %s (%s)' % (stream, where))
+
+
+class CaptureProfile:
+    def __init__(self, config, default):
+        config = config or {}
+        self.default = dict(default)
+        self.default.update(config.get('default', {}))
+        _validate(self.default, 'default')
+        self.symbols = {}
+        for symbol, settings in config.get('symbols', {}).items():
+            _validate(settings, symbol)
+            self.symbols[symbol.lower()] = settings
+
+    def settings(self, symbol):
+        settings = self.symbols.get(symbol)
+        if settings is None:
+            return self.default
+        merged = dict(self.default)
+        merged.update(settings)
+        return merged
+
+    def streams(self, symbol):
+        """返回 [(stream 名称, DEPTH/TRADE/RAW)], 顺序为深度, 成交, 其他。"""
+        settings = self.settings(symbol)
+        streams = []
+        if settings.get('depth') is not None:
+            streams.append(('%s@depth@%s' % (symbol, settings['depth']), DEPTH))
+        if settings.get('trade') is not None:
+            streams.append(('%s@%s' % (symbol, settings['trade']), TRADE))
+        for stream in settings.get('streams', []):
+            streams.append(('%s@%s' % (symbol, stream), RAW))
+        return streams
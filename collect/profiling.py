@@ -0,0 +1,188 @@
+"""
+运行中按需性能分析, 不需要重启:
+
+    kill -USR1 <main.py 的 pid>  # 开始分析, 再发送一次结束并保存
+
+main.py 收到 SIGUSR1 时切换自身的 cProfile, 并转发给 writer 和各交易所进程。
+结果保存为 <PROFILE_DIR>/<name>_<pid>_<time>.prof, 可以用 python3 -m pstats 或 snakeviz 查看。
+只分析收到信号的进程的主线程, writer 的 I/O 线程池不在其中。
+
+LoopLagMonitor 定期测量事件循环的延迟 (计划唤醒时间与实际唤醒时间之差), 超过阈值时记录警告。
+GcMonitor 统计循环垃圾回收的次数和暂停时间, 以及每条消息新增的 GC 跟踪对象数 (dict, list, tuple 等容器)。
+tune_gc 在启动完成后冻结已有对象 (gc.freeze), 并可以调整回收阈值, 减少突发行情时的回收暂停。
+"""
+import asyncio
+import cProfile
+import gc
+import io
+import logging
+import os
+import pstats
+import signal
+import tempfile
+import time
+
+TOP_FUNCTIONS = 15
+
+
+class Profiler:
+    def __init__(self, name, directory=None):
+        self.name = name
+        self.directory = directory or os.getenv('PROFILE_DIR') or tempfile.gettempdir()
+        self.profile = None
+        self.started = 0
+
+    def toggle(self):
+        if self.profile is None:
+            self.start()
+        else:
+            self.stop()
+
+    def start(self):
+        self.profile = cProfile.Profile()
+        self.started = time.time()
+        self.profile.enable()
+        logging.warning('Profiling is started. name=%s, pid=%d' % (self.name, os.getpid()))
+
+    def stop(self):
+        profile = self.profile
+        profile.disable()
+        self.profile = None
+        path = os.path.join(self.directory, '%s_%d_%s.prof' % (self.name, os.getpid(),
+                                                              time.strftime('%Y%m%d_%H%M%S')))
+        profile.dump_stats(path)
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats('tottime').print_stats(TOP_FUNCTIONS)
+        logging.warning('Profiling is stopped. name=%s, elapsed=%.1fs, path=%s\n%s'
+                        % (self.name, time.time() - self.started, path, out.getvalue()))
+        return path
+
+
+def install(profiler, loop=None, forward=None):
+    """
+    SIGUSR1 切换 profiler。loop 不为 None 时通过事件循环处理信号,
+    forward 为返回需要转发的 pid 列表的函数。
+    """
+    def on_signal(*_):
+        profiler.toggle()
+        for pid in forward() if forward is not None else []:
+            try:
+                os.kill(pid, signal.SIGUSR1)
+            except ProcessLookupError:
+                pass
+
+    if loop is not None:
+        loop.add_signal_handler(signal.SIGUSR1, on_signal)
+    else:
+        signal.signal(signal.SIGUSR1, on_signal)
+
+
+class LoopLagMonitor:
+    """
+    每 interval 秒唤醒一次, 统计唤醒延迟, 每 report_interval 秒记录一次最大和平均延迟。
+    """
+
+    def __init__(self, name, interval=0.1, threshold=0.1, report_interval=60):
+        self.name = name
+        self.interval = interval
+        self.threshold = threshold
+        self.report_interval = report_interval
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow = 0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        next_report = loop.time() + self.report_interval
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            now = loop.time()
+            lag = max(now - expected, 0.0)
+            self.count += 1
+            self.total += lag
+            if lag > self.max:
+                self.max = lag
+            if lag > self.threshold:
+                self.slow += 1
+                logging.warning('Event loop is lagging. name=%s, lag=%.3fs' % (self.name, lag))
+            if now >= next_report:
+                next_report = now + self.report_interval
+                self.report()
+
+    def report(self):
+        logging.info('Event loop lag. name=%s, avg=%.3fms, max=%.3fms, slow=%d'
+                     % (self.name, self.total / max(self.count, 1) * 1000, self.max * 1000, self.slow))
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow = 0
+
+
+def tune_gc(threshold=None, freeze=False):
+    """
+    threshold 为 gc.set_threshold 的参数, 如 (50000, 20, 20)。freeze 为 True 时把启动阶段创建的对象
+    (模块, exchangeInfo, 分发表等) 移到永久代, 之后的回收不再扫描它们。
+    """
+    if threshold:
+        gc.set_threshold(*threshold)
+    if freeze:
+        gc.collect()
+        gc.freeze()
+    logging.info('GC is configured. threshold=%s, frozen=%d' % (gc.get_threshold(), gc.get_freeze_count()))
+
+
+class GcMonitor:
+    """
+    通过 gc.callbacks 记录每次回收的代和耗时, 每 report_interval 秒与 messages() (收到的消息总数) 一起记录一次。
+    分配数为第 0 代计数的增量 (GC 跟踪对象的分配减去释放), 不包括 str/bytes/float 等不被跟踪的对象。
+    """
+
+    def __init__(self, name, messages, report_interval=60):
+        self.name = name
+        self.messages = messages
+        self.report_interval = report_interval
+        self.collections = [0, 0, 0]
+        self.pause_total = 0.0
+        self.pause_max = 0.0
+        self.allocated = 0
+        self.started = 0.0
+        self.last_messages = 0
+
+    def on_gc(self, phase, info):
+        if phase == 'start':
+            # 回收前的第 0 代计数, 回收后清零
+            self.allocated += gc.get_count()[0]
+            self.started = time.perf_counter()
+        else:
+            pause = time.perf_counter() - self.started
+            self.collections[info['generation']] += 1
+            self.pause_total += pause
+            if pause > self.pause_max:
+                self.pause_max = pause
+
+    async def run(self):
+        gc.callbacks.append(self.on_gc)
+        self.last_messages = self.messages()
+        self.allocated = -gc.get_count()[0]
+        try:
+            while True:
+                await asyncio.sleep(self.report_interval)
+                self.report()
+        finally:
+            gc.callbacks.remove(self.on_gc)
+
+    def report(self):
+        messages = self.messages()
+        count = messages - self.last_messages
+        allocated = self.allocated + gc.get_count()[0]
+        logging.info('GC stats. name=%s, messages=%d, allocs_per_msg=%.1f, collections=%s, '
+                     'pause_total=%.3fms, pause_max=%.3fms'
+                     % (self.name, count, allocated / max(count, 1), self.collections,
+                        self.pause_total * 1000, self.pause_max * 1000))
+        self.last_messages = messages
+        self.allocated = -gc.get_count()[0]
+        self.collections = [0, 0, 0]
+        self.pause_total = 0.0
+        self.pause_max = 0.0
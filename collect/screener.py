@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import time
+
+import aiohttp
+import numpy as np
+
+BASE_URL = 'https://api.binance.com/api/v3'
+INTERVAL_MS = {'1m': 60000, '3m': 180000, '5m': 300000, '15m': 900000, '30m': 1800000, '1h': 3600000}
+# https://developers.binance.com/docs/binance-spot-api-docs/rest-api/market-data-endpoints
+KLINES_WEIGHT = 2
+TICKER_24HR_WEIGHT = 80
+
+
+class WeightLimiter:
+    """
+    按照响应头 X-MBX-USED-WEIGHT-1M 控制请求权重, 接近上限时等待到下一分钟。
+    """
+
+    def __init__(self, max_weight=1000, concurrency=10):
+        self.max_weight = max_weight
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.used_weight = 0
+        self.minute = int(time.time() // 60)
+
+    async def acquire(self, weight):
+        await self.semaphore.acquire()
+        while True:
+            minute = int(time.time() // 60)
+            if minute != self.minute:
+                self.minute = minute
+                self.used_weight = 0
+            if self.used_weight + weight <= self.max_weight:
+                self.used_weight += weight
+                return
+            to_sleep = (minute + 1) * 60 - time.time()
+            logging.warning('Request weight %d reaches the limit, sleeping %.1f seconds.' % (self.used_weight, to_sleep))
+            await asyncio.sleep(to_sleep)
+
+    def release(self, response=None):
+        if response is not None:
+            used_weight = response.headers.get('X-MBX-USED-WEIGHT-1M')
+            if used_weight is not None:
+                self.used_weight = max(self.used_weight, int(used_weight))
+        self.semaphore.release()
+
+
+class KlineScreener:
+    """
+    并发获取 K 线并筛选高振幅高交易额的交易对。
+    已完结的 K 线缓存在内存中, 之后每轮只请求新的 K 线; 振幅和交易额使用 numpy 向量化计算。
+    """
+
+    def __init__(self, interval='3m', limit=20, top=100, quote='USDT', max_weight=1000, concurrency=10, api_key=None):
+        self.interval = interval
+        self.interval_ms = INTERVAL_MS[interval]
+        self.limit = limit
+        self.top = top
+        self.quote = quote
+        self.limiter = WeightLimiter(max_weight, concurrency)
+        self.headers = {'X-MBX-APIKEY': api_key} if api_key else {}
+        # symbol -> (open_time, open, high, low, quote_volume) 的已完结 K 线, 每列最多 limit 条
+        self.cache = {}
+        self.session = None
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __get(self, path, params, weight):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(headers=self.headers)
+        await self.limiter.acquire(weight)
+        response = None
+        try:
+            response = await self.session.get(BASE_URL + path, params=params, timeout=aiohttp.ClientTimeout(total=10))
+            response.raise_for_status()
+            return await response.json()
+        finally:
+            self.limiter.release(response)
+
+    async def __update_klines(self, symbol, now):
+        cached = self.cache.get(symbol)
+        # 最近一根已完结 K 线的开盘时间
+        last_closed = (now // self.interval_ms - 1) * self.interval_ms
+        if cached is not None and len(cached[0]) and cached[0][-1] >= last_closed:
+            return
+        if cached is not None and len(cached[0]) and (last_closed - cached[0][-1]) / self.interval_ms >= self.limit:
+            # 缓存落后 limit 根以上 (如交易对重新进入前 top), startTime 会取到最早缺失的 K 线, 改为重新获取最近的 limit 根
+            cached = None
+        params = {'symbol': symbol, 'interval': self.interval, 'limit': self.limit}
+        if cached is not None and len(cached[0]):
+            params['startTime'] = int(cached[0][-1]) + self.interval_ms
+        else:
+            # 截止到最近一根已完结 K 线, 得到完整的 limit 根
+            params['endTime'] = int(last_closed) + self.interval_ms - 1
+        klines = await self.__get('/klines', params, KLINES_WEIGHT)
+        # 只缓存已完结的 K 线
+        klines = [kline for kline in klines if kline[6] < now]
+        if not klines:
+            return
+        new = np.array([(kline[0], kline[1], kline[2], kline[3], kline[7]) for kline in klines], dtype='f8').T
+        if cached is not None:
+            new = np.concatenate([np.vstack(cached), new], axis=1)
+        self.cache[symbol] = tuple(new[:, -self.limit:])
+
+    async def screen(self, min_volume, min_amplitude, max_amplitude=200):
+        """
+        返回满足条件的交易对 [{'symbol', 'volume', 'amplitude', 'high', 'low'}], 按振幅降序。
+        振幅 = (最高价 - 最低价) / 开盘价 * 100, 交易额为 quote 资产交易额, 统计最近 limit 根已完结 K 线。
+        """
+        tickers = await self.__get('/ticker/24hr', None, TICKER_24HR_WEIGHT)
+        tickers = [ticker for ticker in tickers if ticker['symbol'].endswith(self.quote)]
+        symbols = [ticker['symbol'] for ticker in
+                   sorted(tickers, key=lambda x: float(x['quoteVolume']), reverse=True)[:self.top]]
+        # 不再在前 top 中的交易对不需要继续缓存
+        for symbol in list(self.cache):
+            if symbol not in symbols:
+                del self.cache[symbol]
+
+        now = int(time.time() * 1000)
+        results = await asyncio.gather(*[self.__update_klines(symbol, now) for symbol in symbols],
+                                       return_exceptions=True)
+        for symbol, result in zip(symbols, results):
+            if isinstance(result, Exception):
+                logging.error('Failed to get klines. symbol=%s, %s' % (symbol, result))
+
+        # 跳过不足 limit 根 K 线的交易对
+        symbols = [symbol for symbol in symbols if symbol in self.cache and len(self.cache[symbol][0]) == self.limit]
+        if not symbols:
+            return []
+        klines = np.stack([np.vstack(self.cache[symbol]) for symbol in symbols])
+        open_price = klines[:, 1, 0]
+        high_price = klines[:, 2, :].max(axis=1)
+        low_price = klines[:, 3, :].min(axis=1)
+        volume = klines[:, 4, :].sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            amplitude = np.round((high_price - low_price) / open_price * 100, 2)
+        selected = (open_price > 0) & (volume > min_volume) & (amplitude > min_amplitude) & (amplitude < max_amplitude)
+        order = np.argsort(-amplitude[selected], kind='stable')
+        indices = np.flatnonzero(selected)[order]
+        return [{'symbol': symbols[i], 'volume': float(volume[i]), 'amplitude': float(amplitude[i]),
+                 'high': float(high_price[i]), 'low': float(low_price[i])} for i in indices]
@@ -0,0 +1,107 @@
+"""
+订单簿快照存储, 按 (exchange, symbol) 保存任意时刻的完整订单簿, 用于跨天衔接转换和采集器预热。
+
+    <root>/<exchange>/<symbol>.snap  快照记录, 只追加
+    <root>/<exchange>/<symbol>.idx   索引, 每个快照一项 (local_timestamp, exch_timestamp, offset)
+
+exchange 为 None 时文件直接位于 <root> 下 (单交易所采集)。时间戳为微秒。
+每条记录为 RECORD 头 + bid 价格, bid 数量, ask 价格, ask 数量四个数组, bid 价格降序, ask 价格升序。
+定点模式 (price_scale/qty_scale >= 0) 的数组为 int64 (单位 10^-scale), 浮点模式为 float64。
+先写记录再追加索引, 中断时只会留下没有索引的记录, 不影响读取。
+"""
+import os
+import struct
+
+import numpy as np
+
+# 默认位于采集输出目录下
+DEFAULT_DIRECTORY = 'snapshots'
+FLOAT = -1
+
+# exch_timestamp, local_timestamp, price_scale, qty_scale, bid_count, ask_count
+RECORD = struct.Struct('<qqbbxxII')
+INDEX_DTYPE = np.dtype([('local_timestamp', '<i8'), ('exch_timestamp', '<i8'), ('offset', '<i8')])
+
+
+class Snapshot:
+    __slots__ = ('exch_timestamp', 'local_timestamp', 'bid_prices', 'bid_qtys', 'ask_prices', 'ask_qtys',
+                 'price_scale', 'qty_scale')
+
+    def __init__(self, exch_timestamp, local_timestamp, bid_prices, bid_qtys, ask_prices, ask_qtys,
+                 price_scale=FLOAT, qty_scale=FLOAT):
+        self.exch_timestamp = exch_timestamp
+        self.local_timestamp = local_timestamp
+        self.bid_prices = bid_prices
+        self.bid_qtys = bid_qtys
+        self.ask_prices = ask_prices
+        self.ask_qtys = ask_qtys
+        self.price_scale = price_scale
+        self.qty_scale = qty_scale
+
+    @property
+    def fixed(self):
+        return self.price_scale != FLOAT
+
+    def levels(self):
+        """返回浮点数的 ([(price, qty), ...] bids, asks)。"""
+        def to_float(values, scale):
+            return values / 10 ** scale if scale != FLOAT else values
+        bids = zip(to_float(self.bid_prices, self.price_scale).tolist(), to_float(self.bid_qtys, self.qty_scale).tolist())
+        asks = zip(to_float(self.ask_prices, self.price_scale).tolist(), to_float(self.ask_qtys, self.qty_scale).tolist())
+        return list(bids), list(asks)
+
+
+class SnapshotStore:
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, exchange, symbol):
+        return os.path.join(self.root, exchange or '', symbol)
+
+    def put(self, exchange, symbol, snapshot):
+        path = self.path(exchange, symbol)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        dtype = '<i8' if snapshot.fixed else '<f8'
+        arrays = [np.ascontiguousarray(values, dtype=dtype) for values in
+                  (snapshot.bid_prices, snapshot.bid_qtys, snapshot.ask_prices, snapshot.ask_qtys)]
+        with open(path + '.snap', 'ab') as f:
+            offset = f.seek(0, os.SEEK_END)
+            f.write(RECORD.pack(snapshot.exch_timestamp, snapshot.local_timestamp, snapshot.price_scale,
+                                snapshot.qty_scale, len(arrays[0]), len(arrays[2])))
+            for values in arrays:
+                f.write(values.tobytes())
+        entry = np.array([(snapshot.local_timestamp, snapshot.exch_timestamp, offset)], dtype=INDEX_DTYPE)
+        with open(path + '.idx', 'ab') as f:
+            f.write(entry.tobytes())
+
+    def index(self, exchange, symbol):
+        filename = self.path(exchange, symbol) + '.idx'
+        if not os.path.exists(filename):
+            return np.empty(0, dtype=INDEX_DTYPE)
+        return np.fromfile(filename, dtype=INDEX_DTYPE)
+
+    def get(self, exchange, symbol, before=None):
+        """
+        返回 local_timestamp <= before 的最近一个快照, before 为 None 时返回最新的快照, 没有时返回 None。
+        同一时间戳有多个快照时返回最后写入的。
+        """
+        index = self.index(exchange, symbol)
+        if before is None:
+            i = len(index) - 1
+        else:
+            # 索引按写入顺序排列, 补写较早的日期时可能乱序
+            order = np.argsort(index['local_timestamp'], kind='stable')
+            j = np.searchsorted(index['local_timestamp'][order], before, side='right') - 1
+            i = order[j] if j >= 0 else -1
+        if i < 0:
+            return None
+        return self.read(exchange, symbol, int(index['offset'][i]))
+
+    def read(self, exchange, symbol, offset):
+        with open(self.path(exchange, symbol) + '.snap', 'rb') as f:
+            f.seek(offset)
+            exch_timestamp, local_timestamp, price_scale, qty_scale, n_bid, n_ask = RECORD.unpack(f.read(RECORD.size))
+            dtype = np.dtype('<f8' if price_scale == FLOAT else '<i8')
+            values = np.frombuffer(f.read((n_bid + n_ask) * 2 * dtype.itemsize), dtype=dtype)
+        return Snapshot(exch_timestamp, local_timestamp, values[:n_bid], values[n_bid:n_bid * 2],
+                        values[n_bid * 2:n_bid * 2 + n_ask], values[n_bid * 2 + n_ask:], price_scale, qty_scale)
@@ -0,0 +1,228 @@
+"""
+有上限的采集队列: 队列中的消息数超过 high_water 时, 生产者把后续消息追加到磁盘上的溢出段,
+writer 追上后按顺序读回, 采集进程的内存占用不会因为 writer 阻塞而无限增长。
+
+    <directory>/<run>_<pid>_<seq>.spill  每行一条 "<symbol> <timestamp> <message>"
+
+生产者处于溢出状态时所有消息都写入当前段, 段关闭 (超过 SEGMENT_SIZE, 打开超过 SEGMENT_AGE 秒,
+或队列降到 low_water 以下) 时向队列放入一个标记, writer 读到标记时才读取这个段,
+因此同一个生产者的消息顺序不变。生产者没有新消息时段由 flush_segments 在事件循环中定时关闭。
+溢出段只在生产者进程内打开, 多个采集进程各自写自己的段。
+写入溢出段失败 (如磁盘写满) 时交出已写入的部分, SPILL_RETRY 秒内消息直接放入内存队列。
+writer 启动时先读取上次异常退出遗留的溢出段 (run 与本次不同的段)。
+"""
+import asyncio
+import logging
+import os
+import time
+from multiprocessing import Queue, Value
+
+SPILL = '__spill__'
+SEGMENT_SIZE = 64 << 20
+SEGMENT_AGE = 1.0
+# 写入溢出段失败后暂停溢出的秒数
+SPILL_RETRY = 5.0
+SUFFIX = '.spill'
+
+
+class SpillQueue:
+    def __init__(self, directory, high_water=100000, low_water=None):
+        """high_water 为 0 时不溢出, 与 multiprocessing.Queue 相同。"""
+        self.queue = Queue()
+        # 队列中的条目数 (包括段标记) 和已写入溢出段但还没有读完的消息数
+        self.pending = Value('q', 0)
+        self.spilled = Value('q', 0)
+        self.directory = directory
+        self.high_water = high_water
+        self.low_water = high_water // 2 if low_water is None else low_water
+        # 区分本次运行和上次遗留的溢出段
+        self.run = '%d%06d' % (time.time(), os.getpid() % 1000000)
+        self.__reset()
+
+    def __getstate__(self):
+        # 文件对象只属于当前进程
+        return {key: value for key, value in self.__dict__.items() if not key.startswith('_SpillQueue__')}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__reset()
+
+    def __reset(self):
+        self.__pid = os.getpid()
+        # 生产者状态
+        self.__segment = None
+        self.__segment_path = None
+        self.__segment_count = 0
+        self.__segment_bytes = 0
+        self.__segment_opened = 0
+        self.__seq = 0
+        self.__spill_total = 0
+        self.__spill_paused_until = 0
+        # 消费者状态
+        self.__reading = None
+        self.__reading_path = None
+        self.__reading_count = 0
+        self.__recovered = []
+
+    def __put(self, item):
+        with self.pending.get_lock():
+            self.pending.value += 1
+        self.queue.put(item)
+
+    def put(self, item):
+        if self.__pid != os.getpid():
+            self.__reset()
+        if item is None:
+            # 结束标记, 先交出当前的溢出段
+            self.flush()
+            self.__put(None)
+            return
+        segment = self.__segment
+        if segment is not None and self.__segment_due():
+            self.__close_segment()
+            segment = None
+        if segment is None:
+            if not self.high_water or self.pending.value < self.high_water \
+                    or time.monotonic() < self.__spill_paused_until:
+                self.__put(item)
+                return
+            try:
+                segment = self.__open_segment()
+            except OSError as e:
+                self.__on_spill_error(e)
+                self.__put(item)
+                return
+        symbol, timestamp, message = item
+        data = ('%s %r %s\n' % (symbol, timestamp, message)).encode('utf-8')
+        try:
+            segment.write(data)
+        except OSError as e:
+            self.__on_spill_error(e)
+            self.__put(item)
+            return
+        self.__segment_bytes += len(data)
+        self.__segment_count += 1
+        with self.spilled.get_lock():
+            self.spilled.value += 1
+
+    def __segment_due(self):
+        return (self.pending.value < self.low_water or self.__segment_bytes >= SEGMENT_SIZE
+                or time.monotonic() - self.__segment_opened >= SEGMENT_AGE)
+
+    def __open_segment(self):
+        if self.__spill_total == 0:
+            logging.warning('Queue is over the high-water mark, spilling to disk. pending=%d, directory=%s'
+                            % (self.pending.value, self.directory))
+        os.makedirs(self.directory, exist_ok=True)
+        self.__seq += 1
+        self.__segment_path = os.path.join(self.directory, '%s_%d_%06d%s' % (self.run, self.__pid, self.__seq, SUFFIX))
+        self.__segment = open(self.__segment_path, 'ab', buffering=1 << 20)
+        self.__segment_count = 0
+        self.__segment_bytes = 0
+        self.__segment_opened = time.monotonic()
+        return self.__segment
+
+    def __close_segment(self):
+        segment = self.__segment
+        self.__segment = None
+        try:
+            segment.close()
+        except OSError as e:
+            self.__on_spill_error(e)
+        # 写入失败时也交出已写入的部分, 末尾不完整的行在读取时跳过
+        self.__spill_total += self.__segment_count
+        self.__put((SPILL, self.__segment_path, self.__segment_count))
+        if self.pending.value < self.low_water:
+            logging.warning('Queue is below the low-water mark, spilling is stopped. spilled=%d'
+                            % self.__spill_total)
+            self.__spill_total = 0
+
+    def __on_spill_error(self, e):
+        logging.error('Failed to write the spill segment, queueing in memory for %d seconds. directory=%s, %s'
+                      % (SPILL_RETRY, self.directory, e))
+        self.__spill_paused_until = time.monotonic() + SPILL_RETRY
+        if self.__segment is not None:
+            self.__close_segment()
+
+    def flush(self):
+        """交出当前的溢出段, 生产者退出前调用。"""
+        if self.__pid == os.getpid() and self.__segment is not None:
+            self.__close_segment()
+
+    def poll(self):
+        """关闭到期的溢出段, 生产者长时间没有新消息时, 已溢出的消息也不会一直留在段中。"""
+        if self.__pid == os.getpid() and self.__segment is not None and self.__segment_due():
+            self.__close_segment()
+
+    def recover(self):
+        """writer 启动时调用, 之后先读取遗留的溢出段。"""
+        if os.path.isdir(self.directory):
+            self.__recovered = sorted(os.path.join(self.directory, filename) for filename in os.listdir(self.directory)
+                                      if filename.endswith(SUFFIX) and not filename.startswith(self.run + '_'))
+            if self.__recovered:
+                logging.warning('Recovering spilled segments. segments=%d' % len(self.__recovered))
+
+    def __open_reading(self, path, count):
+        self.__reading_path = path
+        self.__reading_count = count
+        try:
+            self.__reading = open(path, 'rb', buffering=1 << 20)
+        except OSError as e:
+            # 段已被删除或无法读取, 跳过这个段, 不能让 writer 退出
+            logging.error('Failed to open the spill segment, skipping it. path=%s, %s' % (path, e))
+            self.__finish_reading()
+
+    def __finish_reading(self):
+        if self.__reading is not None:
+            self.__reading.close()
+            self.__reading = None
+            try:
+                os.remove(self.__reading_path)
+            except OSError as e:
+                logging.error('Failed to remove the spill segment. path=%s, %s' % (self.__reading_path, e))
+        with self.spilled.get_lock():
+            self.spilled.value -= self.__reading_count
+
+    def get(self, block=True, timeout=None):
+        while True:
+            if self.__reading is not None:
+                try:
+                    line = self.__reading.readline()
+                except OSError as e:
+                    logging.error('Failed to read the spill segment, skipping the rest of it. path=%s, %s'
+                                  % (self.__reading_path, e))
+                    line = b''
+                if line.endswith(b'\n'):
+                    # 逐行解码, 损坏的行只跳过这一行
+                    try:
+                        symbol, timestamp, message = line[:-1].decode('utf-8').split(' ', 2)
+                        return symbol, float(timestamp), message
+                    except ValueError as e:
+                        logging.error('Skipping a corrupted line in the spill segment. path=%s, %s'
+                                      % (self.__reading_path, e))
+                        continue
+                # 段读完 (异常退出时最后一行可能不完整)
+                self.__finish_reading()
+            if self.__recovered:
+                self.__open_reading(self.__recovered.pop(0), 0)
+                continue
+            item = self.queue.get(block, timeout)
+            with self.pending.get_lock():
+                self.pending.value -= 1
+            if item is not None and item[0] == SPILL:
+                self.__open_reading(item[1], item[2])
+                continue
+            return item
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        return self.pending.value
+
+
+async def flush_segments(queue, interval=SEGMENT_AGE):
+    """在生产者进程的事件循环中运行, 定时关闭到期的溢出段 (见 SpillQueue.poll)。"""
+    while True:
+        await asyncio.sleep(interval)
+        queue.poll()
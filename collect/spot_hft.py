@@ -1,14 +1,18 @@
 import asyncio
-import datetime
 import json
 import logging
 import os
-import time
-from multiprocessing import Process, Queue
-
-from binance import Client
+import signal
+from multiprocessing import Process, RawValue
 
 from binancespot import Binance
+from lifecycle import NORMAL, from_env, lifecycle_proc, resync_after_critical
+from profiles import load_profile
+from profiling import GcMonitor, LoopLagMonitor, Profiler, install, tune_gc
+from screener import KlineScreener
+from spillqueue import SpillQueue, flush_segments
+from watchdog import Watchdog
+from writer import writer_options, writer_proc
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [PID:%(process)d] - %(message)s')
 
@@ -49,131 +53,126 @@ amplitude_threshold = float(os.getenv('MIN_AMPLITUDE', '5'))
 logging.info(f'最低交易额阈值: {volume_threshold}, 最低振幅阈值: {amplitude_threshold}%')
 
 api_key, api_secret = load_api_credentials(key_file_path)
-client = Client(api_key, api_secret)
-queue = Queue()
-current_processes = {}
+# 筛选只用到公开行情接口, API key 仅用于请求头
+screener = KlineScreener(interval='3m', limit=20, top=100,
+                         api_key=api_key if api_key != 'your_api_key' else None)
+# 队列超过 QUEUE_HIGH_WATER 条 (0 表示不限制) 时溢出到磁盘, writer 追上后按顺序读回
+queue = SpillQueue(os.path.join(output_dir, '.spill'), int(os.getenv('QUEUE_HIGH_WATER', '100000')))
 
 
-def get_high_amplitude_high_volume_tickers(min_volume=15000000, min_amplitude=5):
+async def get_high_amplitude_high_volume_tickers(min_volume=15000000, min_amplitude=5):
     """
     获取最近 1 小时高振幅且高交易量的交易对
     """
     logging.info('开始获取交易对信息...')
-    tickers = client.get_ticker()
-    usdt_pairs = [ticker for ticker in tickers if ticker['symbol'].endswith('USDT')]
-    # 按照交易量排序后取前 100 条数据
-    usdt_pairs = sorted(usdt_pairs, key=lambda x: float(x['quoteVolume']), reverse=True)[:100]
-    # 筛选满足条件的币种并根据振幅降序排列
-    selected_symbols = {}
-    for ticker in usdt_pairs:
-        symbol = ticker['symbol']
-        try:
-            # 获取该币种在指定时间内的K线数据，间隔为1小时
-            klines = client.get_klines(symbol=symbol, interval=Client.KLINE_INTERVAL_3MINUTE, limit=20)
-            if klines:
-                # 跳过不足 20 条的数据
-                if len(klines) < 20:
-                    continue
-                # 计算交易量和振幅
-                open_price = float(klines[0][1])
-                if open_price == 0:
-                    continue
-                # 计算1小时的最高价、最低价、总交易量(usdt交易量而不是币交易量)
-                high_price = float(klines[0][2])
-                low_price = float(klines[0][3])
-                volume = float(klines[0][7])
-                for kline in klines[1:]:
-                    high_price = max(high_price, float(kline[2]))
-                    low_price = min(low_price, float(kline[3]))
-                    volume += float(kline[7])
-                # 计算振幅并保留 2 位小数
-                amplitude = round((high_price - low_price) / open_price * 100, 2)
-                """振幅计算公式：(最高价 - 最低价) / 开盘价 * 100%"""
-                # 筛选出交易量大于10000000且振幅大于5%的币种
-                if volume > min_volume and min_amplitude < amplitude < 200:
-                    logging.info('%s - 最高价: %s, 最低价: %s, 交易量: %s, 振幅: %s' % (
-                        symbol, high_price, low_price, round(volume, 2), amplitude))
-                    selected_symbols[symbol] = {'volume': volume, 'amplitude': amplitude, 'symbol': symbol}
-        except Exception as e:
-            logging.error(f"错误处理 {symbol}: {str(e)}")
-    # 按振幅排序后取出振幅最高的3条数据
-    sorted_pairs = sorted(selected_symbols.values(), key=lambda x: x['amplitude'], reverse=True)[:4]
+    # 按交易额取前 100 个 USDT 交易对, 并发获取 20 根 3 分钟 K 线, 计算振幅和交易额(usdt交易量而不是币交易量)
+    selected_symbols = await screener.screen(min_volume, min_amplitude)
+    for item in selected_symbols:
+        logging.info('%s - 最高价: %s, 最低价: %s, 交易量: %s, 振幅: %s' % (
+            item['symbol'], item['high'], item['low'], round(item['volume'], 2), item['amplitude']))
+    # 按振幅排序后取出振幅最高的4条数据
+    sorted_pairs = selected_symbols[:4]
     if len(sorted_pairs) == 0:
         logging.info('未找到符合条件的交易对.')
     else:
         logging.info('找到符合条件的交易对: %s' % ', '.join([item['symbol'] for item in sorted_pairs]))
-    # 如果数量小于 4 且不包含 BNBUSDT 则添加 BNBUSDT
-    if len(sorted_pairs) < 3 and 'BNBUSDT' not in selected_symbols:
-        if 'BNBUSDT' in selected_symbols:
-            sorted_pairs.append(selected_symbols['BNBUSDT'])
-        else:
-            sorted_pairs.append({'volume': 1111111, 'amplitude': 1.1, 'symbol': 'BNBUSDT'})
+    # 如果数量小于 3 且不包含 BNBUSDT 则添加 BNBUSDT
+    if len(sorted_pairs) < 3 and 'BNBUSDT' not in [item['symbol'] for item in sorted_pairs]:
+        sorted_pairs.append({'volume': 1111111, 'amplitude': 1.1, 'symbol': 'BNBUSDT'})
     return sorted_pairs
 
 
-def writer_proc(queue, output):
-    while True:
-        data = queue.get()
-        if data is None:
-            break
-        symbol, timestamp, message = data
-        date = datetime.datetime.fromtimestamp(timestamp).strftime('%Y%m%d')
-        with open(os.path.join(output, '%s_%s.dat' % (symbol, date)), 'a') as f:
-            f.write(str(int(timestamp * 1000000)))
-            f.write(' ')
-            f.write(message)
-            f.write('\n')
+def shutdown():
+    asyncio.create_task(collector.close())
+
+
+async def run_collector():
+    watchdog = None
+    # WATCHDOG_TIMEOUT > 0 时只重新订阅静默的交易对, 不断开连接, 见 watchdog.py
+    watchdog_timeout = float(os.getenv('WATCHDOG_TIMEOUT', '0'))
+    if watchdog_timeout > 0:
+        watchdog = asyncio.create_task(Watchdog(collector, 'spot_hft', min_timeout=watchdog_timeout).run())
+    while not collector.closed:
+        await collector.connect()
+        await asyncio.sleep(1)
+    if watchdog is not None:
+        watchdog.cancel()
 
 
-def main():
-    global current_processes
-    while True:
+async def main():
+    """
+    单个异步采集器: 每 30 分钟重新筛选交易对, 在同一个 WebSocket 连接上通过 SUBSCRIBE/UNSUBSCRIBE 增减交易对,
+    仍被选中的交易对不会中断, 订单簿和文件句柄保持不变。
+    """
+    collect_task = asyncio.create_task(run_collector())
+    # 事件循环延迟超过 LOOP_LAG_THRESHOLD 秒时记录警告
+    lag_threshold = float(os.getenv('LOOP_LAG_THRESHOLD', '0.1'))
+    lag_monitor = asyncio.create_task(LoopLagMonitor('spot_hft', threshold=lag_threshold).run())
+    gc_monitor = asyncio.create_task(GcMonitor('spot_hft', lambda: collector.messages).run())
+    # 磁盘压力从 CRITICAL 恢复后重新获取快照, 修复 writer 丢弃消息造成的深度缺口
+    resync = asyncio.create_task(resync_after_critical(pressure, lambda: [collector]))
+    # 采集器没有新消息时也定时交出溢出段
+    spill_flush = asyncio.create_task(flush_segments(queue))
+    while not collector.closed:
         try:
-            active_symbols = get_high_amplitude_high_volume_tickers(volume_threshold, amplitude_threshold)
+            active_symbols = await get_high_amplitude_high_volume_tickers(volume_threshold, amplitude_threshold)
         except Exception as e:
             logging.error(f"获取交易对信息出错: {str(e)}. 5 秒后重试")
-            time.sleep(5)
+            await asyncio.sleep(5)
             continue
         try:
-            required_symbols = {item['symbol']: item for item in active_symbols}
-            current_symbols = set(current_processes.keys())
-
-            # 需要启动的新进程
-            to_start = required_symbols.keys() - current_symbols
-            # 需要停止的进程
-            to_stop = current_symbols - required_symbols.keys()
-
-            # 停止不再需要的采集进程
-            for symbol in to_stop:
-                proc = current_processes.pop(symbol)
-                proc.terminate()
-                proc.join()  # Ensure the process has exited before continuing.
-                logging.info(f'停止采集 {symbol} 的进程.')
-
-            # 启动新的采集进程
-            for symbol in to_start:
-                p = Process(target=start_collecting, args=(symbol, queue, output_dir))
-                p.start()
-                current_processes[symbol] = p
-                logging.info(f'启动采集 {symbol} 的进程.')
-
+            required_symbols = {item['symbol'].lower() for item in active_symbols}
+            current_symbols = set(collector.symbols)
+
+            # 需要停止采集的交易对
+            to_stop = sorted(current_symbols - required_symbols)
+            # 需要开始采集的交易对
+            to_start = sorted(required_symbols - current_symbols)
+
+            if to_stop:
+                await collector.unsubscribe(to_stop)
+                logging.info(f'停止采集 {", ".join(to_stop)}.')
+            if to_start:
+                # 不存在或不在交易状态的交易对不会订阅
+                started = await collector.subscribe(to_start)
+                if started:
+                    logging.info(f'开始采集 {", ".join(started)}.')
         except Exception as e:
             logging.error(f"主循环出错: {str(e)}")
 
-        time.sleep(1800)
-
-
-def start_collecting(symbol, queue, output):
-    """启动针对特定交易对的数据采集进程"""
-    logging.info(f'开始收集 {symbol}')
-    asyncio.set_event_loop(asyncio.new_event_loop())  # Set up a new event loop for the child process
-    loop = asyncio.get_event_loop()
-    binance_collector = Binance(queue, [symbol.lower()])
-    loop.run_until_complete(binance_collector.connect())
-    loop.close()
+        # 关闭时提前结束等待
+        for _ in range(1800):
+            if collector.closed:
+                break
+            await asyncio.sleep(1)
+    await screener.close()
+    await collect_task
+    lag_monitor.cancel()
+    gc_monitor.cancel()
+    resync.cancel()
+    spill_flush.cancel()
 
 
 if __name__ == "__main__":
-    writer_p = Process(target=writer_proc, args=(queue, output_dir))
+    lifecycle = from_env()
+    pressure = RawValue('i', NORMAL)
+    writer_p = Process(target=writer_proc, args=(queue, output_dir, os.getenv('ARCHIVE_FORMAT', 'text'), pressure),
+                       kwargs=writer_options())
     writer_p.start()
-    main()
+    if lifecycle is not None:
+        Process(target=lifecycle_proc, args=(output_dir, pressure), kwargs=lifecycle, daemon=True).start()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # SPOT_DEDUPE=1 时丢弃内容没有变化的 kline/ticker/有限档深度推送
+    collector = Binance(queue, [], profile=load_profile(os.getenv('CAPTURE_PROFILE')),
+                        dedupe=os.getenv('SPOT_DEDUPE', '0') not in ('0', ''))
+    loop.add_signal_handler(signal.SIGTERM, shutdown)
+    loop.add_signal_handler(signal.SIGINT, shutdown)
+    # SIGUSR1 切换采集进程的 cProfile, 并转发给 writer
+    install(Profiler('spot_hft'), loop, lambda: [writer_p.pid] if writer_p.is_alive() else [])
+    # GC_THRESHOLD=50000,20,20 时调整循环垃圾回收的阈值, GC_FREEZE=1 时冻结启动阶段创建的对象
+    tune_gc([int(value) for value in os.getenv('GC_THRESHOLD', '').split(',') if value],
+            os.getenv('GC_FREEZE', '0') not in ('0', ''))
+    loop.run_until_complete(main())
+    queue.put(None)
+    writer_p.join()
@@ -0,0 +1,14 @@
+"""
+组合 stream (/stream?streams=...) 消息的 stream 名称, 采集器, writer 和 fanout 共用。
+消息以 stream 名称开头, 只做前缀匹配, 不需要解析 JSON。
+"""
+STREAM_PREFIX = '{"stream":"'
+
+
+def stream_name(raw_message):
+    """返回原始消息的 stream 名称, 没有 stream 字段 (如深度快照) 时返回 None。"""
+    if raw_message.startswith(STREAM_PREFIX):
+        end = raw_message.find('"', len(STREAM_PREFIX))
+        if end > 0:
+            return raw_message[len(STREAM_PREFIX):end]
+    return None
@@ -0,0 +1,110 @@
+"""
+按 (symbol, stream) 检测静默的 stream, 只在当前连接上重新订阅受影响的交易对, 其他交易对不受影响。
+
+采集器在 last_seen 中记录每个 stream 最后一条消息的本地时间 (深度只记录已经同步的消息,
+快照同步卡住时也会被发现), 并提供 resubscribe(symbol, streams)。
+超时时间为 stream 的推送周期乘以 factor, 且不小于 min_timeout。没有固定推送周期的 stream
+(trade, aggTrade, bookTicker) 不检测。
+"""
+import asyncio
+import logging
+import re
+
+from clock import now
+
+INTERVAL = re.compile(r'@(\d+)(ms|s)$')
+
+# 没有在 stream 名称中指定推送周期时的默认值 (秒)
+DEFAULT_CADENCE = {
+    'depth': 1.0,
+    'markPrice': 3.0,
+    'kline': 2.0,
+    'ticker': 1.0,
+}
+
+
+def cadence(stream):
+    """
+    'btcusdt@markPrice@1s' -> 1.0, 'btcusdt@depth@0ms' -> 0.0, 'btcusdt@kline_1m' -> 2.0,
+    'btcusdt@trade' -> None (不检测)。
+    """
+    match = INTERVAL.search(stream)
+    if match is not None:
+        value = int(match.group(1))
+        return value / 1000 if match.group(2) == 'ms' else float(value)
+    name = stream.split('@')[1]
+    for prefix, value in DEFAULT_CADENCE.items():
+        if name.startswith(prefix):
+            return value
+    return None
+
+
+class Watchdog:
+    def __init__(self, collector, name, min_timeout=10.0, factor=10.0, check_interval=1.0, report_interval=60):
+        self.collector = collector
+        self.name = name
+        self.min_timeout = min_timeout
+        self.factor = factor
+        self.check_interval = check_interval
+        self.report_interval = report_interval
+        self.timeouts = {}
+        # 累计计数, 每个交易对一项
+        self.stalls = {}
+        self.resubscribes = {}
+        self.failures = {}
+
+    def timeout(self, stream):
+        if stream not in self.timeouts:
+            value = cadence(stream)
+            self.timeouts[stream] = None if value is None else max(value * self.factor, self.min_timeout)
+        return self.timeouts[stream]
+
+    def stalled(self, symbol, timestamp):
+        last_seen = self.collector.last_seen
+        streams = []
+        for stream, _ in self.collector.profile.streams(symbol):
+            timeout = self.timeout(stream)
+            if timeout is None:
+                continue
+            seen = last_seen.get(stream)
+            if seen is None:
+                # 刚订阅的 stream 从第一次检查开始计时
+                last_seen[stream] = timestamp
+            elif timestamp - seen > timeout:
+                streams.append(stream)
+        return streams
+
+    async def check(self):
+        collector = self.collector
+        if collector.ws is None:
+            return
+        timestamp = now()
+        for symbol in list(collector.symbols):
+            streams = self.stalled(symbol, timestamp)
+            if not streams:
+                continue
+            logging.warning('Stream is stalled. name=%s, symbol=%s, streams=%s' % (self.name, symbol, streams))
+            self.stalls[symbol] = self.stalls.get(symbol, 0) + 1
+            # 重新计时, 至少再等待一个超时周期才会再次处理
+            for stream in streams:
+                collector.last_seen[stream] = timestamp
+            try:
+                if await collector.resubscribe(symbol, streams):
+                    self.resubscribes[symbol] = self.resubscribes.get(symbol, 0) + 1
+            except Exception as e:
+                self.failures[symbol] = self.failures.get(symbol, 0) + 1
+                logging.error('Failed to resubscribe. name=%s, symbol=%s, %s' % (self.name, symbol, e))
+
+    def report(self):
+        if self.stalls:
+            logging.info('Watchdog stats. name=%s, stalls=%s, resubscribes=%s, failures=%s'
+                         % (self.name, self.stalls, self.resubscribes, self.failures))
+
+    async def run(self):
+        next_report = now() + self.report_interval
+        while not self.collector.closed:
+            await asyncio.sleep(self.check_interval)
+            await self.check()
+            if now() >= next_report:
+                next_report = now() + self.report_interval
+                self.report()
@@ -0,0 +1,177 @@
+import datetime
+import errno
+import logging
+import os
+import time
+from queue import Empty
+
+from binformat import BinaryFile
+from diskio import FSYNC_NONE, AsyncFile, WriteStats, create_pool
+from lifecycle import CRITICAL, NORMAL, SHED
+from profiling import Profiler, install
+from streams import stream_name
+
+TEXT = 'text'
+BINARY = 'binary'
+LOW_PRIORITY_STREAMS = ('bookTicker', 'markPrice')
+# 磁盘写满后暂停写入的秒数
+DISK_FULL_PAUSE = 5
+# 队列为空时, 每隔多少秒把缓冲区交给 I/O 线程
+FLUSH_INTERVAL = 0.1
+
+
+class TextFile:
+    def __init__(self, path, file=None):
+        self.file = file if file is not None else open(path, 'ab')
+
+    def write_record(self, timestamp, message):
+        self.file.write(('%d %s\n' % (int(timestamp * 1000000), message)).encode())
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def open_archive(output, symbol, date, archive_format, opener=None):
+    """
+    opener(path) 返回以追加方式打开的类文件对象, 默认直接打开文件。
+    symbol 可以带子目录前缀 (如 binance/btcusdt, 见 main.py), 子目录不存在时自动创建。
+    """
+    if '/' in symbol:
+        os.makedirs(os.path.join(output, os.path.dirname(symbol)), exist_ok=True)
+    if archive_format == BINARY:
+        path = os.path.join(output, '%s_%s.bin' % (symbol, date))
+        return BinaryFile(path, opener(path) if opener is not None else None)
+    path = os.path.join(output, '%s_%s.dat' % (symbol, date))
+    return TextFile(path, opener(path) if opener is not None else None)
+
+
+def is_low_priority(message):
+    stream = stream_name(message)
+    return stream is not None and stream.partition('@')[2].startswith(LOW_PRIORITY_STREAMS)
+
+
+def writer_options():
+    """从环境变量读取 writer_proc 的写入参数。"""
+    return {
+        'fsync': os.getenv('WRITER_FSYNC', FSYNC_NONE),
+        'fsync_interval': float(os.getenv('WRITER_FSYNC_INTERVAL', '1')),
+        'buffer_size': int(os.getenv('WRITER_BUFFER_SIZE', str(1 << 20))),
+        'threads': int(os.getenv('WRITER_THREADS', '2')),
+    }
+
+
+def writer_proc(queue, output, archive_format=TEXT, pressure=None, fsync=FSYNC_NONE, fsync_interval=1.0,
+                buffer_size=1 << 20, threads=2, stats_interval=60):
+    """
+    把队列中的 (symbol, timestamp, message) 写入 <output>/<symbol>_<date>.dat,
+    archive_format='binary' 时写入二进制归档 <output>/<symbol>_<date>.bin (见 binformat.py)。
+    记录先写入每个文件的内存缓冲区, 缓冲区满或队列暂时为空时交给 I/O 线程池批量写入 (见 diskio.py),
+    fsync 为 'none', 'interval' (每 fsync_interval 秒) 或 'rotate' (关闭文件时)。
+    日期变化时关闭前一天的文件, 每 stats_interval 秒记录一次写入延迟, 缓冲区占用和溢出到磁盘的消息数。
+    pressure 为 lifecycle 进程维护的共享磁盘压力等级: SHED 时丢弃低优先级 stream, CRITICAL 时丢弃所有消息。
+    磁盘写满 (ENOSPC) 时关闭文件并暂停写入, 而不是退出。SIGUSR1 切换 cProfile (见 profiling.py)。
+    """
+    if archive_format not in (TEXT, BINARY):
+        raise ValueError('unsupported archive format: %s' % archive_format)
+    install(Profiler('writer'))
+    if hasattr(queue, 'recover'):
+        # spillqueue.SpillQueue: 先读取上次遗留的溢出段
+        queue.recover()
+    pool = create_pool(threads)
+    stats = WriteStats()
+
+    # path -> 最近一次打开的 AsyncFile, 同一个文件只允许一个 AsyncFile 写入
+    opened = {}
+
+    def opener(path):
+        previous = opened.get(path)
+        if previous is not None:
+            # 迟到的前一天数据或磁盘恢复后重新打开时, 先等待旧文件的写入和关闭完成,
+            # 保证记录的顺序, BinaryFile 检查文件是否存在时也能看到已写入的文件头
+            previous.wait()
+        for key in [key for key, f in opened.items() if f.done()]:
+            del opened[key]
+        f = opened[path] = AsyncFile(path, pool, stats, buffer_size, max(buffer_size * 64, 64 << 20), fsync,
+                                     fsync_interval)
+        return f
+
+    files = {}
+    current_date = None
+    level = NORMAL
+    dropped = 0
+    paused_until = 0
+    next_report = time.time() + stats_interval
+    while True:
+        try:
+            data = queue.get_nowait()
+        except Empty:
+            try:
+                for f in files.values():
+                    f.flush()
+            except OSError as e:
+                paused_until = _on_write_error(e, files)
+            if time.time() >= next_report:
+                next_report = time.time() + stats_interval
+                _report(stats, queue, len(files))
+            try:
+                data = queue.get(timeout=FLUSH_INTERVAL)
+            except Empty:
+                continue
+        if data is None:
+            break
+        symbol, timestamp, message = data
+        if pressure is not None and pressure.value != level:
+            logging.warning('Writer pressure level is changed. level=%d, dropped=%d' % (pressure.value, dropped))
+            level = pressure.value
+            dropped = 0
+        if level == CRITICAL or (level == SHED and is_low_priority(message)) or paused_until > timestamp:
+            dropped += 1
+            continue
+        date = datetime.datetime.fromtimestamp(timestamp).strftime('%Y%m%d')
+        if date != current_date:
+            # 收到新一天的数据时关闭旧文件, 迟到的前一天数据会重新打开对应文件
+            for key in [key for key in files if key[1] < date]:
+                files.pop(key).close()
+            current_date = max(date, current_date or date)
+        try:
+            f = files.get((symbol, date))
+            if f is None:
+                f = files[(symbol, date)] = open_archive(output, symbol, date, archive_format, opener)
+            f.write_record(timestamp, message)
+        except OSError as e:
+            paused_until = _on_write_error(e, files)
+            dropped += 1
+    for f in files.values():
+        f.close()
+    pool.shutdown(wait=True)
+    _report(stats, queue, 0)
+
+
+def _report(stats, queue, files):
+    report = stats.report()
+    report['files'] = files
+    try:
+        report['queue'] = queue.qsize()
+    except NotImplementedError:
+        report['queue'] = -1
+    report['spilled'] = queue.spilled.value if hasattr(queue, 'spilled') else 0
+    logging.info('Writer stats. files=%(files)d, queue=%(queue)d, spilled=%(spilled)d, writes=%(writes)d, '
+                 'bytes=%(bytes)d, avg_latency=%(avg_latency_ms).3fms, max_latency=%(max_latency_ms).3fms, fsyncs=%(fsyncs)d, '
+                 'stalls=%(stalls)d, buffered=%(buffered)d, max_buffered=%(max_buffered)d' % report)
+
+
+def _on_write_error(e, files):
+    if e.errno != errno.ENOSPC:
+        raise e
+    logging.error('No space left on device, writing is paused for %d seconds.' % DISK_FULL_PAUSE)
+    # 缓冲区中未写入的数据无法保证完整, 关闭后恢复时重新以追加方式打开
+    for f in files.values():
+        try:
+            f.close()
+        except OSError:
+            pass
+    files.clear()
+    return time.time() + DISK_FULL_PAUSE
@@ -0,0 +1,192 @@
+"""
+检查归档文件中深度更新的连续性。
+
+    python3 convert/audit.py /mnt/data                  # 检查目录下所有 .dat/.gz/.bin 文件
+    python3 convert/audit.py -j 8 -o report.json a.dat  # 8 个进程并行, 并输出 JSON 报告
+
+U 本位/币本位期货 (消息带 pu): 每条消息的 pu 应等于上一条的 u, 快照后的第一条应满足 U <= lastUpdateId <= u。
+现货: 每条消息的 U 应等于上一条的 u + 1, 快照后的第一条应满足 U <= lastUpdateId + 1 <= u。
+writer 按日期切分文件, 之后每天的文件通常以没有快照的深度消息开头, 这时以第一条消息为起点检查连续性,
+这些消息计为 unsynced (无法与快照核对), 没有缺口时结果为 WARN 而不是 OK。
+只对 depth 消息做前缀匹配提取更新 ID, 其他消息只统计数量, 不做 JSON 解析。
+"""
+import argparse
+import gzip
+import json
+import os
+import re
+import sys
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'collect'))
+
+from binformat import TAG_RAW, read_file  # noqa: E402
+from streams import STREAM_PREFIX  # noqa: E402
+
+# 原始文件按字节读取
+STREAM_PREFIX_BYTES = STREAM_PREFIX.encode()
+FIRST_UPDATE_ID = re.compile(rb'"U":(\d+)')
+LAST_UPDATE_ID = re.compile(rb'"u":(\d+)')
+PREV_UPDATE_ID = re.compile(rb'"pu":(-?\d+)')
+SNAPSHOT_UPDATE_ID = re.compile(rb'"lastUpdateId": ?(\d+)')
+MAX_EVENTS = 100
+
+
+class DepthAudit:
+    """一个交易对深度流的连续性状态。"""
+
+    def __init__(self):
+        self.prev_u = None
+        self.last_update_id = None
+        self.messages = 0
+        self.snapshots = 0
+        self.unsynced = 0
+        self.gaps = []
+        self.resyncs = []
+        self.gap_count = 0
+
+    def on_snapshot(self, line_no, timestamp, last_update_id):
+        self.snapshots += 1
+        if len(self.resyncs) < MAX_EVENTS:
+            self.resyncs.append({'line': line_no, 'local_timestamp': timestamp, 'last_update_id': last_update_id})
+        self.last_update_id = last_update_id
+        self.prev_u = None
+
+    def on_depth(self, line_no, timestamp, first_id, last_id, prev_id):
+        self.messages += 1
+        futures = prev_id is not None
+        if self.snapshots == 0:
+            # 文件开头尚未收到快照的消息
+            self.unsynced += 1
+        if self.prev_u is None:
+            if self.last_update_id is None:
+                # 第一条消息, 作为检查连续性的起点
+                self.prev_u = last_id
+                return
+            target = self.last_update_id if futures else self.last_update_id + 1
+            if not first_id <= target <= last_id:
+                self.__gap(line_no, timestamp, 'snapshot', self.last_update_id, first_id, last_id)
+            self.last_update_id = None
+        elif (futures and prev_id != self.prev_u) or (not futures and first_id != self.prev_u + 1):
+            self.__gap(line_no, timestamp, 'sequence', self.prev_u, first_id, last_id)
+        self.prev_u = last_id
+
+    def __gap(self, line_no, timestamp, kind, expected, first_id, last_id):
+        self.gap_count += 1
+        if len(self.gaps) < MAX_EVENTS:
+            self.gaps.append({'line': line_no, 'local_timestamp': timestamp, 'kind': kind,
+                              'prev_update_id': expected, 'U': first_id, 'u': last_id})
+
+    def report(self):
+        return {
+            'messages': self.messages,
+            'snapshots': self.snapshots,
+            'unsynced': self.unsynced,
+            'gaps': self.gap_count,
+            'gap_events': self.gaps,
+            'resync_events': self.resyncs,
+        }
+
+
+def iter_lines(path):
+    """产出 (local_timestamp, stream, raw_message_bytes 或解码后的对象)。"""
+    ext = os.path.splitext(path)[1]
+    if ext == '.bin':
+        for timestamp, tag, message in read_file(path):
+            if tag == TAG_RAW:
+                message = json.loads(message)
+            yield timestamp, message.get('stream'), message
+        return
+    open_func = gzip.open if ext == '.gz' else open
+    with open_func(path, 'rb') as f:
+        for line in f:
+            message = line[17:]
+            if message.startswith(STREAM_PREFIX_BYTES):
+                stream = message[len(STREAM_PREFIX_BYTES):message.index(b'"', len(STREAM_PREFIX_BYTES))].decode()
+            else:
+                stream = None
+            yield int(line[:16]), stream, message
+
+
+def audit_file(path):
+    name = os.path.basename(path).split('.')[0]
+    symbol, _, date = name.rpartition('_')
+    streams = {}
+    depth = DepthAudit()
+    lines = 0
+    errors = 0
+    for line_no, (timestamp, stream, message) in enumerate(iter_lines(path), 1):
+        lines += 1
+        key = stream if stream is not None else 'snapshot'
+        streams[key] = streams.get(key, 0) + 1
+        try:
+            if isinstance(message, dict):
+                if stream is None:
+                    depth.on_snapshot(line_no, timestamp, message['lastUpdateId'])
+                elif stream.split('@')[1] == 'depth':
+                    data = message['data']
+                    depth.on_depth(line_no, timestamp, data['U'], data['u'], data.get('pu'))
+            elif stream is None:
+                depth.on_snapshot(line_no, timestamp, int(SNAPSHOT_UPDATE_ID.search(message).group(1)))
+            elif stream.split('@')[1] == 'depth':
+                prev_id = PREV_UPDATE_ID.search(message)
+                depth.on_depth(line_no, timestamp,
+                               int(FIRST_UPDATE_ID.search(message).group(1)),
+                               int(LAST_UPDATE_ID.search(message).group(1)),
+                               int(prev_id.group(1)) if prev_id is not None else None)
+        except (AttributeError, KeyError, ValueError):
+            errors += 1
+    report = depth.report()
+    if report['gaps'] or errors:
+        status = 'FAIL'
+    elif report['unsynced']:
+        status = 'WARN'
+    else:
+        status = 'OK'
+    return {
+        'file': path,
+        'symbol': symbol,
+        'date': date,
+        'lines': lines,
+        'errors': errors,
+        'streams': streams,
+        'depth': report,
+        'status': status,
+        'ok': status == 'OK',
+    }
+
+
+def find_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for filename in sorted(os.listdir(path)):
+                if filename.endswith(('.dat', '.dat.gz', '.gz', '.bin')):
+                    files.append(os.path.join(path, filename))
+        else:
+            files.append(path)
+    return files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='+', help='archive files or directories')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('-o', '--output', help='write the full report as JSON')
+    args = parser.parse_args()
+
+    files = find_files(args.paths)
+    with Pool(max(1, min(args.jobs, len(files)))) as pool:
+        reports = pool.map(audit_file, files, chunksize=1)
+
+    for report in reports:
+        depth = report['depth']
+        print('%s %s %s lines=%d depth=%d snapshots=%d unsynced=%d gaps=%d errors=%d streams=%s' % (
+            report['status'].ljust(4), report['symbol'], report['date'], report['lines'],
+            depth['messages'], depth['snapshots'], depth['unsynced'], depth['gaps'], report['errors'],
+            ','.join('%s:%d' % item for item in sorted(report['streams'].items()))))
+        for gap in depth['gap_events'][:10]:
+            print('    gap at line %(line)d (%(kind)s): prev_update_id=%(prev_update_id)s, U=%(U)d, u=%(u)d' % gap)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=2)
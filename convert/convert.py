@@ -1,10 +1,116 @@
 import argparse
-import gzip
+import atexit
+import cProfile
 import json
 import os
+import pstats
+import time
 
+import numpy as np
 import pandas as pd
 
+from converter import (COLUMN_TYPES, COLUMNS, LATENCY_EVENTS, Converter, estimate_latency, iter_messages, load_scales,
+                       prior_snapshot, source_filename)
+from snapstore import SnapshotStore
+
+
+class ColumnStore:
+    """
+    可追加的列式存储, 每列一个原始二进制文件 (<dir>/<column>.<dtype>), 可以直接 np.memmap 读取。
+    定点模式的小数位数等元数据保存在 <dir>/meta.json。
+    """
+
+    def __init__(self, path, column_types=COLUMN_TYPES, metadata=None):
+        self.path = path
+        self.column_types = column_types
+        os.makedirs(path, exist_ok=True)
+        if metadata:
+            with open(os.path.join(path, 'meta.json'), 'w') as f:
+                json.dump(metadata, f)
+
+    def column_file(self, column, dtype):
+        return os.path.join(self.path, '%s.%s' % (column, dtype))
+
+    def truncate(self, length):
+        # 上次运行在写列文件和保存状态之间中断时, 丢弃多写的行
+        for column, dtype in zip(COLUMNS, self.column_types):
+            filename = self.column_file(column, dtype)
+            if os.path.exists(filename):
+                with open(filename, 'r+b') as f:
+                    f.truncate(length * np.dtype(dtype).itemsize)
+
+    def append(self, array):
+        """追加 Converter.to_array 返回的结构化数组。"""
+        for column, dtype in zip(COLUMNS, self.column_types):
+            with open(self.column_file(column, dtype), 'ab') as f:
+                np.ascontiguousarray(array[column], dtype=dtype).tofile(f)
+
+    def to_frame(self):
+        data = {}
+        for column, dtype in zip(COLUMNS, self.column_types):
+            filename = self.column_file(column, dtype)
+            data[column] = np.fromfile(filename, dtype=dtype) if os.path.exists(filename) else np.array([], dtype)
+        df = pd.DataFrame(data, columns=COLUMNS)
+        meta_file = os.path.join(self.path, 'meta.json')
+        if os.path.exists(meta_file):
+            with open(meta_file, 'r') as f:
+                df.attrs.update(json.load(f))
+        return df
+
+
+def follow(src_file, filename, dst_path, converter, interval, once):
+    """
+    增量转换 writer_proc 正在追加的 .dat 文件。
+    已转换的偏移量和订单簿状态保存在 <filename>.state.json, 新转换的行追加到 <filename>.cols 列式存储中。
+    源文件在 interval 秒内没有增长且次日文件已经出现时 (或指定 --once 时) 结束, 并返回列式存储。
+    """
+    state_file = os.path.join(dst_path, filename + '.state.json')
+    store = ColumnStore(os.path.join(dst_path, filename + '.cols'), converter.column_types, converter.metadata())
+    offset = 0
+    row_count = 0
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+        offset = state['offset']
+        row_count = state['rows']
+        converter.restore(state['converter'])
+    store.truncate(row_count)
+
+    while True:
+        rows = []
+        start = offset
+        with open(src_file, 'rb') as f:
+            f.seek(offset)
+            while True:
+                line = f.readline()
+                # 只处理完整的行, 未写完的行留到下一轮
+                if not line or not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                converter.convert(line.decode(), rows)
+        if offset != start:
+            # 没有产生行的消息 (如 kline, ticker, 非完整模式下的 bookTicker) 也推进了偏移量, 同样保存状态
+            if rows:
+                store.append(converter.to_array(rows))
+                row_count += len(rows)
+            with open(state_file + '.tmp', 'w') as f:
+                json.dump({'offset': offset, 'rows': row_count, 'converter': converter.state()}, f)
+            os.replace(state_file + '.tmp', state_file)
+            print('Appended. rows=%d, total=%d, offset=%d' % (len(rows), row_count, offset))
+        if once:
+            break
+        if offset == start and next_day_started(src_file):
+            break
+        time.sleep(interval)
+    return store
+
+
+def next_day_started(src_file):
+    head, date = os.path.splitext(src_file)[0].rsplit('_', 1)
+    next_date = (pd.Timestamp(date) + pd.Timedelta(days=1)).strftime('%Y%m%d')
+    return os.path.exists('%s_%s.dat' % (head, next_date))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     # parser.add_argument('-e', '--engine', help='translation engine (OpenAI, LibreTranslate)', default='OpenAI',
@@ -14,150 +120,86 @@ if __name__ == '__main__':
     parser.add_argument('-s', '--snapshot')
     parser.add_argument('-f', '--full', action='store_true', default=True)
     parser.add_argument('-c', '--correct', action='store_true')
+    parser.add_argument('-F', '--follow', action='store_true',
+                        help='incrementally convert a .dat file that is still being written')
+    parser.add_argument('--interval', type=float, default=5, help='polling interval of the follow mode in seconds')
+    parser.add_argument('--once', action='store_true',
+                        help='in the follow mode, convert what is available and exit without finalizing')
+    parser.add_argument('--fixed', action='store_true',
+                        help='parse prices and quantities into int64 fixed-point values, scales come from --exchange-info')
+    parser.add_argument('--exchange-info',
+                        help='market of the cached exchangeInfo (spot, fapi, dapi) or an exchangeInfo JSON file, '
+                             'used by the fixed-point mode')
+    parser.add_argument('--snapshot-store',
+                        help='snapshot store directory, the nearest prior book is used when -s is not given '
+                             'and the end-of-day book is saved to it')
+    parser.add_argument('--exchange', help='exchange key in the snapshot store, for multi-venue output directories')
+    parser.add_argument('--latency', type=float, default=0, metavar='SECONDS',
+                        help='add clock_offset and latency columns estimated over rolling windows of this length')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='profile the conversion with cProfile, save the stats to FILE and print the hot spots')
 
     args = parser.parse_args()
 
+    if args.profile:
+        profile = cProfile.Profile()
+
+        def save_profile():
+            profile.disable()
+            profile.dump_stats(args.profile)
+            pstats.Stats(profile).sort_stats('tottime').print_stats(20)
+
+        # --once 时通过 exit 结束, 用 atexit 保证保存
+        atexit.register(save_profile)
+        profile.enable()
+
     src_file = args.src_file
     ext = os.path.splitext(src_file)[1]
-    if ext == '.gz':
-        filename = os.path.basename(os.path.splitext(os.path.splitext(src_file)[0])[0])
-        open_func = gzip.open
-    elif ext == '.dat':
-        filename = os.path.basename(os.path.splitext(src_file)[0])
-        open_func = open
-    else:
-        raise ValueError
+    filename = source_filename(src_file)
 
     dst_file = os.path.join(args.dst_path, filename + '.pkl')
     snapshot_dst_file = os.path.join(args.dst_path, filename + '.snapshot.pkl')
     snapshot_src_file = args.snapshot
-    correct_exch_timestamp = args.correct
 
-    bid_depth = {}
-    ask_depth = {}
+    price_scale = qty_scale = None
+    if args.fixed:
+        if args.exchange_info is None:
+            raise ValueError('--fixed requires --exchange-info.')
+        price_scale, qty_scale = load_scales(args.exchange_info, filename.rsplit('_', 1)[0])
+    converter = Converter(args.full, args.correct, price_scale, qty_scale)
+    snapshot_store = SnapshotStore(args.snapshot_store) if args.snapshot_store else None
+    if snapshot_src_file is None and snapshot_store is not None:
+        # 自动衔接前一天的日终订单簿
+        snapshot_src_file = prior_snapshot(snapshot_store, src_file, args.exchange)
     if snapshot_src_file is not None:
-        snapshot_df = pd.read_pickle(snapshot_src_file, compression='gzip')
-        for row_num, row in snapshot_df.iterrows():
-            if row['side'] == 1:
-                bid_depth[str(row['price'])] = str(row['qty'])
-            elif row['side'] == -1:
-                ask_depth[str(row['price'])] = str(row['qty'])
-
-    prev_exch_timestamp = 0
-    rows = []
-    with open_func(src_file, 'r') as f:
-        while True:
-            line = f.readline()
-            if not line:
-                break
-            local_timestamp = int(line[:16])
-            message = json.loads(line[17:])
-            data = message.get('data')
-            if data is not None:
-                if 'e' in data:
-                    evt = data['e']
-                else:
-                    evt = message['stream'].split('@')[1]
-                if evt == 'trade':
-                    # transaction_time = data['T']
-                    transaction_time = data['E']
-                    price = data['p']
-                    qty = data['q']
-                    side = -1 if data['m'] else 1  # trade initiator's side
-                    exch_timestamp = int(transaction_time) * 1000
-                    if correct_exch_timestamp and exch_timestamp < prev_exch_timestamp:
-                        exch_timestamp = prev_exch_timestamp
-                    prev_exch_timestamp = exch_timestamp
-                    rows.append([2, exch_timestamp, local_timestamp, side, float(price), float(qty)])
-                elif evt == 'depthUpdate':
-                    # transaction_time = data['T']
-                    transaction_time = data['E']
-                    bids = data['b']
-                    asks = data['a']
-                    exch_timestamp = int(transaction_time) * 1000
-                    if correct_exch_timestamp and exch_timestamp < prev_exch_timestamp:
-                        exch_timestamp = prev_exch_timestamp
-                    prev_exch_timestamp = exch_timestamp
-                    rows += [[1, exch_timestamp, local_timestamp, 1, float(bid[0]), float(bid[1])] for bid in bids]
-                    rows += [[1, exch_timestamp, local_timestamp, -1, float(ask[0]), float(ask[1])] for ask in asks]
-                    for bid in bids:
-                        if round(float(bid[1]) / 0.000001) == 0:
-                            if bid[0] in bid_depth:
-                                del bid_depth[bid[0]]
-                        else:
-                            bid_depth[bid[0]] = bid[1]
-                    for ask in asks:
-                        if round(float(ask[1]) / 0.000001) == 0:
-                            if ask[0] in ask_depth:
-                                del ask_depth[ask[0]]
-                        else:
-                            ask_depth[ask[0]] = ask[1]
-                elif evt == 'markPriceUpdate' and args.full:
-                    # transaction_time = data['T']
-                    transaction_time = data['E']
-                    index = data['i']
-                    mark_price = data['p']
-                    # est_settle_price = data['P']
-                    funding_rate = data['r']
-                    rows.append([100, prev_exch_timestamp, local_timestamp, 0, float(index), 0])
-                    rows.append([101, prev_exch_timestamp, local_timestamp, 0, float(mark_price), 0])
-                    rows.append([102, prev_exch_timestamp, local_timestamp, 0, float(funding_rate), 0])
-                elif evt == 'bookTicker' and args.full:
-                    if 'T' in message:
-                        transaction_time = message['T']
-                        exch_timestamp = int(transaction_time) * 1000
-                    else:
-                        exch_timestamp = local_timestamp
-                    bid_price = data['b']
-                    bid_qty = data['B']
-                    ask_price = data['a']
-                    ask_qty = data['A']
-                    if correct_exch_timestamp and exch_timestamp < prev_exch_timestamp:
-                        exch_timestamp = prev_exch_timestamp
-                    prev_exch_timestamp = exch_timestamp
-                    rows.append([103, exch_timestamp, local_timestamp, 1, float(bid_price), float(bid_qty)])
-                    rows.append([104, exch_timestamp, local_timestamp, -1, float(ask_price), float(ask_qty)])
-            else:
-                # snapshot
-                # event_time = msg['E']
-                # 判断 message['T'] 是否存在
-                if 'T' in message:
-                    transaction_time = message['T']
-                    exch_timestamp = int(transaction_time) * 1000
-                else:
-                    exch_timestamp = local_timestamp
-                bids = message['bids']
-                asks = message['asks']
-                bid_clear_upto = float(bids[-1][0])
-                ask_clear_upto = float(asks[-1][0])
-                if correct_exch_timestamp and exch_timestamp < prev_exch_timestamp:
-                    exch_timestamp = prev_exch_timestamp
-                prev_exch_timestamp = exch_timestamp
-                # clear the existing market depth upto the prices in the snapshot.
-                rows.append([3, exch_timestamp, local_timestamp, 1, bid_clear_upto, 0])
-                rows.append([3, exch_timestamp, local_timestamp, -1, ask_clear_upto, 0])
-                for bid in list(bid_depth.keys()):
-                    if float(bid) > float(bid_clear_upto) or bid == bids[-1][0]:
-                        del bid_depth[bid]
-                for ask in list(ask_depth.keys()):
-                    if float(ask) < float(ask_clear_upto) or ask == asks[-1][0]:
-                        del ask_depth[ask]
-                # insert the snapshot.
-                rows += [[4, exch_timestamp, local_timestamp, 1, float(bid[0]), float(bid[1])] for bid in bids]
-                rows += [[4, exch_timestamp, local_timestamp, -1, float(ask[0]), float(ask[1])] for ask in asks]
-                for bid in bids:
-                    bid_depth[bid[0]] = bid[1]
-                for ask in asks:
-                    ask_depth[ask[0]] = ask[1]
-    df = pd.DataFrame(rows, columns=['event', 'exch_timestamp', 'local_timestamp', 'side', 'price', 'qty'])
+        converter.load_snapshot(snapshot_src_file)
+
+    if args.follow:
+        if ext != '.dat':
+            raise ValueError('only .dat files can be followed.')
+        store = follow(src_file, filename, args.dst_path, converter, args.interval, args.once)
+        if args.once:
+            exit(0)
+        df = store.to_frame()
+    else:
+        rows = []
+        for local_timestamp, message in iter_messages(src_file):
+            converter.convert_message(local_timestamp, message, rows)
+        df = converter.to_frame(rows)
+    if args.latency > 0:
+        # 时钟偏移和超出最小延迟的行情延迟 (微秒), 可以作为回测的行情延迟模型
+        df['clock_offset'], df['latency'] = estimate_latency(df['event'].values, df['exch_timestamp'].values,
+                                                             df['local_timestamp'].values, int(args.latency * 1000000))
+        feed = df['latency'][df['event'].isin(LATENCY_EVENTS)]
+        if len(feed):
+            print('Latency. clock_offset=%dus~%dus, p50=%dus, p99=%dus, max=%dus'
+                  % (df['clock_offset'].min(), df['clock_offset'].max(), feed.quantile(0.5), feed.quantile(0.99),
+                     feed.max()))
     df.to_pickle(dst_file, compression='gzip')
 
-    snapshot = []
-    snapshot += [[4, exch_timestamp, local_timestamp, 1, float(bid), float(qty)]
-                 for bid, qty in sorted(bid_depth.items(), key=lambda v: -float(v[0]))]
-    snapshot += [[4, exch_timestamp, local_timestamp, -1, float(ask), float(qty)]
-                 for ask, qty in sorted(ask_depth.items(), key=lambda v: float(v[0]))]
-    snapshot_df = pd.DataFrame(snapshot, columns=['event', 'exch_timestamp', 'local_timestamp', 'side', 'price', 'qty'])
+    snapshot_df = converter.to_frame(converter.snapshot_rows())
     snapshot_df.to_pickle(snapshot_dst_file, compression='gzip')
+    if snapshot_store is not None:
+        snapshot_store.put(args.exchange, filename.rsplit('_', 1)[0], converter.book_snapshot())
 
     print('Done. rows=%d, filename=%s' % (len(df), dst_file))
@@ -0,0 +1,461 @@
+"""
+converter 的库接口, 不依赖 pandas (只有读取 .pkl 快照和 to_frame 时才导入), 可以在 notebook 或回测中直接使用:
+
+    from converter import iter_batches, prior_snapshot, replay_book
+    from snapstore import SnapshotStore
+    src_file = '/mnt/data/btcusdt_20220811.dat.gz'
+    for batch in iter_batches(src_file, snapshot=prior_snapshot(SnapshotStore('/mnt/data/snapshots'), src_file)):
+        batch['local_timestamp'], batch['price'] ...  # numpy 结构化数组, 字段见 COLUMNS
+
+    def on_book(local_timestamp, converter):
+        converter.bid_depth, converter.ask_depth ...
+    replay_book('/mnt/data/btcusdt_20220811.dat.gz', on_book)
+
+convert.py 是基于这里的命令行工具。
+"""
+import gzip
+import heapq
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'collect'))
+
+from binformat import TAG_RAW, read_file  # noqa: E402
+from exchangeinfo import ENDPOINTS, ExchangeInfo  # noqa: E402
+from snapstore import FLOAT, Snapshot  # noqa: E402
+
+COLUMNS = ['event', 'exch_timestamp', 'local_timestamp', 'side', 'price', 'qty']
+COLUMN_TYPES = ['i8', 'i8', 'i8', 'i8', 'f8', 'f8']
+FIXED_COLUMN_TYPES = ['i8', 'i8', 'i8', 'i8', 'i8', 'i8']
+# 定点模式下 mark price, index price, funding rate 的小数位数
+MARK_SCALE = 8
+# 交易所时间戳来自事件本身的行 (深度, 成交), 用于估计时钟偏移
+LATENCY_EVENTS = [1, 2]
+
+
+def record_dtype(column_types=COLUMN_TYPES):
+    return np.dtype(list(zip(COLUMNS, column_types)))
+
+
+def rescale(values, src_scale, dst_scale):
+    """把 src_scale 的数组转换为 dst_scale (FLOAT 表示浮点数) 的 Python 数值列表。"""
+    values = np.asarray(values)
+    if src_scale == dst_scale:
+        return values.astype('i8' if dst_scale != FLOAT else 'f8').tolist()
+    if src_scale != FLOAT:
+        values = values / 10 ** src_scale
+    if dst_scale == FLOAT:
+        return values.astype('f8').tolist()
+    return np.round(values * 10 ** dst_scale).astype('i8').tolist()
+
+
+def to_fixed(value, scale):
+    """把十进制字符串精确转换为 10^-scale 为单位的整数。"""
+    integer, _, fraction = value.partition('.')
+    if len(fraction) > scale:
+        if fraction[scale:].strip('0'):
+            raise ValueError('%s has more than %d decimal places.' % (value, scale))
+        fraction = fraction[:scale]
+    return int(integer + fraction.ljust(scale, '0'))
+
+
+def load_scales(exchange_info, symbol):
+    """
+    读取交易对的 (price_scale, qty_scale)。exchange_info 为市场名称 (spot/fapi/dapi, 使用本地缓存) 或 exchangeInfo 文件路径。
+    """
+    if exchange_info in ENDPOINTS:
+        return ExchangeInfo(exchange_info).scales(symbol)
+    return ExchangeInfo(path=exchange_info).scales(symbol)
+
+
+def is_zero_qty(qty):
+    return round(float(qty) / 0.000001) == 0
+
+
+class Converter:
+    """
+    逐行转换 .dat 记录, 并维护订单簿状态 (bid_depth/ask_depth), 便于增量转换时保存和恢复。
+    指定 price_scale/qty_scale 时使用定点模式: 价格和数量解析为 int64 (单位 10^-scale),
+    订单簿的键和值都是整数, 比较和判零都是整数运算。
+    """
+
+    def __init__(self, full=True, correct_exch_timestamp=False, price_scale=None, qty_scale=None):
+        self.full = full
+        self.correct_exch_timestamp = correct_exch_timestamp
+        self.bid_depth = {}
+        self.ask_depth = {}
+        # 最近一条消息的交易所时间戳 (markPrice 沿用), 未修正
+        self.prev_exch_timestamp = 0
+        # 已输出的行中最大的交易所时间戳, correct_exch_timestamp 时用于修正下一批
+        self.max_exch_timestamp = 0
+        self.exch_timestamp = 0
+        self.local_timestamp = 0
+        self.fixed = price_scale is not None
+        self.price_scale = price_scale
+        self.qty_scale = qty_scale
+        if self.fixed:
+            self.price = lambda value: to_fixed(value, price_scale)
+            self.qty = lambda value: to_fixed(value, qty_scale)
+            self.mark = lambda value: to_fixed(value, MARK_SCALE)
+            self.key = self.price
+            self.level_qty = self.qty
+            self.is_zero = lambda qty: qty == 0
+            self.column_types = FIXED_COLUMN_TYPES
+        else:
+            self.price = self.qty = self.mark = float
+            # 订单簿以数值为键, 与快照存储中的数组一致 (原始字符串 "100.10" 和 "100.1" 是同一档)
+            self.key = self.level_qty = float
+            self.is_zero = is_zero_qty
+            self.column_types = COLUMN_TYPES
+
+    def metadata(self):
+        if not self.fixed:
+            return {}
+        return {'price_scale': self.price_scale, 'qty_scale': self.qty_scale, 'mark_scale': MARK_SCALE}
+
+    def load_snapshot(self, snapshot_src_file):
+        """读取初始订单簿, snapshot_src_file 为 .snapshot.pkl 文件或快照存储中的 Snapshot。"""
+        if isinstance(snapshot_src_file, Snapshot):
+            self.load_book(snapshot_src_file)
+            return
+        import pandas as pd
+        snapshot_df = pd.read_pickle(snapshot_src_file, compression='gzip')
+        side = snapshot_df['side'].to_numpy()
+        price = snapshot_df['price'].to_numpy()
+        qty = snapshot_df['qty'].to_numpy()
+        bids = side == 1
+        asks = side == -1
+        self.load_book(Snapshot(0, 0, price[bids], qty[bids], price[asks], qty[asks],
+                                snapshot_df.attrs.get('price_scale', FLOAT), snapshot_df.attrs.get('qty_scale', FLOAT)))
+
+    def load_book(self, snapshot):
+        price_scale = self.price_scale if self.fixed else FLOAT
+        qty_scale = self.qty_scale if self.fixed else FLOAT
+        self.bid_depth.update(zip(rescale(snapshot.bid_prices, snapshot.price_scale, price_scale),
+                                  rescale(snapshot.bid_qtys, snapshot.qty_scale, qty_scale)))
+        self.ask_depth.update(zip(rescale(snapshot.ask_prices, snapshot.price_scale, price_scale),
+                                  rescale(snapshot.ask_qtys, snapshot.qty_scale, qty_scale)))
+
+    def book_snapshot(self):
+        """当前订单簿的 Snapshot, 用于保存到快照存储。"""
+        dtype = 'i8' if self.fixed else 'f8'
+        bids = sorted(self.bid_depth.items(), reverse=True)
+        asks = sorted(self.ask_depth.items())
+        return Snapshot(self.exch_timestamp, self.local_timestamp,
+                        np.array([level[0] for level in bids], dtype), np.array([level[1] for level in bids], dtype),
+                        np.array([level[0] for level in asks], dtype), np.array([level[1] for level in asks], dtype),
+                        self.price_scale if self.fixed else FLOAT, self.qty_scale if self.fixed else FLOAT)
+
+    def state(self):
+        return {
+            'bid_depth': self.bid_depth,
+            'ask_depth': self.ask_depth,
+            'prev_exch_timestamp': self.prev_exch_timestamp,
+            'max_exch_timestamp': self.max_exch_timestamp,
+            'exch_timestamp': self.exch_timestamp,
+            'local_timestamp': self.local_timestamp,
+        }
+
+    def restore(self, state):
+        # JSON 的键只能是字符串, 旧版本的浮点模式状态中数量也是字符串
+        value = int if self.fixed else float
+        self.bid_depth = {value(price): value(qty) for price, qty in state['bid_depth'].items()}
+        self.ask_depth = {value(price): value(qty) for price, qty in state['ask_depth'].items()}
+        self.prev_exch_timestamp = state['prev_exch_timestamp']
+        # 旧版本的状态中 prev_exch_timestamp 是修正后的值
+        self.max_exch_timestamp = state.get('max_exch_timestamp', self.prev_exch_timestamp)
+        self.exch_timestamp = state['exch_timestamp']
+        self.local_timestamp = state['local_timestamp']
+
+    def convert(self, line, rows):
+        self.convert_message(int(line[:16]), json.loads(line[17:]), rows)
+
+    def convert_message(self, local_timestamp, message, rows):
+        bid_depth = self.bid_depth
+        ask_depth = self.ask_depth
+        prev_exch_timestamp = self.prev_exch_timestamp
+        exch_timestamp = self.exch_timestamp
+        to_price = self.price
+        to_qty = self.qty
+        data = message.get('data')
+        if data is not None:
+            if 'e' in data:
+                evt = data['e']
+            else:
+                evt = message['stream'].split('@')[1]
+            if evt == 'trade':
+                # transaction_time = data['T']
+                transaction_time = data['E']
+                price = data['p']
+                qty = data['q']
+                side = -1 if data['m'] else 1  # trade initiator's side
+                exch_timestamp = int(transaction_time) * 1000
+                prev_exch_timestamp = exch_timestamp
+                rows.append([2, exch_timestamp, local_timestamp, side, to_price(price), to_qty(qty)])
+            elif evt == 'depthUpdate':
+                # transaction_time = data['T']
+                transaction_time = data['E']
+                bids = data['b']
+                asks = data['a']
+                exch_timestamp = int(transaction_time) * 1000
+                prev_exch_timestamp = exch_timestamp
+                rows += [[1, exch_timestamp, local_timestamp, 1, to_price(bid[0]), to_qty(bid[1])] for bid in bids]
+                rows += [[1, exch_timestamp, local_timestamp, -1, to_price(ask[0]), to_qty(ask[1])] for ask in asks]
+                key = self.key
+                level_qty = self.level_qty
+                is_zero = self.is_zero
+                for bid in bids:
+                    price = key(bid[0])
+                    qty = level_qty(bid[1])
+                    if is_zero(qty):
+                        if price in bid_depth:
+                            del bid_depth[price]
+                    else:
+                        bid_depth[price] = qty
+                for ask in asks:
+                    price = key(ask[0])
+                    qty = level_qty(ask[1])
+                    if is_zero(qty):
+                        if price in ask_depth:
+                            del ask_depth[price]
+                    else:
+                        ask_depth[price] = qty
+            elif evt == 'markPriceUpdate' and self.full:
+                # transaction_time = data['T']
+                transaction_time = data['E']
+                index = data['i']
+                mark_price = data['p']
+                # est_settle_price = data['P']
+                funding_rate = data['r']
+                to_mark = self.mark
+                rows.append([100, prev_exch_timestamp, local_timestamp, 0, to_mark(index), 0])
+                rows.append([101, prev_exch_timestamp, local_timestamp, 0, to_mark(mark_price), 0])
+                rows.append([102, prev_exch_timestamp, local_timestamp, 0, to_mark(funding_rate), 0])
+            elif evt == 'bookTicker' and self.full:
+                if 'T' in message:
+                    transaction_time = message['T']
+                    exch_timestamp = int(transaction_time) * 1000
+                else:
+                    exch_timestamp = local_timestamp
+                bid_price = data['b']
+                bid_qty = data['B']
+                ask_price = data['a']
+                ask_qty = data['A']
+                prev_exch_timestamp = exch_timestamp
+                rows.append([103, exch_timestamp, local_timestamp, 1, to_price(bid_price), to_qty(bid_qty)])
+                rows.append([104, exch_timestamp, local_timestamp, -1, to_price(ask_price), to_qty(ask_qty)])
+        else:
+            # snapshot
+            # event_time = msg['E']
+            # 判断 message['T'] 是否存在
+            if 'T' in message:
+                transaction_time = message['T']
+                exch_timestamp = int(transaction_time) * 1000
+            else:
+                exch_timestamp = local_timestamp
+            bids = message['bids']
+            asks = message['asks']
+            bid_clear_upto = to_price(bids[-1][0])
+            ask_clear_upto = to_price(asks[-1][0])
+            prev_exch_timestamp = exch_timestamp
+            # clear the existing market depth upto the prices in the snapshot.
+            rows.append([3, exch_timestamp, local_timestamp, 1, bid_clear_upto, 0])
+            rows.append([3, exch_timestamp, local_timestamp, -1, ask_clear_upto, 0])
+            key = self.key
+            last_bid = key(bids[-1][0])
+            last_ask = key(asks[-1][0])
+            # 订单簿的键与 to_price 的类型相同 (浮点模式为 float, 定点模式为 int), 直接比较
+            for bid in list(bid_depth.keys()):
+                if bid > bid_clear_upto or bid == last_bid:
+                    del bid_depth[bid]
+            for ask in list(ask_depth.keys()):
+                if ask < ask_clear_upto or ask == last_ask:
+                    del ask_depth[ask]
+            # insert the snapshot.
+            rows += [[4, exch_timestamp, local_timestamp, 1, to_price(bid[0]), to_qty(bid[1])] for bid in bids]
+            rows += [[4, exch_timestamp, local_timestamp, -1, to_price(ask[0]), to_qty(ask[1])] for ask in asks]
+            level_qty = self.level_qty
+            for bid in bids:
+                bid_depth[key(bid[0])] = level_qty(bid[1])
+            for ask in asks:
+                ask_depth[key(ask[0])] = level_qty(ask[1])
+        self.prev_exch_timestamp = prev_exch_timestamp
+        self.exch_timestamp = exch_timestamp
+        self.local_timestamp = local_timestamp
+
+    def snapshot_rows(self):
+        exch_timestamp = self.exch_timestamp
+        local_timestamp = self.local_timestamp
+        value = int if self.fixed else float
+        snapshot = []
+        snapshot += [[4, exch_timestamp, local_timestamp, 1, value(bid), value(qty)]
+                     for bid, qty in sorted(self.bid_depth.items(), key=lambda v: -value(v[0]))]
+        snapshot += [[4, exch_timestamp, local_timestamp, -1, value(ask), value(qty)]
+                     for ask, qty in sorted(self.ask_depth.items(), key=lambda v: value(v[0]))]
+        return snapshot
+
+    def correct(self, exch_timestamp):
+        """correct_exch_timestamp 时就地修正一批行的 exch_timestamp 列, 与之前输出的批次连续。"""
+        if self.correct_exch_timestamp and len(exch_timestamp):
+            self.max_exch_timestamp = correct_exch_timestamp(exch_timestamp, self.max_exch_timestamp)
+
+    def to_array(self, rows):
+        """把转换得到的行变为结构化数组, 字段为 COLUMNS, 类型为 column_types, exch_timestamp 已按需修正。"""
+        array = np.empty(len(rows), dtype=record_dtype(self.column_types))
+        if rows:
+            for column, values in zip(COLUMNS, zip(*rows)):
+                array[column] = values
+            self.correct(array['exch_timestamp'])
+        return array
+
+    def to_frame(self, rows):
+        import pandas as pd
+        df = pd.DataFrame(self.to_array(rows))
+        df.attrs.update(self.metadata())
+        return df
+
+
+def correct_exch_timestamp(exch_timestamp, initial=0):
+    """
+    就地把 exch_timestamp (int64 数组) 修正为不小于 initial 的累计最大值, 交易所时间戳回退的行使用之前的最大时间戳。
+    返回修正后的最大值, 作为下一批的 initial。
+    """
+    if exch_timestamp[0] < initial:
+        exch_timestamp[0] = initial
+    np.maximum.accumulate(exch_timestamp, out=exch_timestamp)
+    return int(exch_timestamp[-1])
+
+
+def estimate_latency(event, exch_timestamp, local_timestamp, window=60000000):
+    """
+    估计本地时钟相对交易所时钟的偏移和每一行的行情延迟 (微秒), 返回 (clock_offset, latency) 两个 int64 数组。
+
+    每行的时间差 local_timestamp - exch_timestamp 为时钟偏移加上传输延迟。按 local_timestamp 每 window 微秒分段,
+    取本段和前一段中深度和成交行 (事件时间来自交易所) 的最小时间差作为 clock_offset, latency 为时间差减去 clock_offset,
+    即超出最小延迟的部分。只有单向的时间戳时无法区分时钟偏移和最小延迟, clock_offset 包含两者。
+    没有深度和成交行的段沿用前一段的估计。
+    """
+    event = np.asarray(event)
+    local_timestamp = np.asarray(local_timestamp, dtype=np.int64)
+    delay = local_timestamp - np.asarray(exch_timestamp, dtype=np.int64)
+    if len(delay) == 0:
+        return delay.copy(), delay.copy()
+    segments, inverse = np.unique(local_timestamp // window, return_inverse=True)
+    valid = np.isin(event, LATENCY_EVENTS)
+    missing = np.iinfo(np.int64).max
+    minimum = np.full(len(segments), missing, dtype=np.int64)
+    np.minimum.at(minimum, inverse[valid], delay[valid])
+    # 与时间上相邻的前一段合并为滚动窗口
+    offset = minimum.copy()
+    adjacent = np.flatnonzero(np.diff(segments) == 1) + 1
+    offset[adjacent] = np.minimum(minimum[adjacent], minimum[adjacent - 1])
+    found = offset != missing
+    if not found.any():
+        offset[:] = 0
+    else:
+        # 没有有效行的段沿用前一段, 开头的段使用第一个有效段
+        last = np.maximum.accumulate(np.where(found, np.arange(len(offset)), -1))
+        last[last < 0] = np.argmax(found)
+        offset = offset[last]
+    clock_offset = offset[inverse]
+    return clock_offset, delay - clock_offset
+
+
+def iter_messages(src_file):
+    """
+    逐条产出 (local_timestamp, message), 支持 .dat, .gz 和二进制归档 .bin。
+    """
+    ext = os.path.splitext(src_file)[1]
+    if ext == '.bin':
+        # 二进制归档直接解码为对象, 不需要 JSON 解析
+        for local_timestamp, tag, message in read_file(src_file):
+            if tag == TAG_RAW:
+                message = json.loads(message)
+            yield local_timestamp, message
+        return
+    open_func = gzip.open if ext == '.gz' else open
+    with open_func(src_file, 'rt') as f:
+        for line in f:
+            yield int(line[:16]), json.loads(line[17:])
+
+
+def source_filename(src_file):
+    """源文件对应的输出文件名 (不含扩展名), 如 btcusdt_20220811。"""
+    ext = os.path.splitext(src_file)[1]
+    if ext == '.gz':
+        return os.path.basename(os.path.splitext(os.path.splitext(src_file)[0])[0])
+    elif ext == '.dat' or ext == '.bin':
+        return os.path.basename(os.path.splitext(src_file)[0])
+    raise ValueError('unsupported source file: %s' % src_file)
+
+
+def prior_snapshot(store, src_file, exchange=None):
+    """
+    快照存储中早于源文件第一条记录的最近一个快照, 即前一天的日终订单簿, 没有时返回 None。
+    store 为 snapstore.SnapshotStore, 交易对取自文件名。
+    """
+    symbol = source_filename(src_file).rsplit('_', 1)[0]
+    for local_timestamp, _ in iter_messages(src_file):
+        return store.get(exchange, symbol, local_timestamp)
+    return None
+
+
+def top_levels(converter, depth=20):
+    """
+    从 converter 的订单簿重建前 depth 档 (与现货 depth20 stream 的内容相同), 用于不订阅有限档深度时按需生成,
+    返回 ([(price, qty)] bids 价格降序, asks 价格升序)。
+    """
+    return heapq.nlargest(depth, converter.bid_depth.items()), heapq.nsmallest(depth, converter.ask_depth.items())
+
+
+def create_converter(full=True, correct=False, snapshot=None, price_scale=None, qty_scale=None):
+    converter = Converter(full, correct, price_scale, qty_scale)
+    if snapshot is not None:
+        converter.load_snapshot(snapshot)
+    return converter
+
+
+def iter_batches(src_file, full=True, correct=False, snapshot=None, batch_size=65536, price_scale=None,
+                 qty_scale=None, converter=None):
+    """
+    转换 .dat/.gz/.bin 文件, 每 batch_size 行左右产出一个结构化数组 (同一条消息的行不会被拆开)。
+    选项与命令行相同: full 包括 mark price, funding, book ticker, correct 修正交易所时间戳,
+    snapshot 为前一天的 .snapshot.pkl 或快照存储中的 Snapshot (见 prior_snapshot)。传入 converter 时忽略这些选项, 可以跨文件延续订单簿状态。
+    """
+    if converter is None:
+        converter = create_converter(full, correct, snapshot, price_scale, qty_scale)
+    convert_message = converter.convert_message
+    rows = []
+    for local_timestamp, message in iter_messages(src_file):
+        convert_message(local_timestamp, message, rows)
+        if len(rows) >= batch_size:
+            yield converter.to_array(rows)
+            rows = []
+    if rows:
+        yield converter.to_array(rows)
+
+
+def replay_book(src_file, callback, full=True, correct=False, snapshot=None, price_scale=None, qty_scale=None,
+                converter=None):
+    """
+    逐条消息回放订单簿, 每条消息转换后调用 callback(local_timestamp, converter),
+    converter.bid_depth/ask_depth 为当前的订单簿, converter.exch_timestamp 为当前的交易所时间戳 (correct 时已修正)。
+    返回 converter, 可以用 book_snapshot() 得到日终快照。
+    """
+    if converter is None:
+        converter = create_converter(full, correct, snapshot, price_scale, qty_scale)
+    convert_message = converter.convert_message
+    correct = converter.correct_exch_timestamp
+    rows = []
+    for local_timestamp, message in iter_messages(src_file):
+        convert_message(local_timestamp, message, rows)
+        if correct:
+            # 不生成数组, 逐条消息用累计最大值修正
+            converter.exch_timestamp = converter.max_exch_timestamp = max(converter.exch_timestamp,
+                                                                          converter.max_exch_timestamp)
+        callback(local_timestamp, converter)
+        rows.clear()
+    return converter
@@ -0,0 +1,248 @@
+"""
+多交易对, 多天的时间归并回放, 内存占用与天数无关。
+
+    python3 convert/replay.py -d /mnt/data -s btcusdt,ethusdt --start 20220811 --end 20220812
+
+    from replay import find_sources, replay
+    for batch in replay(find_sources('/mnt/data', ['btcusdt', 'ethusdt'], '20220811', '20220812')):
+        batch['symbol'], batch['local_timestamp'], batch['price'] ...
+
+每个交易对每天的数据按 .cols (follow 模式的列式存储, np.memmap 读取) > .pkl > .bin > .dat > .dat.gz 的优先级选择一个文件,
+同一交易对的多天数据顺序拼接, 原始文件共用一个 Converter, 订单簿状态可以跨天延续,
+第一个原始文件的初始订单簿可以从快照存储 (--snapshot-store) 中获取。
+每个数据源按 chunk_size 行分块读取: .cols 按块 np.memmap, 原始文件按块转换, 内存占用与文件大小无关;
+gzip 压缩的 .pkl 无法分块读取, 每个交易对同时只加载一个文件 (一天) 的数据, 需要固定内存占用时使用 .cols (convert.py -F)。
+用堆维护各数据源当前块的最后一个时间戳 (frontier),
+每一轮输出所有数据源中不晚于最小 frontier 的行, 合并后稳定排序, 相同时间戳按交易对的顺序输出。
+要求每个数据源按排序键非递减: local_timestamp 总是满足, 按 exch_timestamp 归并时必须使用 -c,
+每个交易对的 exch_timestamp 跨文件, 跨块取累计最大值 (原始文件在转换时修正)。
+只支持浮点模式的数据, 定点模式 (--fixed) 转换的 .pkl/.cols 各交易对的小数位数不同, 无法合并为同一列, 直接报错。
+"""
+import argparse
+import heapq
+import json
+import os
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+from converter import COLUMN_TYPES, COLUMNS, Converter, correct_exch_timestamp, iter_messages, prior_snapshot
+from snapstore import SnapshotStore
+
+EXTENSIONS = ['.cols', '.pkl', '.bin', '.dat', '.dat.gz']
+KEYS = ('local_timestamp', 'exch_timestamp')
+
+
+def batch_dtype(column_types=COLUMN_TYPES):
+    return np.dtype([('symbol', 'i4')] + list(zip(COLUMNS, column_types)))
+
+
+def find_sources(directory, symbols, start=None, end=None):
+    """
+    返回 [[symbol 的按日期排序的文件], ...], 顺序与 symbols 相同。start/end 为 YYYYMMDD (包含)。
+    """
+    found = {}
+    for filename in os.listdir(directory):
+        for ext in EXTENSIONS:
+            if filename.endswith(ext):
+                match = re.match(r'^(.+)_(\d{8})$', filename[:-len(ext)])
+                if match is None:
+                    break
+                symbol, date = match.groups()
+                if symbol not in symbols or (start and date < start) or (end and date > end):
+                    break
+                current = found.get((symbol, date))
+                if current is None or EXTENSIONS.index(ext) < EXTENSIONS.index(current[1]):
+                    found[(symbol, date)] = (os.path.join(directory, filename), ext)
+                break
+    return [[found[key][0] for key in sorted(key for key in found if key[0] == symbol)] for symbol in symbols]
+
+
+def _check_float(path, metadata):
+    if 'price_scale' in metadata:
+        raise ValueError('fixed-point data cannot be replayed, convert it without --fixed: %s' % path)
+
+
+def _column_chunks(path, chunk_size):
+    """ColumnStore 目录, 每列 np.memmap, 按块切片。"""
+    meta_file = os.path.join(path, 'meta.json')
+    if os.path.exists(meta_file):
+        with open(meta_file, 'r') as f:
+            _check_float(path, json.load(f))
+    columns = []
+    for column in COLUMNS:
+        filename = [name for name in os.listdir(path) if name.split('.')[0] == column][0]
+        dtype = filename.split('.', 1)[1]
+        if os.path.getsize(os.path.join(path, filename)) == 0:
+            return
+        columns.append(np.memmap(os.path.join(path, filename), dtype=dtype, mode='r'))
+    # follow 模式正在追加时各列长度可能不同
+    length = min(len(values) for values in columns)
+    for i in range(0, length, chunk_size):
+        yield [values[i:i + chunk_size] for values in columns]
+
+
+def _pickle_chunks(path, chunk_size):
+    """gzip 压缩的 DataFrame 只能整体读取, 只保留各列数组, 读完这个文件后才读取下一个。"""
+    df = pd.read_pickle(path, compression='gzip')
+    _check_float(path, df.attrs)
+    columns = [df[column].to_numpy() for column in COLUMNS]
+    del df
+    for i in range(0, len(columns[0]), chunk_size):
+        yield [values[i:i + chunk_size] for values in columns]
+
+
+def _raw_chunks(path, chunk_size, converter):
+    rows = []
+    for local_timestamp, message in iter_messages(path):
+        converter.convert_message(local_timestamp, message, rows)
+        if len(rows) >= chunk_size:
+            array = converter.to_array(rows)
+            yield [array[column] for column in COLUMNS]
+            rows = []
+    if rows:
+        array = converter.to_array(rows)
+        yield [array[column] for column in COLUMNS]
+
+
+class Source:
+    """一个交易对按日期顺序拼接的数据, 逐块产出结构化数组。"""
+
+    def __init__(self, symbol_id, paths, dtype, key, chunk_size=65536, full=True, snapshot_store=None, exchange=None,
+                 correct=False):
+        self.symbol_id = symbol_id
+        self.paths = paths
+        self.dtype = dtype
+        self.key = key
+        self.chunk_size = chunk_size
+        self.full = full
+        self.snapshot_store = snapshot_store
+        self.exchange = exchange
+        self.correct = correct
+
+    def chunks(self):
+        converter = None
+        # 跨文件的 exch_timestamp 累计最大值
+        max_exch_timestamp = 0
+        for path in self.paths:
+            if path.endswith('.cols'):
+                chunks = _column_chunks(path, self.chunk_size)
+                converter = None
+            elif path.endswith('.pkl'):
+                chunks = _pickle_chunks(path, self.chunk_size)
+                converter = None
+            else:
+                if converter is None:
+                    # 连续的原始文件共用一个 Converter, 第一个文件从快照存储中取前一天的订单簿
+                    converter = Converter(self.full, self.correct)
+                    if self.snapshot_store is not None:
+                        snapshot = prior_snapshot(self.snapshot_store, path, self.exchange)
+                        if snapshot is not None:
+                            converter.load_book(snapshot)
+                chunks = _raw_chunks(path, self.chunk_size, converter)
+            for columns in chunks:
+                chunk = np.empty(len(columns[0]), dtype=self.dtype)
+                chunk['symbol'] = self.symbol_id
+                for column, values in zip(COLUMNS, columns):
+                    chunk[column] = values
+                if self.correct and len(chunk):
+                    max_exch_timestamp = correct_exch_timestamp(chunk['exch_timestamp'], max_exch_timestamp)
+                if self.key != 'local_timestamp':
+                    chunk = chunk[np.argsort(chunk[self.key], kind='stable')]
+                yield chunk
+
+
+def replay(sources, key='local_timestamp', chunk_size=65536, column_types=COLUMN_TYPES, full=True,
+           snapshot_store=None, exchange=None, correct=False):
+    """
+    sources 为 find_sources 的返回值, 逐批产出按 key 归并排序后的结构化数组 (字段见 batch_dtype),
+    symbol 字段为交易对在 sources 中的下标。指定 snapshot_store (snapstore.SnapshotStore) 时,
+    原始文件的初始订单簿取自其中最近的前一个快照。correct 时修正每个交易对的 exch_timestamp 使其单调不减,
+    key 为 exch_timestamp 时必须指定, 否则块之间的 exch_timestamp 可能倒退, 无法归并。
+    """
+    if key not in KEYS:
+        raise ValueError('key must be one of %s.' % (KEYS,))
+    if key == 'exch_timestamp' and not correct:
+        raise ValueError('replaying by exch_timestamp requires correct=True.')
+    dtype = batch_dtype(column_types)
+    iterators = [Source(i, paths, dtype, key, chunk_size, full, snapshot_store, exchange, correct).chunks()
+                 for i, paths in enumerate(sources)]
+    chunks = [None] * len(iterators)
+    positions = [0] * len(iterators)
+    frontiers = []
+
+    def advance(i):
+        for chunk in iterators[i]:
+            if len(chunk):
+                chunks[i] = chunk
+                positions[i] = 0
+                heapq.heappush(frontiers, (chunk[key][-1], i))
+                return
+        chunks[i] = None
+
+    for i in range(len(iterators)):
+        advance(i)
+    while frontiers:
+        limit = frontiers[0][0]
+        parts = []
+        for i, chunk in enumerate(chunks):
+            if chunk is None:
+                continue
+            start = positions[i]
+            stop = start + np.searchsorted(chunk[key][start:], limit, side='right')
+            if stop > start:
+                parts.append(chunk[start:stop])
+                positions[i] = stop
+        # frontier 等于 limit 的数据源的当前块已被完全消费, 全部弹出后再读取下一块
+        # (下一块的 frontier 可能仍等于 limit, 不能在同一轮中再次弹出)
+        exhausted = []
+        while frontiers and frontiers[0][0] == limit:
+            exhausted.append(heapq.heappop(frontiers)[1])
+        for i in exhausted:
+            advance(i)
+        if not parts:
+            continue
+        batch = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        if len(parts) > 1:
+            batch = batch[np.argsort(batch[key], kind='stable')]
+        yield batch
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--directory', required=True)
+    parser.add_argument('-s', '--symbols', required=True, help='symbols separated by comma')
+    parser.add_argument('--start', help='first date, YYYYMMDD')
+    parser.add_argument('--end', help='last date, YYYYMMDD')
+    parser.add_argument('--key', choices=KEYS, default='local_timestamp')
+    parser.add_argument('--chunk-size', type=int, default=65536)
+    parser.add_argument('-c', '--correct', action='store_true',
+                        help='make exch_timestamp non-decreasing per symbol, needed with --key exch_timestamp')
+    parser.add_argument('--snapshot-store', help='snapshot store directory for the initial books of raw files')
+    parser.add_argument('--exchange', help='exchange key in the snapshot store')
+    args = parser.parse_args()
+    if args.key == 'exch_timestamp' and not args.correct:
+        parser.error('--key exch_timestamp requires -c')
+
+    symbols = args.symbols.split(',')
+    sources = find_sources(args.directory, symbols, args.start, args.end)
+    for symbol, paths in zip(symbols, sources):
+        print('%s: %s' % (symbol, ', '.join(os.path.basename(path) for path in paths) or '-'))
+    counts = np.zeros(len(symbols), dtype='i8')
+    batches = 0
+    first = last = None
+    started = time.time()
+    snapshot_store = SnapshotStore(args.snapshot_store) if args.snapshot_store else None
+    for batch in replay(sources, args.key, args.chunk_size, snapshot_store=snapshot_store, exchange=args.exchange,
+                        correct=args.correct):
+        counts += np.bincount(batch['symbol'], minlength=len(symbols))
+        batches += 1
+        if first is None:
+            first = batch[args.key][0]
+        last = batch[args.key][-1]
+    elapsed = time.time() - started
+    print('Done. rows=%d, batches=%d, first=%s, last=%s, elapsed=%.2fs, %s' % (
+        counts.sum(), batches, first, last, elapsed,
+        ', '.join('%s=%d' % item for item in zip(symbols, counts))))
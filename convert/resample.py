@@ -0,0 +1,208 @@
+"""
+从原始归档生成降采样数据集, 一次读取原始数据同时得到:
+    <filename>.book_<interval>.npz  固定间隔的前 N 档订单簿快照
+    <filename>.bars_<interval>.npz  固定间隔的 OHLCV / 主动买卖量 / VWAP / 成交不平衡 K 线
+
+    python3 convert/resample.py -i /mnt/data/btcusdt_20220811.dat -o /mnt/data --book-interval 100ms --bar-interval 1s
+
+订单簿通过 converter 的行 (event 1/3/4) 回放, 成交行 (event 2) 收集后用 numpy 一次性聚合。
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+from converter import Converter, iter_messages, prior_snapshot, source_filename
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'collect'))
+
+from book import OrderBook  # noqa: E402
+from snapstore import SnapshotStore  # noqa: E402
+
+UNITS = {'us': 1, 'ms': 1000, 's': 1000000, 'm': 60000000, 'h': 3600000000}
+
+
+def parse_interval(value):
+    """'100ms', '1s', '5m' -> 微秒。"""
+    for unit in sorted(UNITS, key=len, reverse=True):
+        if value.endswith(unit):
+            return int(float(value[:-len(unit)]) * UNITS[unit])
+    return int(value)
+
+
+class BookSampler:
+    """
+    回放 converter 输出的深度行, 每跨过一个采样时刻记录一次前 N 档。
+    """
+
+    def __init__(self, depth, interval):
+        self.book = OrderBook()
+        self.depth = depth
+        self.interval = interval
+        self.next_timestamp = None
+        self.timestamps = []
+        self.bids = []
+        self.asks = []
+
+    def sample_until(self, timestamp):
+        if self.next_timestamp is None:
+            self.next_timestamp = (timestamp // self.interval + 1) * self.interval
+            return
+        if timestamp < self.next_timestamp:
+            return
+        # 采样时刻的状态是该时刻之前最后一条消息之后的状态, 空档期间的采样时刻状态不变
+        bids = self.__levels(self.book.top_bids(self.depth))
+        asks = self.__levels(self.book.top_asks(self.depth))
+        while self.next_timestamp <= timestamp:
+            self.timestamps.append(self.next_timestamp)
+            self.bids.append(bids)
+            self.asks.append(asks)
+            self.next_timestamp += self.interval
+
+    def __levels(self, levels):
+        levels = np.array(levels, dtype='f8').reshape(-1, 2)
+        if len(levels) < self.depth:
+            levels = np.vstack([levels, np.full((self.depth - len(levels), 2), np.nan)])
+        return levels
+
+    def apply(self, event, side, price, qty):
+        book = self.book
+        if event == 1 or event == 4:
+            if round(qty / 0.000001) == 0:
+                qty = 0
+            if side == 1:
+                book.set_bid(price, qty)
+            else:
+                book.set_ask(price, qty)
+        elif event == 3:
+            if side == 1:
+                book.clear_bids_from(price)
+            else:
+                book.clear_asks_upto(price)
+
+    def result(self):
+        bids = np.array(self.bids, dtype='f8').reshape(-1, self.depth, 2)
+        asks = np.array(self.asks, dtype='f8').reshape(-1, self.depth, 2)
+        return {
+            'timestamp': np.array(self.timestamps, dtype='i8'),
+            'bid_price': bids[:, :, 0],
+            'bid_qty': bids[:, :, 1],
+            'ask_price': asks[:, :, 0],
+            'ask_qty': asks[:, :, 1],
+        }
+
+
+def aggregate_trades(timestamps, prices, qtys, sides, interval):
+    """
+    把成交聚合为固定间隔的 K 线, 没有成交的区间不输出。
+    """
+    timestamps = np.asarray(timestamps, dtype='i8')
+    prices = np.asarray(prices, dtype='f8')
+    qtys = np.asarray(qtys, dtype='f8')
+    sides = np.asarray(sides, dtype='i8')
+    if len(timestamps) == 0:
+        names = ['open', 'high', 'low', 'close', 'volume', 'quote_volume', 'buy_volume', 'sell_volume', 'vwap',
+                 'imbalance']
+        result = {name: np.array([], dtype='f8') for name in names}
+        result['timestamp'] = np.array([], dtype='i8')
+        result['trades'] = np.array([], dtype='i8')
+        return result
+    bucket = timestamps // interval
+    # 交易所时间戳可能不单调, 稳定排序保持同一区间内的成交顺序
+    order = np.argsort(bucket, kind='stable')
+    bucket = bucket[order]
+    prices = prices[order]
+    qtys = qtys[order]
+    sides = sides[order]
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    ends = np.r_[starts[1:], len(bucket)]
+    quote = prices * qtys
+    volume = np.add.reduceat(qtys, starts)
+    buy_volume = np.add.reduceat(np.where(sides == 1, qtys, 0), starts)
+    sell_volume = volume - buy_volume
+    quote_volume = np.add.reduceat(quote, starts)
+    return {
+        'timestamp': bucket[starts] * interval,
+        'open': prices[starts],
+        'high': np.maximum.reduceat(prices, starts),
+        'low': np.minimum.reduceat(prices, starts),
+        'close': prices[ends - 1],
+        'volume': volume,
+        'quote_volume': quote_volume,
+        'buy_volume': buy_volume,
+        'sell_volume': sell_volume,
+        'trades': ends - starts,
+        'vwap': quote_volume / volume,
+        'imbalance': (buy_volume - sell_volume) / volume,
+    }
+
+
+def resample(src_file, book_interval, bar_interval, depth=20, snapshot=None, correct=False, timestamp='local'):
+    """
+    一次读取 src_file, 返回 (book, bars) 两个 {列名: ndarray} 字典。timestamp 为 'local' 或 'exch'。
+    snapshot 为 .snapshot.pkl 文件或快照存储中的 Snapshot。
+    """
+    converter = Converter(full=False, correct_exch_timestamp=correct)
+    sampler = BookSampler(depth, book_interval)
+    if snapshot is not None:
+        converter.load_snapshot(snapshot)
+        for price, qty in converter.bid_depth.items():
+            sampler.book.set_bid(float(price), float(qty))
+        for price, qty in converter.ask_depth.items():
+            sampler.book.set_ask(float(price), float(qty))
+    ts_col = 2 if timestamp == 'local' else 1
+    trade_timestamps = []
+    trade_prices = []
+    trade_qtys = []
+    trade_sides = []
+    rows = []
+    for local_timestamp, message in iter_messages(src_file):
+        converter.convert_message(local_timestamp, message, rows)
+        if not rows:
+            continue
+        # 同一条消息的行时间戳相同, 逐条消息采样时交易所时间戳用累计最大值修正
+        ts = rows[0][ts_col]
+        if ts_col == 1 and converter.correct_exch_timestamp:
+            ts = converter.max_exch_timestamp = max(ts, converter.max_exch_timestamp)
+        sampler.sample_until(ts)
+        for row in rows:
+            event = row[0]
+            if event == 2:
+                trade_timestamps.append(ts)
+                trade_sides.append(row[3])
+                trade_prices.append(row[4])
+                trade_qtys.append(row[5])
+            else:
+                sampler.apply(event, row[3], row[4], row[5])
+        rows.clear()
+    bars = aggregate_trades(trade_timestamps, trade_prices, trade_qtys, trade_sides, bar_interval)
+    return sampler.result(), bars
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--src_file', required=True)
+    parser.add_argument('-o', '--dst_path', required=True)
+    parser.add_argument('-s', '--snapshot', help='initial market depth snapshot (.snapshot.pkl)')
+    parser.add_argument('-c', '--correct', action='store_true')
+    parser.add_argument('--snapshot-store', help='snapshot store directory, used when -s is not given')
+    parser.add_argument('--exchange', help='exchange key in the snapshot store')
+    parser.add_argument('--book-interval', default='100ms')
+    parser.add_argument('--bar-interval', default='1s')
+    parser.add_argument('--depth', type=int, default=20)
+    parser.add_argument('--timestamp', choices=['local', 'exch'], default='local')
+    args = parser.parse_args()
+
+    filename = source_filename(args.src_file)
+    snapshot = args.snapshot
+    if snapshot is None and args.snapshot_store:
+        snapshot = prior_snapshot(SnapshotStore(args.snapshot_store), args.src_file, args.exchange)
+    book, bars = resample(args.src_file, parse_interval(args.book_interval), parse_interval(args.bar_interval),
+                          args.depth, snapshot, args.correct, args.timestamp)
+    book_file = os.path.join(args.dst_path, '%s.book_%s.npz' % (filename, args.book_interval))
+    bars_file = os.path.join(args.dst_path, '%s.bars_%s.npz' % (filename, args.bar_interval))
+    np.savez_compressed(book_file, **book)
+    np.savez_compressed(bars_file, **bars)
+    print('Done. book=%d, bars=%d, filename=%s, %s' % (len(book['timestamp']), len(bars['timestamp']),
+                                                        book_file, bars_file))